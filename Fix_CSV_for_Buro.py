@@ -15,8 +15,11 @@
 - проверяет FULLCARDCODE на дубликаты и удаляет все кроме первого с сохранением в отдельную таблицу списка дубликатов,
 - переносит WORG6 → WORG7 если пусты WORG7 и WORG8, эти поля содержат название организаций,
 - заполняет поле подразделение – WDEP8 ("Нет данных") если строка пустая,
-- пересохраняет готовый файл через Excel COM для 100% совместимости с импортёром.
+- сохраняет готовый файл в структуре Excel (sharedStrings, стили, метаданные листа) без
+  пересохранения через Excel COM (COM остаётся как опция --com).
 - добавлена проверка готового xlsx файла на соответствие структуры
+- обработка доступна без GUI: ExportPipeline / check_export и командная строка
+  (python Fix_CSV_for_Buro.py process <папка> -o <результат>).
 
 Автор: Шаулис Э.Ю.
 Дата: 01.03.2026
@@ -24,19 +27,110 @@
 """
 
 import os
+import sys
 import glob
-import pandas as pd
+import json
+import hashlib
+import codecs
+import csv
+import difflib
+import functools
+import io
+import time
+import tracemalloc
+import argparse
+import multiprocessing
+import pickle
+import queue
+import shutil
+import sqlite3
+import tempfile
+import unicodedata
+import zipfile
 import re
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 from tkinter import Tk, Label, Button, Text, END, DISABLED, NORMAL, messagebox, filedialog, Menu, ttk, Scrollbar, Frame
 from tkinter.font import Font
 import threading
 
-try:
-    import win32com.client as win32
-    HAS_WIN32 = True
-except ImportError:
-    HAS_WIN32 = False
+
+class _LazyModule:
+    """Модуль, который импортируется при первом обращении к атрибуту.
+
+    pandas и numpy на слабых машинах грузятся секунды — окно GUI показывается
+    сразу, а модули подгружаются в фоне (warm_up) или при первом использовании.
+    После загрузки прокси подменяет себя в глобальных именах настоящим модулем.
+    """
+
+    _lock = threading.RLock()
+
+    def __init__(self, alias, loader):
+        self._alias = alias
+        self._loader = loader
+        self._module = None
+
+    def load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = self._loader()
+                globals()[self._alias] = self._module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+def _load_numpy():
+    import numpy
+    return numpy
+
+
+def _load_pandas():
+    import pandas
+    return pandas
+
+
+np = _LazyModule('np', _load_numpy)
+pd = _LazyModule('pd', _load_pandas)
+
+
+def warm_up():
+    """Заранее импортирует pandas, numpy и движки xlsx/Parquet (GUI — в фоновом потоке).
+
+    Возвращает {модуль: секунды импорта}; отсутствующие необязательные модули пропускаются.
+    """
+    timings = {}
+    for name, module in (('numpy', np), ('pandas', pd)):
+        started = time.perf_counter()
+        if isinstance(module, _LazyModule):
+            module.load()
+        timings[name] = time.perf_counter() - started
+    started = time.perf_counter()
+    try:
+        import openpyxl  # noqa: F401
+        timings['openpyxl'] = time.perf_counter() - started
+    except ImportError:
+        pass
+    started = time.perf_counter()
+    try:
+        import pyarrow  # noqa: F401
+        timings['pyarrow'] = time.perf_counter() - started
+    except ImportError:
+        pass
+    return timings
+
+
+def _win32_client():
+    """win32com.client или None (нет pywin32); импортируется только при пересохранении через COM."""
+    try:
+        import win32com.client
+        return win32com.client
+    except ImportError:
+        return None
 
 TARGET_FIELDS = [
     'B_VERSION', 'NAME', 'FIRSTNAME', 'SECONDNAME', 'TABLENO', 'FULLCARDCODE', 'ALNAME',
@@ -56,6 +150,3190 @@ TARGET_FIELDS = [
     'BLOCKEDDATA', 'PERSON_AGREEMENT_DATE', 'EMAIL'
 ]
 
+HEX_PATTERN = re.compile(r'^[0-9A-Fa-f]{12}$')
+
+
+# Сколько байт читать для определения кодировки без разбора файла (потоковый режим)
+DETECT_LIMIT = 16 * 1024 * 1024
+# Сколько не-ASCII байт сравнивать при выборе между cp1251 и cp866
+DETECT_SAMPLE = 64 * 1024
+
+_BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+_RUSSIAN_LETTERS = frozenset('абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯ')
+_ASCII_BYTES = bytes(range(128))
+_encoding_cache = {}
+
+
+def _single_byte_cyrillic(data):
+    """cp1251 или cp866: чья расшифровка не-ASCII байт даёт больше русских букв."""
+    sample = data.translate(None, _ASCII_BYTES)[:DETECT_SAMPLE]
+    scores = {}
+    for enc in ('cp1251', 'cp866'):
+        text = sample.decode(enc, errors='replace')
+        scores[enc] = sum(map(_RUSSIAN_LETTERS.__contains__, text))
+    return 'cp866' if scores['cp866'] > scores['cp1251'] else 'cp1251'
+
+
+def decode_csv_bytes(data):
+    """Определяет кодировку по сырым байтам и декодирует их. Возвращает (кодировка, текст).
+
+    BOM (UTF-8/UTF-16) имеет приоритет; иначе UTF-8 проверяется по всему
+    буферу, при ошибке выбирается cp1251 или cp866 по частоте русских букв.
+    """
+    for bom, enc in _BOMS:
+        if data.startswith(bom):
+            return enc, data.decode(enc)
+    try:
+        return 'utf-8', data.decode('utf-8')
+    except UnicodeDecodeError:
+        enc = _single_byte_cyrillic(data)
+        return enc, data.decode(enc)
+
+
+def detect_encoding(file_path):
+    """Кодировка файла без полного разбора: проверяются первые DETECT_LIMIT байт.
+
+    Результат запоминается для пути, размера и mtime файла.
+    """
+    st = os.stat(file_path)
+    key = (os.path.abspath(file_path), st.st_size, st.st_mtime_ns)
+    enc = _encoding_cache.get(key)
+    if enc is not None:
+        return enc
+    with open(file_path, 'rb') as f:
+        data = f.read(DETECT_LIMIT)
+    for bom, bom_enc in _BOMS:
+        if data.startswith(bom):
+            enc = bom_enc
+            break
+    else:
+        try:
+            # final=False — многобайтный символ может быть обрезан на границе буфера
+            codecs.getincrementaldecoder('utf-8')().decode(data, final=len(data) < DETECT_LIMIT)
+            enc = 'utf-8'
+        except UnicodeDecodeError:
+            enc = _single_byte_cyrillic(data)
+    _encoding_cache[key] = enc
+    return enc
+
+
+# Коды причин отклонения строки (порядок = приоритет правил)
+REJECT_OK = 0
+REJECT_PLACEHOLDER = 1
+REJECT_FULLCARDCODE = 2
+REJECT_NAME_TABLENO = 3
+REJECT_NO_POST = 4
+
+# Причины, отклонённые строки которых сохраняются: код -> (имя набора/файла, лист)
+REJECT_OUTPUTS = {
+    REJECT_FULLCARDCODE: ('rejected_FULLCARDCODE', 'Отклонённые'),
+    REJECT_NAME_TABLENO: ('rejected_NAME_TABLENO', 'Отклонённые'),
+    REJECT_NO_POST: ('rejected_no_POST', 'Без должности'),
+}
+DUPLICATES_OUTPUT = ('duplicated_FULLCARDCODE', 'Дубликаты')
+REGISTRY_OUTPUT = ('registry_conflicts', 'Конфликты карт')
+REPAIRED_OUTPUT = ('repaired_FULLCARDCODE', 'Исправленные коды')
+NEAR_DUPLICATES_OUTPUT = ('near_duplicates', 'Возможные дубли')
+
+# Сводка по причинам: счётчик (result.counts или набор отклонённых) -> описание
+SUMMARY_REASONS = [
+    ('placeholders', 'Строки-шаблоны «Фамилия Имя Отчество»'),
+    ('rejected_FULLCARDCODE', 'Некорректный FULLCARDCODE'),
+    ('rejected_NAME_TABLENO', 'Нет фамилии или табельного номера'),
+    ('rejected_no_POST', 'Нет должности'),
+    ('duplicated_FULLCARDCODE', 'Повторяющийся FULLCARDCODE (все экземпляры)'),
+    ('full_duplicates', 'Дубликаты по всем полям'),
+    ('registry_conflicts', 'Карта выдана другому TABLENO в прошлых выгрузках (строки оставлены)'),
+    ('repaired_FULLCARDCODE', 'Исправленный FULLCARDCODE (строки оставлены)'),
+    ('near_duplicates', 'Возможные дубли одного человека (строки оставлены)'),
+]
+SUMMARY_SHEETS = {'departments': 'Отделы', 'organizations': 'Организации',
+                  'blocked': 'Блокировки', 'reasons': 'Причины'}
+REPORT_FORMATS = ('xlsx', 'json', 'none')
+
+
+# Столбцы с малым числом различных значений (сотни на миллионы строк) — хранятся
+# как category: коды int8/int16 вместо объекта-строки на каждую ячейку
+CATEGORY_COLUMNS = (
+    ['B_VERSION'] + [f'WDEP{i}' for i in range(2, 9)] + [f'WORG{i}' for i in range(1, 9)]
+    + ['POST', 'DOCTYPE', 'PERSONCAT', 'SITIZENSHIP', 'PASSKIND', 'PASSFORM', 'PASSTYPE',
+       'CARD_IDENTIFIER_TYPE_ID', 'CARDACC_TYPE_CARD', 'IS_BLOCKED', 'SEX', 'IS_PERSON_AGREEMENT_EXISTS']
+)
+
+
+def is_categorical(s):
+    return isinstance(s.dtype, pd.CategoricalDtype)
+
+
+def compact_frame(df):
+    """Переводит столбцы из CATEGORY_COLUMNS в category (на месте, возвращает df)."""
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns and not is_categorical(df[col]):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def concat_frames(frames):
+    """pd.concat с сохранением category: категории файлов объединяются заранее,
+    иначе pandas превратил бы столбец с разными категориями обратно в object.
+    """
+    frames = list(frames)
+    if len(frames) > 1:
+        for col in CATEGORY_COLUMNS:
+            if not all(col in df.columns and is_categorical(df[col]) for df in frames):
+                continue
+            categories = frames[0][col].cat.categories
+            for df in frames[1:]:
+                categories = categories.union(df[col].cat.categories)
+            frames = [df.assign(**{col: df[col].cat.set_categories(categories)}) for df in frames]
+    return compact_frame(pd.concat(frames, ignore_index=True))
+
+
+def _strip_categorical(s):
+    # Обрезаются только категории; совпавшие после обрезки сливаются,
+    # пропуски (код -1) попадают на добавленную в конец категорию ''
+    categories = np.append(s.cat.categories.astype(str).str.strip().to_numpy(dtype=object), '')
+    inverse, uniques = pd.factorize(categories)
+    codes = inverse[s.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, uniques), index=s.index, name=s.name)
+
+
+def strip_frame(df):
+    """Обрезает пробелы во всех строковых столбцах; новый DataFrame строится один раз."""
+    def strip(s):
+        if is_categorical(s):
+            return _strip_categorical(s)
+        if pd.api.types.is_string_dtype(s.dtype):
+            return s.fillna('').astype(str).str.strip()
+        return s
+    return pd.DataFrame({col: strip(df[col]) for col in df.columns}, index=df.index)
+
+
+def set_where(df, mask, col, values):
+    """df.loc[mask, col] = values; для category недостающие значения сначала добавляются в категории."""
+    if is_categorical(df[col]):
+        if isinstance(values, pd.Series):
+            values = values.astype(object)
+            incoming = pd.Index(values[mask].unique())
+        else:
+            incoming = pd.Index([values])
+        missing = incoming.difference(df[col].cat.categories)
+        if len(missing):
+            df[col] = df[col].cat.add_categories(missing)
+    df.loc[mask, col] = values
+
+
+ORG_COLUMNS = ['WORG1', 'WORG2', 'WORG3', 'WORG4', 'WORG5', 'WORG6', 'WORG7', 'WORG8']
+CUBE_KEYS = ['department', 'organization', 'blocked']
+
+
+def organization_column(df):
+    """Организация строки: WORG7, а без этого столбца — первое непустое из WORG1..WORG8."""
+    if 'WORG7' in df.columns:
+        return df['WORG7']
+    org = np.full(len(df), '', dtype=object)
+    for col in reversed([col for col in ORG_COLUMNS if col in df.columns]):
+        values = df[col].astype(object).fillna('').to_numpy()
+        org = np.where(values != '', values, org)
+    return pd.Series(org, index=df.index)
+
+
+def stats_cube(df):
+    """Свёртка (отдел, организация, заблокирован) -> число человек за одну группировку.
+
+    Ключи-category группируются по кодам; порядок групп — по первому появлению.
+    Результат мал (сотни строк) — свёртки пачек складываются merge_cubes.
+    """
+    keys = pd.DataFrame({
+        'department': df['WDEP8'] if 'WDEP8' in df.columns else '',
+        'organization': organization_column(df),
+        'blocked': df['IS_BLOCKED'].eq('1') if 'IS_BLOCKED' in df.columns else False,
+    }, index=df.index)
+    cube = keys.groupby(CUBE_KEYS, observed=True, sort=False, dropna=False).size().reset_index(name='people')
+    for col in ['department', 'organization']:
+        cube[col] = cube[col].astype(object).fillna('')
+    return cube
+
+
+def merge_cubes(cubes):
+    """Сумма свёрток stats_cube (потоковый режим: по одной на пачку)."""
+    if not cubes:
+        return pd.DataFrame({'department': [], 'organization': [], 'blocked': [], 'people': []})
+    return pd.concat(cubes, ignore_index=True).groupby(CUBE_KEYS, sort=False)['people'].sum().reset_index()
+
+
+def summary_tables(cube):
+    """Полные таблицы сводки из свёртки: отделы и организации по убыванию численности и итог блокировок."""
+    blocked = cube['people'].where(cube['blocked'].astype(bool), 0)
+    frame = cube.assign(blocked=blocked)
+
+    def table(key, label):
+        grouped = frame.groupby(key, sort=False)[['people', 'blocked']].sum()
+        grouped = grouped[grouped.index != ''].sort_values('people', ascending=False, kind='stable')
+        return grouped.reset_index().set_axis([label, 'Человек', 'Заблокировано'], axis=1)
+
+    total, blocked_total = int(cube['people'].sum()), int(blocked.sum())
+    return {
+        'total': total,
+        'blocked': blocked_total,
+        'blocked_percent': round(blocked_total / total * 100, 2) if total else 0.0,
+        'departments': table('department', 'Отдел'),
+        'organizations': table('organization', 'Организация'),
+    }
+
+
+def summary_to_dict(summary):
+    """Сводка для JSON: таблицы — списками записей."""
+    return {key: value.to_dict('records') if isinstance(value, pd.DataFrame) else value
+            for key, value in summary.items()}
+
+
+NAME_COLUMNS = ['NAME', 'FIRSTNAME', 'SECONDNAME']
+
+# Невидимые символы, которые попадают в значения при копировании
+_INVISIBLE = dict.fromkeys(map(ord, '\u200b\u200c\u200d\u2060\ufeff\u00ad'), None)
+_WHITESPACE = re.compile(r'\s+')
+# Кириллица, внешне совпадающая с HEX-цифрами, и латиница, совпадающая с кириллицей
+_CYRILLIC_HEX = str.maketrans('АВСЕавсе', 'ABCEABCE')
+_LATIN_HOMOGLYPHS = 'AaBCcEeHKMOoPpTXxy'
+_LATIN_TO_CYRILLIC = str.maketrans(_LATIN_HOMOGLYPHS, 'АаВСсЕеНКМОоРрТХху')
+_LATIN_LETTER = re.compile('[A-Za-z]')
+# Значения, которые нормализация заведомо не меняет, — отсеиваются одной векторной проверкой
+CANONICAL_FULLCARDCODE = '[0-9A-F]{12}'
+CANONICAL_NAME = '(?:[А-ЯЁа-яё]+(?:[ -][А-ЯЁа-яё]+)*)?'
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def normalize_fullcardcode(value):
+    """NFKC, без невидимых символов и пробелов, кириллические А/В/С/Е → латиница, верхний регистр.
+
+    Если и после этого код не 12 HEX — возвращается исходное значение без
+    крайних пробелов (строка уйдёт в rejected_FULLCARDCODE как есть).
+    """
+    repaired = _WHITESPACE.sub('', unicodedata.normalize('NFKC', value).translate(_INVISIBLE))
+    repaired = repaired.translate(_CYRILLIC_HEX).upper()
+    return repaired if HEX_PATTERN.match(repaired) else value.strip()
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def normalize_name(value):
+    """NFC, без невидимых символов, пробелы (в т.ч. неразрывные) схлопнуты; латинские буквы-двойники
+    в кириллическом ФИО заменяются кириллицей."""
+    value = _WHITESPACE.sub(' ', unicodedata.normalize('NFC', value).translate(_INVISIBLE)).strip()
+    latin = set(_LATIN_LETTER.findall(value))
+    if latin and latin.issubset(_LATIN_HOMOGLYPHS) and any(ch in _RUSSIAN_LETTERS for ch in value):
+        value = value.translate(_LATIN_TO_CYRILLIC)
+    return value
+
+
+def map_unique(s, func, canonical=None):
+    """func к каждому различному значению s (для category — к категориям), результат раскладывается по строкам.
+
+    Значения, целиком совпадающие с регулярным выражением canonical, func не
+    передаются. Возвращает (Series того же типа, маска строк, где значение
+    изменилось не только обрезкой крайних пробелов). Пропуски становятся ''.
+    """
+    if is_categorical(s):
+        uniques = s.cat.categories.astype(str).to_numpy(dtype=object)
+        codes = s.cat.codes.to_numpy()
+    else:
+        codes, uniques = pd.factorize(s.to_numpy(dtype=object))
+        uniques = np.asarray(uniques, dtype=object)
+    # Последний элемент — для пропусков (код -1)
+    mapped = np.append(uniques, '')
+    changed = np.zeros(len(mapped), dtype=bool)
+    todo = np.ones(len(uniques), dtype=bool)
+    if canonical is not None and len(uniques):
+        todo = ~pd.Series(uniques, dtype=object).str.fullmatch(canonical).to_numpy(dtype=bool)
+    if todo.any():
+        before = uniques[todo]
+        after = np.array([func(v) for v in before], dtype=object)
+        mapped[:-1][todo] = after
+        changed[:-1][todo] = after != np.array([v.strip() for v in before], dtype=object)
+    if is_categorical(s):
+        inverse, categories = pd.factorize(mapped)
+        values = pd.Categorical.from_codes(inverse[codes], categories)
+        return pd.Series(values, index=s.index, name=s.name), changed[codes]
+    return pd.Series(mapped[codes], index=s.index, name=s.name, dtype=s.dtype), changed[codes]
+
+
+def normalize_frame(df):
+    """Нормализация FULLCARDCODE и ФИО по различным значениям (до обрезки и правил).
+
+    Возвращает (DataFrame, маска строк с исправленным FULLCARDCODE, маска строк
+    с исправленным ФИО).
+    """
+    rows = len(df)
+    columns = {}
+    codes_changed = np.zeros(rows, dtype=bool)
+    names_changed = np.zeros(rows, dtype=bool)
+    if 'FULLCARDCODE' in df.columns:
+        columns['FULLCARDCODE'], codes_changed = map_unique(df['FULLCARDCODE'], normalize_fullcardcode,
+                                                            CANONICAL_FULLCARDCODE)
+    for col in NAME_COLUMNS:
+        if col in df.columns:
+            columns[col], changed = map_unique(df[col], normalize_name, CANONICAL_NAME)
+            names_changed |= changed
+    return df.assign(**columns), codes_changed, names_changed
+
+
+def evaluate_rules(df):
+    """Код причины отклонения для каждой строки за один проход (REJECT_OK — строка проходит).
+
+    Ожидает обрезанные значения. Правила проверяются в прежнем порядке, строка
+    получает код первого нарушенного. Отсутствующий столбец считается пустым.
+    Полностью пустая строка имеет пустой FULLCARDCODE и отклоняется этим правилом.
+    """
+    rows = len(df)
+
+    def empty(col):
+        if col not in df.columns:
+            return np.ones(rows, dtype=bool)
+        return (df[col] == '').to_numpy(dtype=bool)
+
+    if all(col in df.columns for col in ['NAME', 'FIRSTNAME', 'SECONDNAME']):
+        placeholder = ((df['NAME'] == 'Фамилия') & (df['FIRSTNAME'] == 'Имя')
+                       & (df['SECONDNAME'] == 'Отчество')).to_numpy(dtype=bool)
+    else:
+        placeholder = np.zeros(rows, dtype=bool)
+
+    if 'FULLCARDCODE' in df.columns:
+        bad_code = ~df['FULLCARDCODE'].str.fullmatch(HEX_PATTERN.pattern).to_numpy(dtype=bool, na_value=False)
+    else:
+        bad_code = np.ones(rows, dtype=bool)
+
+    return np.select(
+        [placeholder, bad_code, empty('NAME') | empty('TABLENO'), empty('POST')],
+        [REJECT_PLACEHOLDER, REJECT_FULLCARDCODE, REJECT_NAME_TABLENO, REJECT_NO_POST],
+        default=REJECT_OK,
+    ).astype(np.int8)
+
+
+def collect_csv_files(sources, pattern="*.csv"):
+    """Список файлов из папок (по маске pattern), масок и отдельных файлов (порядок сохраняется)."""
+    files = []
+    for src in sources:
+        if os.path.isdir(src):
+            files.extend(sorted(glob.glob(os.path.join(src, pattern))))
+        elif any(ch in src for ch in '*?['):
+            files.extend(sorted(glob.glob(src)))
+        elif os.path.isfile(src):
+            files.append(src)
+    return files
+
+
+def drop_placeholders(df):
+    """Убирает строки-заглушки «Фамилия/Имя/Отчество». Возвращает (DataFrame, удалено строк)."""
+    if not all(col in df.columns for col in ['NAME', 'FIRSTNAME', 'SECONDNAME']):
+        return df, 0
+    mask_bad = (df['NAME'] == 'Фамилия') & (df['FIRSTNAME'] == 'Имя') & (df['SECONDNAME'] == 'Отчество')
+    bad_rows = int(mask_bad.sum())
+    return (df[~mask_bad] if bad_rows else df), bad_rows
+
+
+def file_digest(file_path):
+    """Хеш содержимого файла (BLAKE2b, 128 бит)."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def default_cache_dir():
+    base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'BastionExport', 'cache')
+
+
+# Ошибки кэша, при которых обработка продолжается без него: недоступная папка, диск,
+# несериализуемый кадр (pyarrow: ArrowInvalid — ValueError, ArrowTypeError — TypeError)
+CACHE_ERRORS = (OSError, ValueError, TypeError, pickle.PickleError)
+
+
+class FileCache:
+    """Дисковый кэш прочитанных и нормализованных CSV.
+
+    Запись ищется по абсолютному пути; совпадение размера и mtime — попадание
+    без чтения файла, иначе сверяется хеш содержимого. Кадры хранятся в Feather
+    (pyarrow) или pickle, общий объём ограничен max_bytes — при превышении
+    удаляются давно не использованные записи.
+    """
+
+    INDEX = 'index.json'
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        try:
+            import pyarrow  # noqa: F401
+            self._ext = 'feather'
+        except ImportError:
+            self._ext = 'pkl'
+        self._index = self._load_index()
+        self._dirty = False
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.INDEX), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp = os.path.join(self.cache_dir, self.INDEX + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.cache_dir, self.INDEX))
+        self._dirty = False
+
+    @staticmethod
+    def _key(file_path):
+        return os.path.normcase(os.path.abspath(file_path))
+
+    def lookup(self, file_path):
+        """(DataFrame, сведения о файле) из кэша или None."""
+        key = self._key(file_path)
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(file_path)
+            if (st.st_size, st.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+                if st.st_size != entry['size'] or file_digest(file_path) != entry['digest']:
+                    return None
+                entry['mtime_ns'] = st.st_mtime_ns
+            data_path = os.path.join(self.cache_dir, entry['data'])
+            if entry['data'].endswith('.feather'):
+                df = pd.read_feather(data_path)
+            else:
+                df = pd.read_pickle(data_path)
+        except (OSError, ValueError, KeyError):
+            self._drop(key)
+            return None
+        entry['used'] = time.time()
+        self._dirty = True
+        return df, dict(entry['info'])
+
+    def store(self, file_path, df, info):
+        key = self._key(file_path)
+        self._drop(key)
+        st = os.stat(file_path)
+        digest = info.get('digest') or file_digest(file_path)
+        name = f"{hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()}.{self._ext}"
+        data_path = os.path.join(self.cache_dir, name)
+        df = df.reset_index(drop=True)
+        try:
+            if self._ext == 'feather':
+                df.to_feather(data_path)
+            else:
+                df.to_pickle(data_path)
+        except CACHE_ERRORS:
+            # Недописанный файл данных без записи в индексе иначе остался бы в папке навсегда
+            try:
+                os.remove(data_path)
+            except OSError:
+                pass
+            raise
+        self._index[key] = {
+            'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': digest,
+            'data': name, 'bytes': os.path.getsize(data_path), 'used': time.time(),
+            'info': {k: v for k, v in info.items() if k != 'digest'},
+        }
+        self._dirty = True
+        self._evict()
+
+    def _drop(self, key):
+        entry = self._index.pop(key, None)
+        if entry is not None:
+            self._dirty = True
+            try:
+                os.remove(os.path.join(self.cache_dir, entry['data']))
+            except OSError:
+                pass
+
+    def _evict(self):
+        total = sum(entry['bytes'] for entry in self._index.values())
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= entry['bytes']
+            self._drop(key)
+
+    def invalidate(self, file_paths=None):
+        """Удаляет записи для file_paths (None — весь кэш). Возвращает число удалённых."""
+        keys = list(self._index) if file_paths is None else [self._key(f) for f in file_paths]
+        removed = 0
+        for key in keys:
+            if key in self._index:
+                self._drop(key)
+                removed += 1
+        self.save()
+        return removed
+
+
+def default_registry_path():
+    return os.path.join(os.path.dirname(default_cache_dir()), 'cards.sqlite')
+
+
+class CardRegistry:
+    """Реестр выгруженных карт между запусками: FULLCARDCODE → TABLENO/NAME/файл/время запуска.
+
+    SQLite с кодом карты (48-битное целое) в INTEGER PRIMARY KEY — поиск по
+    B-дереву без отдельного индекса. Коды текущего запуска проверяются пачкой
+    через временную таблицу; новые записи копятся во временной staging и
+    переносятся в реестр одной транзакцией в commit() — только после того, как
+    итоговый файл сохранён.
+    """
+
+    BATCH = 50000
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS cards (
+                code INTEGER PRIMARY KEY, fullcardcode TEXT, tableno TEXT, name TEXT,
+                source TEXT, run TEXT);
+            CREATE TEMP TABLE staging (
+                code INTEGER PRIMARY KEY, fullcardcode TEXT, tableno TEXT, name TEXT, source TEXT);
+            CREATE TEMP TABLE probe (code INTEGER PRIMARY KEY);
+        """)
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+
+    def lookup(self, codes):
+        """Записи реестра для кодов codes (uint64): DataFrame code/fullcardcode/tableno/name/source/run."""
+        codes = np.unique(np.asarray(codes, dtype=np.uint64)).astype(np.int64)
+        self._db.execute("DELETE FROM probe")
+        for start in range(0, len(codes), self.BATCH):
+            self._db.executemany("INSERT INTO probe VALUES (?)",
+                                 ((int(code),) for code in codes[start:start + self.BATCH]))
+        found = pd.read_sql_query(
+            "SELECT c.code, c.fullcardcode, c.tableno, c.name, c.source, c.run "
+            "FROM probe p JOIN cards c ON c.code = p.code", self._db)
+        found['code'] = found['code'].astype(np.uint64)
+        return found
+
+    def conflicts(self, df, codes):
+        """Строки df, чей код уже выгружался с другим TABLENO, с прежними значениями (PREV_*)."""
+        known = self.lookup(codes)
+        if not len(known):
+            return df.iloc[0:0]
+        position = pd.Index(known['code']).get_indexer(codes)
+        hit = position >= 0
+        previous = known.iloc[position[hit]]
+        tableno = df['TABLENO'].to_numpy(dtype=object)[hit] if 'TABLENO' in df.columns else ''
+        differs = previous['tableno'].to_numpy(dtype=object) != tableno
+        rows = df[hit][differs].copy()
+        previous = previous[differs]
+        rows['PREV_TABLENO'] = previous['tableno'].to_numpy()
+        rows['PREV_NAME'] = previous['name'].to_numpy()
+        rows['PREV_SOURCE'] = previous['source'].to_numpy()
+        rows['PREV_RUN'] = previous['run'].to_numpy()
+        return rows
+
+    def stage(self, df, codes, sources):
+        """Запоминает итоговые строки запуска; в реестр они попадут при commit()."""
+        def column(name):
+            return df[name].astype(object).tolist() if name in df.columns else [''] * len(df)
+        self._db.executemany(
+            "INSERT OR REPLACE INTO staging VALUES (?, ?, ?, ?, ?)",
+            zip(np.asarray(codes, dtype=np.uint64).astype(np.int64).tolist(), column('FULLCARDCODE'),
+                column('TABLENO'), column('NAME'), list(sources)))
+
+    def commit(self, run):
+        """Переносит staging в реестр одной транзакцией. Возвращает (новых, обновлённых)."""
+        db = self._db
+        with db:
+            staged = db.execute("SELECT COUNT(*) FROM staging").fetchone()[0]
+            known = db.execute("SELECT COUNT(*) FROM staging s JOIN cards c ON c.code = s.code").fetchone()[0]
+            db.execute("INSERT OR REPLACE INTO cards SELECT code, fullcardcode, tableno, name, source, ? "
+                       "FROM staging", (run,))
+            db.execute("DELETE FROM staging")
+        return staged - known, known
+
+    def close(self):
+        self._db.close()
+
+
+_TARGET_SET = frozenset(TARGET_FIELDS)
+
+
+def _read_projected(text):
+    """Разбор CSV сразу в схему TARGET_FIELDS: неизвестные столбцы не читаются,
+    отсутствующие создаются пустыми. Возвращает (DataFrame, неизвестные столбцы).
+
+    При наличии pyarrow — многопоточный pyarrow.csv, иначе pandas с usecols.
+    """
+    header = next(csv.reader(io.StringIO(text[:text.find('\n') + 1 or len(text)]),
+                             delimiter=';', quotechar='"'), [])
+    unknown = [col for col in header if col not in _TARGET_SET]
+    if has_pyarrow():
+        from pyarrow import csv as pa_csv, string, ArrowInvalid
+        try:
+            table = pa_csv.read_csv(
+                io.BytesIO(text.encode('utf-8')),
+                parse_options=pa_csv.ParseOptions(delimiter=';', quote_char='"', newlines_in_values=True),
+                convert_options=pa_csv.ConvertOptions(
+                    column_types=dict.fromkeys(TARGET_FIELDS, string()), include_columns=TARGET_FIELDS,
+                    include_missing_columns=True, strings_can_be_null=False, quoted_strings_can_be_null=False))
+            # Отсутствующие в файле столбцы приходят как null — заполняются '' одним вызовом
+            return table.to_pandas().fillna(''), unknown
+        except ArrowInvalid:
+            # Строки с лишними/недостающими полями — разбор pandas, как без проекции
+            pass
+    df = pd.read_csv(io.StringIO(text), sep=';', quotechar='"', dtype=str, keep_default_na=False,
+                     na_filter=False, usecols=lambda col: col in _TARGET_SET)
+    return df.reindex(columns=TARGET_FIELDS, fill_value=''), unknown
+
+
+def read_csv_file(file_path, projected=False):
+    """Читает и нормализует один CSV (strip, без заглушек).
+
+    Возвращает (путь, DataFrame, сведения, ошибка), сведения — словарь
+    encoding/rows/placeholders/digest. Исключения не пробрасываются — ошибка
+    одного файла не прерывает загрузку остальных (в том числе в дочернем
+    процессе пула). projected=True — кадр сразу в схеме TARGET_FIELDS
+    (_read_projected), отброшенные столбцы — в сведениях unknown_columns.
+    """
+    try:
+        # Файл читается один раз: те же байты идут на хеш, определение кодировки и разбор
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        enc, text = decode_csv_bytes(data)
+        del data
+        info = {'encoding': enc, 'digest': digest}
+        if projected:
+            df, info['unknown_columns'] = _read_projected(text)
+            info['projected'] = True
+        else:
+            df = pd.read_csv(io.StringIO(text), sep=';', quotechar='"',
+                             dtype=str, keep_default_na=False, na_filter=False)
+        del text
+        info['rows'] = len(df)
+        df, info['placeholders'] = drop_placeholders(strip_frame(compact_frame(df)))
+        return file_path, df, info, None
+    except Exception as e:
+        return file_path, None, None, str(e)
+
+
+def resolve_workers(workers, jobs):
+    """Число процессов загрузки: 0/None — по числу ядер, не больше числа файлов."""
+    if not workers:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, jobs))
+
+
+def pool_map(func, items, workers=1):
+    """func(item) для всех items (в пуле процессов при workers > 1), результаты — в исходном порядке."""
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    try:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError):
+        # Нет поддержки процессов (ограниченная среда) — последовательно
+        for item in items:
+            yield func(item)
+        return
+    with pool:
+        for value in pool.map(func, items):
+            yield value
+
+
+def iter_read_csv_files(csv_files, workers=1, projected=False):
+    """Читает файлы (параллельно при workers > 1), отдаёт результаты в исходном порядке."""
+    return pool_map(functools.partial(read_csv_file, projected=projected), csv_files, workers)
+
+
+def null_log(msg, tag=None):
+    pass
+
+
+class LogSink:
+    """Буферизованный журнал: log(msg, tag=None) для ExportPipeline и check_export.
+
+    Файл журнала открывается один раз и сбрасывается на диск не чаще раза в
+    flush_interval секунд (и при close). Если передана очередь ui_queue, сообщения
+    кладутся в неё — GUI забирает их пачками по таймеру, а фоновый поток не
+    ждёт отрисовки. Без очереди (режим без GUI) — вывод в stdout при echo.
+    """
+
+    def __init__(self, log_file=None, echo=False, ui_queue=None, flush_interval=1.0):
+        self.log_file = log_file
+        self.echo = echo
+        self.queue = ui_queue
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._file = open(log_file, "w", encoding="utf-8") if log_file else None
+        self._flushed = time.monotonic()
+
+    def __call__(self, msg, tag=None):
+        with self._lock:
+            if self.echo:
+                print(msg)
+            if self._file is not None:
+                self._file.write(msg + "\n")
+            if time.monotonic() - self._flushed >= self.flush_interval:
+                self._flush()
+        if self.queue is not None:
+            self.queue.put((msg, tag))
+
+    def _flush(self):
+        if self.echo:
+            sys.stdout.flush()
+        if self._file is not None:
+            self._file.flush()
+        self._flushed = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@functools.lru_cache(maxsize=None)
+def _hex_tables():
+    # Таблица байт → значение HEX-цифры и веса разрядов; строятся при первом вызове (numpy загружается лениво)
+    digits = np.full(256, 255, dtype=np.uint8)
+    for i, c in enumerate(b'0123456789ABCDEF'):
+        digits[c] = i
+        digits[ord(chr(c).lower())] = i
+    return digits, np.uint64(16) ** np.arange(11, -1, -1, dtype=np.uint64)
+
+
+def fullcardcode_to_int(codes):
+    """Проверенные FULLCARDCODE (12 HEX) → 48-битные целые (uint64), без цикла по строкам."""
+    hex_digits, hex_weights = _hex_tables()
+    raw = np.asarray(codes, dtype=object).astype('S12')
+    digits = hex_digits[raw.view(np.uint8).reshape(-1, 12)].astype(np.uint64)
+    return (digits * hex_weights).sum(axis=1, dtype=np.uint64)
+
+
+def row_hashes(df):
+    """64-битный хеш каждой строки (для дедупликации без хранения самих строк)."""
+    return pd.util.hash_pandas_object(df, index=False).to_numpy(dtype=np.uint64)
+
+
+class SeenSet:
+    """Компактное множество 64-битных ключей — отсортированный numpy-массив.
+
+    8 байт на ключ вместо ~70 у set() из int; хранит состояние между пачками
+    потоковой обработки.
+    """
+
+    def __init__(self):
+        self._keys = np.empty(0, dtype=np.uint64)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def contains(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        if not len(self._keys):
+            return np.zeros(len(keys), dtype=bool)
+        pos = np.searchsorted(self._keys, keys)
+        pos[pos == len(self._keys)] = 0
+        return self._keys[pos] == keys
+
+    def update(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(keys):
+            self._keys = np.union1d(self._keys, keys)
+
+    def add_first(self, keys):
+        """Маска первых вхождений: ключа ещё не было и он первый в пачке. Добавляет их."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        mask = np.zeros(len(keys), dtype=bool)
+        mask[np.unique(keys, return_index=True)[1]] = True
+        mask &= ~self.contains(keys)
+        self.update(keys[mask])
+        return mask
+
+
+class DedupIndex:
+    """Индекс дубликатов по 64-битным ключам строк за одну сортировку.
+
+    Ключ — FULLCARDCODE как 48-битное целое (from_codes) или хеш всей строки
+    (from_rows). Отвечает на вопросы «первое вхождение», «все дубликаты» и
+    «размер группы» без повторных проходов по DataFrame; используется и при
+    нормализации, и при проверке готового файла.
+    """
+
+    def __init__(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        starts = np.flatnonzero(np.r_[len(keys) > 0, sorted_keys[1:] != sorted_keys[:-1]])
+        self.sizes = np.diff(np.r_[starts, len(keys)])      # размер каждой группы
+        self.first_rows = order[starts]                     # позиция первого вхождения группы
+        self.keys = sorted_keys[starts]
+        self.groups = np.empty(len(keys), dtype=np.int64)   # номер группы для каждой строки
+        self.groups[order] = np.repeat(np.arange(len(starts)), self.sizes)
+
+    @classmethod
+    def from_codes(cls, codes):
+        return cls(fullcardcode_to_int(codes))
+
+    @classmethod
+    def from_rows(cls, df):
+        return cls(row_hashes(df))
+
+    def __len__(self):
+        return len(self.groups)
+
+    def first(self):
+        """Маска первых вхождений (как ~duplicated(keep='first'))."""
+        mask = np.zeros(len(self.groups), dtype=bool)
+        mask[self.first_rows] = True
+        return mask
+
+    def duplicated(self):
+        """Маска всех строк, ключ которых встречается больше одного раза (keep=False)."""
+        return self.group_sizes() > 1
+
+    def group_sizes(self):
+        """Размер группы для каждой строки."""
+        return self.sizes[self.groups]
+
+    def duplicate_groups(self):
+        """(позиции первых вхождений, размеры) групп-дубликатов в порядке появления."""
+        dup = np.flatnonzero(self.sizes > 1)
+        dup = dup[np.argsort(self.first_rows[dup], kind='stable')]
+        return self.first_rows[dup], self.sizes[dup]
+
+
+# Поиск возможных дублей одного человека (разные карты, разное написание).
+# Оценка пары — взвешенная сумма совпадений полей (для ФИО — сходство строк)
+NEAR_FIELDS = ['NAME', 'FIRSTNAME', 'SECONDNAME', 'BIRTHDATE', 'TABLENO']
+NEAR_WEIGHTS = {'NAME': 0.3, 'FIRSTNAME': 0.2, 'SECONDNAME': 0.15, 'BIRTHDATE': 0.2, 'TABLENO': 0.15}
+# ФИО вместе дают 0.65 — в списке только пары, у которых совпала ещё дата рождения или TABLENO
+NEAR_THRESHOLD = 0.7
+# Блоки крупнее разбиваются следующим, более узким ключом; на последнем уровне — пропускаются
+NEAR_MAX_BLOCK = 200
+
+_NOT_LETTER = re.compile('[^А-ЯA-Z]')
+_BIRTHDATE = re.compile(r'^(\d{1,2})\.(\d{1,2})\.(\d{4})|^(\d{4})-(\d{1,2})-(\d{1,2})')
+
+
+def _match_key(value):
+    """Ключ сравнения ФИО: верхний регистр, Ё → Е, только буквы."""
+    return _NOT_LETTER.sub('', value.upper().replace('Ё', 'Е'))
+
+
+def _birth_key(value):
+    """Дата рождения как ГГГГ-ММ-ДД ('' — не распознана)."""
+    m = _BIRTHDATE.match(value.strip())
+    if not m:
+        return ''
+    day, month, year = (m.group(1), m.group(2), m.group(3)) if m.group(3) else (m.group(6), m.group(5), m.group(4))
+    return f"{year}-{int(month):02d}-{int(day):02d}"
+
+
+def _factorize_keys(df, col, func):
+    """(код строки, массив ключей) — func вызывается по разу на различное значение столбца."""
+    if col not in df.columns:
+        return np.zeros(len(df), dtype=np.intp), np.array([''], dtype=object)
+    codes, uniques = pd.factorize(df[col].astype(object).fillna('').to_numpy(dtype=object))
+    inverse, keys = pd.factorize(np.array([func(v) for v in uniques], dtype=object))
+    return inverse[codes], np.asarray(keys, dtype=object)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _similarity(a, b):
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def _pair_similarity(left, right, keys):
+    """Сходство ключей пар строк: равные — 1, иначе SequenceMatcher по каждой различной паре значений."""
+    sim = (left == right).astype(float)
+    differ = np.flatnonzero(left != right)
+    if len(differ):
+        pairs, inverse = np.unique(np.column_stack([np.minimum(left[differ], right[differ]),
+                                                    np.maximum(left[differ], right[differ])]),
+                                   axis=0, return_inverse=True)
+        values = np.array([_similarity(keys[a], keys[b]) for a, b in pairs])
+        sim[differ] = values[inverse.ravel()]
+    return sim
+
+
+def _block_ids(arrays, valid):
+    ids = pd.factorize(row_hashes(pd.DataFrame({i: a for i, a in enumerate(arrays)})))[0]
+    ids[~valid] = -1
+    return ids
+
+
+def _block_pairs(ids, max_block):
+    """Пары строк внутри блоков (одинаковый id >= 0) размером до max_block.
+
+    Возвращает (левые, правые, строки слишком крупных блоков). Пары
+    строятся векторно — отдельно для каждого встречающегося размера блока.
+    """
+    valid = np.flatnonzero(ids >= 0)
+    order = valid[np.argsort(ids[valid], kind='stable')]
+    if not len(order):
+        empty = np.array([], dtype=np.intp)
+        return empty, empty, empty
+    sorted_ids = ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    left, right = [np.array([], dtype=np.intp)], [np.array([], dtype=np.intp)]
+    for k in np.unique(sizes[(sizes >= 2) & (sizes <= max_block)]):
+        members = order[starts[sizes == k][:, None] + np.arange(k)]
+        a, b = np.triu_indices(k, 1)
+        left.append(members[:, a].ravel())
+        right.append(members[:, b].ravel())
+    return np.concatenate(left), np.concatenate(right), order[np.repeat(sizes > max_block, sizes)]
+
+
+def near_duplicate_pairs(df, threshold=NEAR_THRESHOLD, max_block=NEAR_MAX_BLOCK):
+    """Пары строк df, похожие на одного человека, без попарного сравнения всех строк.
+
+    Кандидаты берутся из блоков с общим ключом: префикс фамилии + год рождения
+    (при переполнении блока — плюс инициал имени, затем полная дата), имя +
+    отчество + дата рождения (смена фамилии), TABLENO + инициал фамилии.
+    Возвращает (левые позиции, правые позиции, оценка, строк в пропущенных блоках),
+    пары отсортированы по убыванию оценки.
+    """
+    n = len(df)
+    surname, surname_keys = _factorize_keys(df, 'NAME', _match_key)
+    first, first_keys = _factorize_keys(df, 'FIRSTNAME', _match_key)
+    second, second_keys = _factorize_keys(df, 'SECONDNAME', _match_key)
+    birth, birth_keys = _factorize_keys(df, 'BIRTHDATE', _birth_key)
+    tableno, tableno_keys = _factorize_keys(df, 'TABLENO', str.strip)
+
+    def derived(codes, keys, func):
+        return pd.factorize(np.array([func(k) for k in keys], dtype=object))[0][codes]
+
+    surname4 = derived(surname, surname_keys, lambda k: k[:4])
+    surname1 = derived(surname, surname_keys, lambda k: k[:1])
+    first1 = derived(first, first_keys, lambda k: k[:1])
+    year = derived(birth, birth_keys, lambda k: k[:4])
+    has_surname = surname_keys[surname] != ''
+    has_first = first_keys[first] != ''
+    has_birth = birth_keys[birth] != ''
+    has_tableno = tableno_keys[tableno] != ''
+
+    passes = [
+        [((surname4, year), has_surname & has_birth),
+         ((surname4, year, first1), has_surname & has_birth),
+         ((surname4, birth, first1), has_surname & has_birth)],
+        [((first, second, birth), has_first & has_birth)],
+        [((tableno, surname1), has_tableno & has_surname)],
+    ]
+    lefts, rights = [], []
+    skipped = np.zeros(n, dtype=bool)
+    for levels in passes:
+        rows = np.arange(n)
+        for arrays, valid in levels:
+            ids = np.full(n, -1, dtype=np.intp)
+            ids[rows] = _block_ids(arrays, valid)[rows]
+            left, right, rows = _block_pairs(ids, max_block)
+            lefts.append(left)
+            rights.append(right)
+        skipped[rows] = True
+
+    left, right = np.concatenate(lefts), np.concatenate(rights)
+    # Пара могла попасть в несколько проходов — оставляем одну (сортировка быстрее np.unique на миллионах пар)
+    pair_keys = np.sort(np.minimum(left, right).astype(np.int64) * n + np.maximum(left, right))
+    pair_keys = pair_keys[np.r_[True, pair_keys[1:] != pair_keys[:-1]]] if len(pair_keys) else pair_keys
+    left, right = pair_keys // n, pair_keys % n
+
+    # Верхняя граница оценки (ФИО совпадают полностью) отсекает пары ещё до сравнения строк
+    score = (NEAR_WEIGHTS['BIRTHDATE'] * ((birth[left] == birth[right]) & has_birth[left])
+             + NEAR_WEIGHTS['TABLENO'] * ((tableno[left] == tableno[right]) & has_tableno[left]))
+    keep = score + NEAR_WEIGHTS['NAME'] + NEAR_WEIGHTS['FIRSTNAME'] + NEAR_WEIGHTS['SECONDNAME'] >= threshold
+    left, right, score = left[keep], right[keep], score[keep]
+    for col, codes, keys in (('NAME', surname, surname_keys), ('FIRSTNAME', first, first_keys),
+                             ('SECONDNAME', second, second_keys)):
+        score = score + NEAR_WEIGHTS[col] * _pair_similarity(codes[left], codes[right], keys)
+    keep = score >= threshold - 1e-9
+    order = np.argsort(-score[keep], kind='stable')
+    return left[keep][order], right[keep][order], score[keep][order], int(skipped.sum())
+
+
+# Движки записи итогового xlsx
+OUTPUT_ENGINES = ('native', 'pandas', 'openpyxl', 'xlsxwriter')
+
+# Без этих опций xlsxwriter превращает строки вида "=..." в формулы, а адреса — в ссылки
+XLSXWRITER_OPTIONS = {'strings_to_numbers': False, 'strings_to_formulas': False, 'strings_to_urls': False}
+
+
+def has_xlsxwriter():
+    try:
+        import xlsxwriter  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _win_memory_counters():
+    """PROCESS_MEMORY_COUNTERS текущего процесса на Windows (None на других платформах)."""
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def peak_rss_mb():
+    """Пиковый объём памяти процесса за всё время работы, МБ (None, если платформа не поддерживается)."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux отдаёт килобайты, macOS — байты
+        return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    counters = _win_memory_counters()
+    return counters.PeakWorkingSetSize / 1024 / 1024 if counters is not None else None
+
+
+def rss_mb():
+    """Текущий объём памяти процесса (RSS), МБ; None, если платформа не поддерживается."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        pass
+    counters = _win_memory_counters()
+    return counters.WorkingSetSize / 1024 / 1024 if counters is not None else None
+
+
+def memory_mark():
+    """(текущий RSS, пик процесса) в МБ — отметка начала этапа для stage_record."""
+    return rss_mb(), peak_rss_mb()
+
+
+def traced_peak_mb():
+    """Пик памяти Python-аллокаций (МБ) с прошлого вызова, если включён tracemalloc.
+
+    Используется бенчмарком для памяти по этапам; без tracemalloc — None.
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    return peak
+
+
+def stage_record(stage, sec, rows_in=None, rows_out=None, start=None):
+    """Метрики одного этапа: время, строки на входе/выходе и память.
+
+    rss_mb — RSS на конце этапа, rss_delta_mb — его изменение за этап,
+    peak_growth_mb — на сколько этап поднял пик процесса (0 — пик был раньше),
+    peak_rss_mb — пик процесса за всё время работы. start — memory_mark() начала этапа.
+    """
+    rss, peak = memory_mark()
+
+    def delta(end, begin):
+        return round(end - begin, 1) if end is not None and begin is not None else None
+
+    start = start or (None, None)
+    return {
+        'stage': stage,
+        'sec': round(sec, 4),
+        'rows_in': rows_in,
+        'rows_out': rows_out,
+        'rss_mb': round(rss, 1) if rss is not None else None,
+        'rss_delta_mb': delta(rss, start[0]),
+        'peak_growth_mb': delta(peak, start[1]),
+        'peak_rss_mb': round(peak, 1) if peak is not None else None,
+    }
+
+
+def log_stages(log, stages):
+    """Таблица этапов в журнал: время, строки, RSS на конце этапа и прирост пика процесса."""
+    if not stages:
+        return
+    log("\n⏱ Этапы обработки:")
+    for item in stages:
+        line = f"   {item['stage']:<14} {item['sec']:>8.2f} с"
+        if item['rows_in'] is not None or item['rows_out'] is not None:
+            rows_in = '—' if item['rows_in'] is None else item['rows_in']
+            rows_out = '—' if item['rows_out'] is None else item['rows_out']
+            line += f", строк: {rows_in} → {rows_out}"
+        if item.get('rss_mb') is not None:
+            line += f", RSS: {item['rss_mb']:.0f} МБ"
+            if item.get('rss_delta_mb') is not None:
+                line += f" ({item['rss_delta_mb']:+.0f} за этап)"
+        if item['peak_rss_mb'] is not None:
+            line += f", пик процесса: {item['peak_rss_mb']:.0f} МБ"
+            if item.get('peak_growth_mb'):
+                line += f" (+{item['peak_growth_mb']:.0f} за этап)"
+        log(line)
+
+
+METRICS_NAME = "export_metrics.jsonl"
+
+
+def append_metrics(path, kind, result, log=None):
+    """Дописывает в path строку JSON с метриками прогона (kind — 'process' или 'check').
+
+    По строке на запуск — файл удобно собирать и строить тренды по ночным прогонам.
+    """
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'kind': kind}
+    record.update(result.to_dict())
+    record.pop('loaded_files', None)
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        (log or null_log)(f"⚠ Не удалось записать метрики в {path}: {e}")
+
+
+class StageClock:
+    """Замер последовательных этапов: lap('этап') записывает время с прошлой отметки."""
+
+    def __init__(self, result):
+        self.result = result
+        traced_peak_mb()
+        self._last = time.perf_counter()
+        self._mark = memory_mark()
+
+    def lap(self, stage, rows_in=None, rows_out=None):
+        now = time.perf_counter()
+        sec = now - self._last
+        self.result.timings[stage] = self.result.timings.get(stage, 0.0) + sec
+        self._last = now
+        peak = traced_peak_mb()
+        if peak is not None:
+            self.result.memory[stage] = round(peak, 1)
+        self.result.stages.append(stage_record(stage, sec, rows_in, rows_out, self._mark))
+        self._mark = memory_mark()
+
+
+class XlsxStreamWriter:
+    """Построчная запись xlsx — память не растёт с числом строк.
+
+    engine='openpyxl' — write_only книга, engine='xlsxwriter' — режим
+    constant_memory; оба пишут строки inline (без sharedStrings).
+    Книга может содержать несколько листов (add_sheet), строки дописываются
+    в любой из них; файл сохраняется один раз в close().
+    """
+
+    def __init__(self, path, sheet_name=None, columns=None, engine='openpyxl'):
+        self.path = path
+        self.engine = engine
+        self.rows = 0
+        self.sheet_rows = {}
+        self._sheets = {}
+        if engine == 'xlsxwriter':
+            import xlsxwriter
+            self._wb = xlsxwriter.Workbook(path, dict(XLSXWRITER_OPTIONS, constant_memory=True))
+        else:
+            from openpyxl import Workbook
+            self._wb = Workbook(write_only=True)
+        if sheet_name:
+            self.add_sheet(sheet_name, columns)
+
+    def add_sheet(self, sheet_name, columns):
+        if self.engine == 'xlsxwriter':
+            ws = self._wb.add_worksheet(sheet_name)
+            ws.write_row(0, 0, list(columns))
+        else:
+            ws = self._wb.create_sheet(sheet_name)
+            ws.append(list(columns))
+        self._sheets[sheet_name] = ws
+        self.sheet_rows[sheet_name] = 0
+
+    def append(self, df, sheet_name=None):
+        sheet_name = sheet_name or next(iter(self._sheets))
+        ws = self._sheets[sheet_name]
+        if self.engine == 'xlsxwriter':
+            row_no = self.sheet_rows[sheet_name] + 1
+            for i, row in enumerate(df.itertuples(index=False, name=None)):
+                ws.write_row(row_no + i, 0, row)
+        else:
+            for row in df.itertuples(index=False, name=None):
+                ws.append(row)
+        self.rows += len(df)
+        self.sheet_rows[sheet_name] += len(df)
+
+    def close(self):
+        if self.engine == 'xlsxwriter':
+            self._wb.close()
+        else:
+            self._wb.save(self.path)
+
+
+class ParquetStreamWriter:
+    """Дописываемый Parquet (pyarrow): все столбцы — строки в порядке columns.
+
+    Каждая пачка пишется отдельными группами строк, поэтому память не растёт
+    с числом строк; файл закрывается в close().
+    """
+
+    ROW_GROUP = 100000
+
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.path = path
+        self.rows = 0
+        self.schema = pa.schema([pa.field(str(col), pa.string()) for col in columns])
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def append(self, df):
+        import pyarrow as pa
+        for start in range(0, len(df), self.ROW_GROUP):
+            part = df.iloc[start:start + self.ROW_GROUP].astype(str)
+            self._writer.write_table(pa.Table.from_pandas(part, schema=self.schema, preserve_index=False))
+        self.rows += len(df)
+
+    def close(self):
+        self._writer.close()
+
+
+def read_export_frame(file_path):
+    """Итоговый файл (xlsx или Parquet) целиком, все значения — строки."""
+    if file_path.lower().endswith('.parquet'):
+        return pd.read_parquet(file_path).astype(object).fillna('')
+    return pd.read_excel(file_path, dtype=str, keep_default_na=False, na_filter=False)
+
+
+def open_xlsx_writer(path, sheet_name, columns, engine='native'):
+    """Построчный writer для выбранного движка (pandas пишет целиком — заменяется на native)."""
+    if engine in ('openpyxl', 'xlsxwriter'):
+        return XlsxStreamWriter(path, sheet_name, columns, engine=engine)
+    return NativeXlsxWriter(path, sheet_name, columns)
+
+
+def write_output(df, path, engine='native', sheet_name='Лист1'):
+    """Сохраняет итоговый DataFrame выбранным движком (см. OUTPUT_ENGINES)."""
+    if engine == 'native':
+        writer = NativeXlsxWriter(path, sheet_name, df.columns)
+        writer.append(df)
+        writer.close()
+    elif engine == 'pandas':
+        df.to_excel(path, sheet_name=sheet_name, index=False)
+    elif engine == 'openpyxl':
+        writer = XlsxStreamWriter(path, sheet_name, df.columns)
+        writer.append(df)
+        writer.close()
+    elif engine == 'xlsxwriter':
+        # Обычный режим xlsxwriter: строки в sharedStrings, как у Excel
+        import xlsxwriter
+        wb = xlsxwriter.Workbook(path, XLSXWRITER_OPTIONS)
+        ws = wb.add_worksheet(sheet_name)
+        ws.write_row(0, 0, list(df.columns))
+        for i, row in enumerate(df.itertuples(index=False, name=None), start=1):
+            ws.write_row(i, 0, row)
+        wb.close()
+    else:
+        raise ValueError(f"Неизвестный движок записи: {engine}")
+
+
+_XML_HEAD = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+_NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_NS_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_NS_PKG_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_CT_SHEET = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+# Символы, недопустимые в XML, Excel кодирует как _xHHHH_
+_XML_ILLEGAL = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def column_letter(index):
+    """0 → A, 25 → Z, 26 → AA ..."""
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _xml_text(value):
+    value = _XML_ILLEGAL.sub(lambda m: f"_x{ord(m.group()):04X}_", value)
+    return escape(value)
+
+
+class NativeXlsxWriter:
+    """xlsx в той же структуре, что сохраняет Excel, без сторонних библиотек.
+
+    Все значения — строки в общей таблице xl/sharedStrings.xml (count/uniqueCount),
+    пустые ячейки не пишутся, у строк и ячеек есть r/spans, у листа — dimension,
+    стили — минимальный набор Excel «Обычный». Заменяет пересохранение через
+    Excel COM. Строки листа копятся во временном файле, в памяти только
+    уникальные значения и XML одной пачки из BATCH_ROWS строк; архив
+    собирается в close(). Лист длиннее предела Excel не пишется — ValueError.
+    """
+
+    BATCH_ROWS = 10000
+    MAX_ROWS = 1048576           # строк на листе Excel, включая заголовок
+
+    def __init__(self, path, sheet_name=None, columns=None):
+        self.path = path
+        self.rows = 0
+        self.sheet_rows = {}
+        self._sheets = {}            # имя листа -> [временный файл, число столбцов]
+        self._last_rows = {}         # имя листа -> номер последней непустой строки (для dimension)
+        self._strings = {}           # значение -> индекс в sharedStrings
+        self._string_refs = 0
+        if sheet_name:
+            self.add_sheet(sheet_name, columns)
+
+    def add_sheet(self, sheet_name, columns):
+        columns = [str(col) for col in columns]
+        self._sheets[sheet_name] = [tempfile.TemporaryFile(), len(columns)]
+        self._last_rows[sheet_name] = 1
+        self.sheet_rows[sheet_name] = -1     # заголовок не считается строкой данных
+        self.append(pd.DataFrame([columns]), sheet_name)
+        self.rows -= 1
+
+    def append(self, df, sheet_name=None):
+        sheet_name = sheet_name or next(iter(self._sheets))
+        total = self.sheet_rows[sheet_name] + 1 + len(df)
+        if total > self.MAX_ROWS:
+            raise ValueError(f"Лист «{sheet_name}»: {total} строк больше предела Excel ({self.MAX_ROWS}) — "
+                             "сохраните итог в Parquet (--columnar --no-xlsx)")
+        for start in range(0, len(df), self.BATCH_ROWS):
+            self._append_batch(df.iloc[start:start + self.BATCH_ROWS], sheet_name)
+
+    def _append_batch(self, df, sheet_name):
+        tmp, ncols = self._sheets[sheet_name]
+        n = len(df)
+        first_row = self.sheet_rows[sheet_name] + 2
+        values = df.to_numpy(dtype=object)
+
+        # Индексы sharedStrings: factorize по пачке, затем перевод в общую нумерацию
+        codes, uniques = pd.factorize(values.ravel(order='C'))
+        mapping = np.empty(len(uniques), dtype=np.int64)
+        for i, value in enumerate(uniques):
+            value = '' if value is None else str(value)
+            index = self._strings.get(value)
+            if index is None:
+                index = self._strings[value] = len(self._strings)
+            mapping[i] = index
+        empty = (codes < 0).reshape(n, -1)
+        for i, value in enumerate(uniques):
+            if value is None or value == '':
+                empty |= (codes == i).reshape(n, -1)
+        indexes = mapping[np.where(codes < 0, 0, codes)].reshape(n, -1).astype(str).astype(object)
+        self._string_refs += int((~empty).sum())
+
+        row_numbers = np.arange(first_row, first_row + n).astype(str).astype(object)
+        cells = np.full(n, '', dtype=object)
+        for j in range(values.shape[1]):
+            cell = '<c r="' + column_letter(j) + row_numbers + '" t="s"><v>' + indexes[:, j] + '</v></c>'
+            cell[empty[:, j]] = ''
+            cells = cells + cell
+        rows = '<row r="' + row_numbers + f'" spans="1:{ncols}">' + cells + '</row>'
+        # Строки без единой ячейки Excel не пишет — номер строки просто пропускается
+        filled = ~empty.all(axis=1)
+        tmp.write(''.join(rows[filled]).encode('utf-8'))
+        if filled.any():
+            self._last_rows[sheet_name] = first_row + int(np.flatnonzero(filled)[-1])
+
+        self.rows += n
+        self.sheet_rows[sheet_name] += n
+
+    def close(self):
+        names = list(self._sheets)
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr('[Content_Types].xml', self._content_types(len(names)))
+            zf.writestr('_rels/.rels', _XML_HEAD + (
+                f'<Relationships xmlns="{_NS_PKG_REL}">'
+                f'<Relationship Id="rId3" Type="{_NS_REL}/extended-properties" Target="docProps/app.xml"/>'
+                '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties" Target="docProps/core.xml"/>'
+                f'<Relationship Id="rId1" Type="{_NS_REL}/officeDocument" Target="xl/workbook.xml"/>'
+                '</Relationships>'))
+            zf.writestr('docProps/app.xml', self._app_xml(names))
+            zf.writestr('docProps/core.xml', self._core_xml())
+            zf.writestr('xl/workbook.xml', _XML_HEAD + (
+                f'<workbook xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}">'
+                '<fileVersion appName="xl" lastEdited="7" lowestEdited="7" rupBuild="22228"/>'
+                '<workbookPr defaultThemeVersion="124226"/>'
+                '<bookViews><workbookView xWindow="240" yWindow="15" windowWidth="16095" windowHeight="9660"/></bookViews>'
+                '<sheets>'
+                + ''.join(f'<sheet name="{_xml_text(name)}" sheetId="{i}" r:id="rId{i}"/>'
+                          for i, name in enumerate(names, start=1))
+                + '</sheets><calcPr calcId="191029"/></workbook>'))
+            n = len(names)
+            zf.writestr('xl/_rels/workbook.xml.rels', _XML_HEAD + (
+                f'<Relationships xmlns="{_NS_PKG_REL}">'
+                + ''.join(f'<Relationship Id="rId{i}" Type="{_NS_REL}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+                          for i in range(1, n + 1))
+                + f'<Relationship Id="rId{n + 1}" Type="{_NS_REL}/styles" Target="styles.xml"/>'
+                + f'<Relationship Id="rId{n + 2}" Type="{_NS_REL}/sharedStrings" Target="sharedStrings.xml"/>'
+                '</Relationships>'))
+            for i, name in enumerate(names, start=1):
+                self._write_sheet(zf, i, name)
+            zf.writestr('xl/styles.xml', self._styles_xml())
+            with zf.open('xl/sharedStrings.xml', 'w') as f:
+                f.write((_XML_HEAD + f'<sst xmlns="{_NS_MAIN}" count="{self._string_refs}" '
+                         f'uniqueCount="{len(self._strings)}">').encode('utf-8'))
+                batch = []
+                for value in self._strings:
+                    space = ' xml:space="preserve"' if value != value.strip() else ''
+                    batch.append(f'<si><t{space}>{_xml_text(value)}</t></si>')
+                    if len(batch) >= 10000:
+                        f.write(''.join(batch).encode('utf-8'))
+                        batch = []
+                f.write((''.join(batch) + '</sst>').encode('utf-8'))
+
+    def _write_sheet(self, zf, number, name):
+        tmp, ncols = self._sheets[name]
+        last_row = self._last_rows[name]
+        ref = f"A1:{column_letter(max(ncols, 1) - 1)}{last_row}"
+        selected = ' tabSelected="1"' if number == 1 else ''
+        with zf.open(f'xl/worksheets/sheet{number}.xml', 'w') as f:
+            f.write((_XML_HEAD + f'<worksheet xmlns="{_NS_MAIN}" xmlns:r="{_NS_REL}">'
+                     f'<dimension ref="{ref}"/><sheetViews><sheetView{selected} workbookViewId="0"/></sheetViews>'
+                     '<sheetFormatPr defaultRowHeight="15"/><sheetData>').encode('utf-8'))
+            tmp.seek(0)
+            shutil.copyfileobj(tmp, f, 1024 * 1024)
+            f.write(b'</sheetData><pageMargins left="0.7" right="0.7" top="0.75" bottom="0.75" '
+                    b'header="0.3" footer="0.3"/></worksheet>')
+        tmp.close()
+
+    @staticmethod
+    def _content_types(sheet_count):
+        ct = 'application/vnd.openxmlformats-officedocument'
+        return _XML_HEAD + (
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            f'<Override PartName="/xl/workbook.xml" ContentType="{ct}.spreadsheetml.sheet.main+xml"/>'
+            + ''.join(f'<Override PartName="/xl/worksheets/sheet{i}.xml" ContentType="{_CT_SHEET}"/>'
+                      for i in range(1, sheet_count + 1))
+            + f'<Override PartName="/xl/styles.xml" ContentType="{ct}.spreadsheetml.styles+xml"/>'
+            f'<Override PartName="/xl/sharedStrings.xml" ContentType="{ct}.spreadsheetml.sharedStrings+xml"/>'
+            '<Override PartName="/docProps/core.xml" ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>'
+            f'<Override PartName="/docProps/app.xml" ContentType="{ct}.extended-properties+xml"/>'
+            '</Types>')
+
+    @staticmethod
+    def _app_xml(names):
+        return _XML_HEAD + (
+            '<Properties xmlns="http://schemas.openxmlformats.org/officeDocument/2006/extended-properties" '
+            'xmlns:vt="http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes">'
+            '<Application>Microsoft Excel</Application><DocSecurity>0</DocSecurity><ScaleCrop>false</ScaleCrop>'
+            '<HeadingPairs><vt:vector size="2" baseType="variant">'
+            '<vt:variant><vt:lpstr>Листы</vt:lpstr></vt:variant>'
+            f'<vt:variant><vt:i4>{len(names)}</vt:i4></vt:variant></vt:vector></HeadingPairs>'
+            f'<TitlesOfParts><vt:vector size="{len(names)}" baseType="lpstr">'
+            + ''.join(f'<vt:lpstr>{_xml_text(name)}</vt:lpstr>' for name in names)
+            + '</vt:vector></TitlesOfParts><LinksUpToDate>false</LinksUpToDate>'
+            '<SharedDoc>false</SharedDoc><HyperlinksChanged>false</HyperlinksChanged>'
+            '<AppVersion>16.0300</AppVersion></Properties>')
+
+    @staticmethod
+    def _core_xml():
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return _XML_HEAD + (
+            '<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dcterms="http://purl.org/dc/terms/" '
+            'xmlns:dcmitype="http://purl.org/dc/dcmitype/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+            f'<dcterms:created xsi:type="dcterms:W3CDTF">{now}</dcterms:created>'
+            f'<dcterms:modified xsi:type="dcterms:W3CDTF">{now}</dcterms:modified>'
+            '</cp:coreProperties>')
+
+    @staticmethod
+    def _styles_xml():
+        return _XML_HEAD + (
+            f'<styleSheet xmlns="{_NS_MAIN}">'
+            '<fonts count="1"><font><sz val="11"/><color theme="1"/><name val="Calibri"/>'
+            '<family val="2"/><charset val="204"/><scheme val="minor"/></font></fonts>'
+            '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+            '<fill><patternFill patternType="gray125"/></fill></fills>'
+            '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+            '<cellStyles count="1"><cellStyle name="Обычный" xfId="0" builtinId="0"/></cellStyles>'
+            '<dxfs count="0"/><tableStyles count="0" defaultTableStyle="TableStyleMedium2" '
+            'defaultPivotStyle="PivotStyleLight16"/></styleSheet>')
+
+
+def _xlsx_sheet_paths(zf):
+    """Имена листов книги и пути к их XML в порядке workbook.xml."""
+    ns = {'m': _NS_MAIN, 'r': _NS_REL}
+    rels = ElementTree.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    targets = {rel.get('Id'): rel.get('Target') for rel in rels}
+    workbook = ElementTree.fromstring(zf.read('xl/workbook.xml'))
+    sheets = []
+    for sheet in workbook.find('m:sheets', ns):
+        target = targets[sheet.get(f'{{{_NS_REL}}}id')].lstrip('/')
+        sheets.append((sheet.get('name'), target if target.startswith('xl/') else 'xl/' + target))
+    return sheets
+
+
+def _xlsx_shared_strings(zf):
+    if 'xl/sharedStrings.xml' not in zf.namelist():
+        return []
+    strings = []
+    with zf.open('xl/sharedStrings.xml') as f:
+        for _, elem in ElementTree.iterparse(f):
+            if elem.tag == f'{{{_NS_MAIN}}}si':
+                strings.append(''.join(t.text or '' for t in elem.iter(f'{{{_NS_MAIN}}}t')))
+                elem.clear()
+    return strings
+
+
+def _cell_column(ref):
+    index = 0
+    for ch in ref:
+        if not ch.isalpha():
+            break
+        index = index * 26 + ord(ch) - 64
+    return index - 1
+
+
+def iter_xlsx_cells(zf, sheet_path, strings):
+    """Потоковое чтение листа: (номер строки, {индекс столбца: (тип, значение)})."""
+    c_tag, row_tag = f'{{{_NS_MAIN}}}c', f'{{{_NS_MAIN}}}row'
+    v_tag, is_tag = f'{{{_NS_MAIN}}}v', f'{{{_NS_MAIN}}}is'
+    with zf.open(sheet_path) as f:
+        for _, elem in ElementTree.iterparse(f):
+            if elem.tag != row_tag:
+                continue
+            cells = {}
+            for c in elem.iter(c_tag):
+                kind = c.get('t', 'n')
+                if kind == 'inlineStr':
+                    inline = c.find(is_tag)
+                    value = ''.join(t.text or '' for t in inline.iter(f'{{{_NS_MAIN}}}t')) if inline is not None else ''
+                else:
+                    v = c.find(v_tag)
+                    value = v.text if v is not None and v.text is not None else ''
+                    if kind == 's' and value != '':
+                        value = strings[int(value)]
+                if value != '':
+                    cells[_cell_column(c.get('r', ''))] = (kind, value)
+            yield int(elem.get('r')), cells
+            elem.clear()
+
+
+def _join_rows(rows_a, rows_b):
+    """Строки двух листов по номеру r (объединение номеров, по возрастанию): (r, ячейки a, ячейки b).
+
+    Строки, которой нет на одном из листов, там считается пустой — пропуск строки
+    не сдвигает сравнение всех следующих.
+    """
+    a, b = next(rows_a, None), next(rows_b, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a[0], a[1], {}
+            a = next(rows_a, None)
+        elif a is None or b[0] < a[0]:
+            yield b[0], {}, b[1]
+            b = next(rows_b, None)
+        else:
+            yield a[0], a[1], b[1]
+            a, b = next(rows_a, None), next(rows_b, None)
+
+
+def compare_xlsx_structure(path, reference):
+    """Сравнивает структуру двух xlsx, например свой файл и пересохранённый через Excel.
+
+    Проверяются обязательные части пакета, листы и их порядок, dimension,
+    наличие sharedStrings, тип хранения строк (s/inlineStr) и значения всех
+    ячеек. Возвращает список расхождений — пустой, если файлы эквивалентны.
+    """
+    required = ['[Content_Types].xml', '_rels/.rels', 'xl/workbook.xml',
+                'xl/_rels/workbook.xml.rels', 'xl/styles.xml', 'xl/sharedStrings.xml']
+    differences = []
+    with zipfile.ZipFile(path) as za, zipfile.ZipFile(reference) as zb:
+        for part in required:
+            if (part in zb.namelist()) and part not in za.namelist():
+                differences.append(f"нет части пакета {part}")
+        sheets_a, sheets_b = _xlsx_sheet_paths(za), _xlsx_sheet_paths(zb)
+        if [name for name, _ in sheets_a] != [name for name, _ in sheets_b]:
+            differences.append(f"листы: {[n for n, _ in sheets_a]} ≠ {[n for n, _ in sheets_b]}")
+        strings_a, strings_b = _xlsx_shared_strings(za), _xlsx_shared_strings(zb)
+        for (name, sheet_a), (_, sheet_b) in zip(sheets_a, sheets_b):
+            dim_a = re.search(rb'<dimension ref="([^"]+)"', za.read(sheet_a)[:4096])
+            dim_b = re.search(rb'<dimension ref="([^"]+)"', zb.read(sheet_b)[:4096])
+            if (dim_a and dim_a.group(1)) != (dim_b and dim_b.group(1)):
+                differences.append(f"{name}: dimension {dim_a and dim_a.group(1).decode()} ≠ "
+                                   f"{dim_b and dim_b.group(1).decode()}")
+            rows_a = iter_xlsx_cells(za, sheet_a, strings_a)
+            rows_b = iter_xlsx_cells(zb, sheet_b, strings_b)
+            for row, cells_a, cells_b in _join_rows(rows_a, rows_b):
+                if cells_a != cells_b:
+                    differences.append(f"{name}: строка {row} различается")
+                    if len(differences) >= 20:
+                        differences.append("... сравнение остановлено")
+                        return differences
+    return differences
+
+
+class RejectWriter:
+    """Сохранение отклонённых строк по категориям.
+
+    Форматы: 'xlsx' — отдельный файл на категорию (как раньше), 'workbook' —
+    одна книга rejected_report.xlsx с листом на причину, 'csv' и 'parquet' —
+    файл на категорию без Excel. columnar=True дополнительно к основному
+    формату пишет каждую категорию в <категория>.parquet. Строки можно
+    добавлять частями (потоковый режим), все файлы дописываются и закрываются
+    в close().
+    """
+
+    FORMATS = ('xlsx', 'workbook', 'csv', 'parquet')
+    REPORT_NAME = 'rejected_report.xlsx'
+
+    def __init__(self, output_dir, fmt='xlsx', log=None, columnar=False):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Неизвестный формат отклонённых строк: {fmt}")
+        if fmt == 'parquet' and not has_pyarrow():
+            (log or null_log)("⚠ Модуль pyarrow не установлен — отклонённые строки сохраняются в CSV")
+            fmt = 'csv'
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.columnar = columnar and fmt != 'parquet'
+        self.counts = {}
+        self.files = {}
+        self.columnar_files = {}
+        self._writers = {}
+        self._columnar = {}
+        self._report = None
+
+    def path_for(self, name):
+        if self.fmt == 'workbook':
+            return os.path.join(self.output_dir, self.REPORT_NAME)
+        ext = 'xlsx' if self.fmt == 'xlsx' else self.fmt
+        return os.path.join(self.output_dir, f"{name}.{ext}")
+
+    def add(self, name, sheet_name, df):
+        if not len(df):
+            return self.path_for(name)
+        path = self.path_for(name)
+        if name not in self._writers:
+            self._writers[name] = self._open(name, sheet_name, path, df.columns)
+        self._write(name, sheet_name, df)
+        if self.columnar:
+            if name not in self._columnar:
+                self.columnar_files[name] = os.path.join(self.output_dir, f"{name}.parquet")
+                self._columnar[name] = ParquetStreamWriter(self.columnar_files[name], df.columns)
+            self._columnar[name].append(df)
+        self.counts[name] = self.counts.get(name, 0) + len(df)
+        self.files[name] = path
+        return path
+
+    def _open(self, name, sheet_name, path, columns):
+        if self.fmt == 'xlsx':
+            return XlsxStreamWriter(path, sheet_name, columns)
+        if self.fmt == 'workbook':
+            if self._report is None:
+                self._report = XlsxStreamWriter(path)
+            # Имена листов в книге должны быть уникальны — используем имя категории
+            self._report.add_sheet(name, columns)
+            return self._report
+        if self.fmt == 'csv':
+            with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+                f.write(';'.join(columns) + '\r\n')
+            return path
+        return ParquetStreamWriter(path, columns)
+
+    def _write(self, name, sheet_name, df):
+        writer = self._writers[name]
+        if self.fmt == 'xlsx':
+            writer.append(df)
+        elif self.fmt == 'workbook':
+            writer.append(df, name)
+        elif self.fmt == 'csv':
+            df.to_csv(writer, sep=';', mode='a', header=False, index=False,
+                      encoding='utf-8', lineterminator='\r\n')
+        else:
+            writer.append(df)
+
+    def close(self):
+        if self.fmt in ('xlsx', 'parquet'):
+            for writer in self._writers.values():
+                writer.close()
+        for writer in self._columnar.values():
+            writer.close()
+        if self._report is not None:
+            self._report.close()
+
+
+DELTA_KEYS = ['FULLCARDCODE', 'TABLENO']
+
+
+def default_snapshot_path(output_dir):
+    try:
+        import pyarrow  # noqa: F401
+        ext = 'feather'
+    except ImportError:
+        ext = 'pkl'
+    return os.path.join(output_dir, f"Бастион_Экспорт_снимок.{ext}")
+
+
+def load_snapshot(path):
+    """Снимок предыдущего запуска (итоговый кадр) или None, если его нет."""
+    if not os.path.exists(path):
+        return None
+    df = pd.read_feather(path) if path.endswith('.feather') else pd.read_pickle(path)
+    return df.reindex(columns=TARGET_FIELDS, fill_value='')
+
+
+def save_snapshot(df, path):
+    """Атомарно сохраняет снимок: запись во временный файл и замена."""
+    tmp = path + '.tmp'
+    df = df.reset_index(drop=True)
+    if path.endswith('.feather'):
+        df.to_feather(tmp)
+    else:
+        df.to_pickle(tmp)
+    os.replace(tmp, path)
+
+
+def diff_frames(previous, current, keys=DELTA_KEYS):
+    """Сравнение двух итоговых кадров по ключу keys и хешу всей строки.
+
+    Возвращает (маска новых в current, маска изменённых в current, маска
+    удалённых в previous, Series «столбец → число изменённых значений»).
+    """
+    current_keys = row_hashes(current[keys])
+    previous_keys = row_hashes(previous[keys])
+    position = pd.Index(previous_keys).get_indexer(current_keys)
+    new = position < 0
+    matched = ~new
+    changed = np.zeros(len(current), dtype=bool)
+    changed[matched] = row_hashes(current[matched]) != row_hashes(previous.iloc[position[matched]])
+    removed = ~pd.Index(previous_keys).isin(current_keys)
+
+    before = previous.iloc[position[changed]]
+    after = current[changed]
+    fields = pd.Series({col: int((before[col].astype(object).to_numpy() != after[col].astype(object).to_numpy()).sum())
+                        for col in current.columns}, dtype='int64')
+    return new, changed, removed, fields[fields > 0].sort_values(ascending=False, kind='stable')
+
+
+class ExportResult:
+    """Результат нормализации: счётчики, отклонённые наборы, тайминги."""
+
+    def __init__(self):
+        self.error = None            # 'no_files' / 'no_data' или None
+        self.output_file = None
+        self.combined = None
+        self.csv_files = []
+        self.loaded_files = []
+        self.failed_files = []
+        self.counts = {}
+        self.rejected = {}           # категория -> DataFrame (в потоковом режиме пусто)
+        self.reject_counts = {}      # категория -> число строк
+        self.reject_files = {}       # категория -> путь к файлу
+        self.removed_file = None     # режим изменений: удалённые с прошлого запуска записи
+        self.columnar_files = {}     # 'export'/'removed'/категория -> путь к .parquet
+        self.timings = {}            # этап -> секунды
+        self.memory = {}             # пиковая память процесса, МБ
+        self.stages = []             # метрики этапов по порядку (stage_record)
+        self.summary = {}            # сводка: итоги и полные таблицы (summary_tables, reasons)
+        self.summary_file = None     # файл сводки (xlsx/json)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def to_dict(self):
+        return {
+            'ok': self.ok,
+            'error': self.error,
+            'output_file': self.output_file,
+            'csv_files': len(self.csv_files),
+            'loaded_files': self.loaded_files,
+            'failed_files': self.failed_files,
+            'counts': self.counts,
+            'rejected': self.reject_counts,
+            'reject_files': self.reject_files,
+            'removed_file': self.removed_file,
+            'columnar_files': self.columnar_files,
+            'timings': {name: round(sec, 4) for name, sec in self.timings.items()},
+            'memory': self.memory,
+            'stages': self.stages,
+            'summary': summary_to_dict(self.summary),
+            'summary_file': self.summary_file,
+        }
+
+
+class ExportPipeline:
+    """Нормализация CSV «Бастион» без привязки к интерфейсу.
+
+    Используется как GUI (App), так и командной строкой. Все сообщения идут
+    через log(msg, tag=None), диалоги и статусы — забота вызывающей стороны.
+    """
+
+    def __init__(self, log=None, resave_com=False, workers=1, chunksize=None, reject_format='xlsx',
+                 output_engine='native', cache_dir=None, cache_max_mb=1024, registry_path=None,
+                 delta=False, snapshot_path=None, columnar=False, xlsx=True, projected=False, normalize=True,
+                 near_duplicates=None, report='xlsx', cache=None):
+        self.log = log or null_log
+        self.report = report
+        # Поиск возможных дублей держит ключевые столбцы всех строк — в потоковом режиме
+        # это снова память O(N), поэтому там он включается только явно
+        if near_duplicates is None:
+            near_duplicates = not chunksize
+        elif near_duplicates and chunksize:
+            self.log("⚠ Поиск возможных дублей в потоковом режиме копит ФИО, дату рождения и TABLENO "
+                     "всех строк — память растёт с числом строк")
+        self.near_duplicates = near_duplicates
+        self.normalize = normalize
+        self.projected = projected
+        if columnar and not has_pyarrow():
+            self.log("⚠ Модуль pyarrow не установлен — Parquet не сохраняется")
+            columnar = False
+        self.columnar = columnar
+        # Без xlsx результат только в Parquet (xlsx собирается из него командой to-xlsx)
+        self.xlsx = xlsx or not columnar
+        self.delta = delta
+        self.snapshot_path = snapshot_path
+        self.registry_path = registry_path
+        self._registry = None
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_mb * 1024 * 1024
+        # Готовый FileCache (служба наблюдения) — один индекс на процесс вместо двух перезаписывающих друг друга
+        self.cache = cache
+        self.resave_com = resave_com
+        self.workers = workers
+        self.chunksize = chunksize
+        self.reject_format = reject_format
+        if output_engine == 'xlsxwriter' and not has_xlsxwriter():
+            self.log("⚠ Модуль xlsxwriter не установлен — запись через openpyxl")
+            output_engine = 'openpyxl'
+        if delta and chunksize:
+            self.log("⚠ Режим изменений не поддерживается в потоковом режиме — сохраняется полный файл")
+            self.delta = False
+        if output_engine == 'pandas' and chunksize:
+            # В потоковом режиме файл дописывается пачками — нужен построчный движок
+            output_engine = 'native'
+        self.output_engine = output_engine
+
+    @contextmanager
+    def _timed(self, result, stage, rows_in=None):
+        """Замер этапа; вызывающий код может записать stage['rows_out']."""
+        traced_peak_mb()
+        record = {'rows_in': rows_in, 'rows_out': None}
+        mark = memory_mark()
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            sec = time.perf_counter() - started
+            result.timings[stage] = result.timings.get(stage, 0.0) + sec
+            peak = traced_peak_mb()
+            if peak is not None:
+                result.memory[stage] = max(result.memory.get(stage, 0.0), round(peak, 1))
+            result.stages.append(stage_record(stage, sec, record['rows_in'], record['rows_out'], mark))
+
+    def run(self, sources, output_dir=None, output_file=None):
+        """Обрабатывает папки/файлы из sources и сохраняет результат.
+
+        output_dir — куда класть итоговый и отклонённые файлы (по умолчанию
+        папка первого источника), output_file — явное имя итогового xlsx.
+        """
+        result = ExportResult()
+        started = time.perf_counter()
+        if isinstance(sources, str):
+            sources = [sources]
+        if output_dir is None:
+            first = sources[0] if sources else '.'
+            output_dir = first if os.path.isdir(first) else os.path.dirname(os.path.abspath(first))
+
+        self.log("═" * 50, 'info')
+        if len(sources) == 1 and os.path.isdir(sources[0]):
+            self.log(f"🚀 Начат экспорт из папки: {sources[0]}", 'info')
+        else:
+            self.log(f"🚀 Начат экспорт, источников: {len(sources)}", 'info')
+        self.log("═" * 50, 'info')
+
+        csv_files = collect_csv_files(sources)
+        result.csv_files = csv_files
+        if not csv_files:
+            result.error = 'no_files'
+            self.log("ОШИБКА: CSV-файлы не найдены.", 'error')
+            return result
+
+        self.log(f"Найдено {len(csv_files)} CSV-файлов. Загрузка...")
+
+        if output_file is None:
+            timestamp = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+            prefix = "Бастион_Экспорт_Изменения" if self.delta else "Бастион_Экспорт"
+            output_file = os.path.join(output_dir, f"{prefix}_{timestamp}.xlsx")
+
+        rejects = RejectWriter(output_dir, self.reject_format, log=self.log, columnar=self.columnar)
+        self._open_registry()
+
+        if self.chunksize:
+            output_file = self._run_streaming(csv_files, rejects, output_file, result)
+            if not result.loaded_files:
+                result.error = 'no_data'
+                self.log("❌ ОШИБКА: ни один файл не загружен.", 'error')
+                self._close_registry()
+                return result
+            return self._finish(output_file, None, result, started)
+
+        with self._timed(result, 'load') as stage:
+            all_dfs = self._load(csv_files, result)
+            stage['rows_out'] = sum(len(df) for df in all_dfs)
+
+        if not all_dfs:
+            result.error = 'no_data'
+            self.log("❌ ОШИБКА: ни один файл не загружен.", 'error')
+            self._close_registry()
+            return result
+        # Границы файлов в объединённом кадре — источник строки для реестра карт
+        self._file_ends = np.cumsum([len(df) for df in all_dfs])
+
+        with self._timed(result, 'concat', stage['rows_out']) as stage:
+            combined = concat_frames(all_dfs)
+            stage['rows_out'] = len(combined)
+        result.counts['initial'] = len(combined) + result.counts['placeholders']
+        self.log(f"\nВсего строк после объединения: {result.counts['initial']}")
+
+        if self.normalize:
+            with self._timed(result, 'normalize', len(combined)) as stage:
+                combined = self._normalize(combined, rejects, result)
+                stage['rows_out'] = len(combined)
+        with self._timed(result, 'validate', len(combined)) as stage:
+            combined = self._validate(combined, rejects, result)
+            stage['rows_out'] = len(combined)
+        with self._timed(result, 'dedup', len(combined)) as stage:
+            combined = self._deduplicate(combined, rejects, result)
+            stage['rows_out'] = len(combined)
+        if self._registry is not None:
+            with self._timed(result, 'registry', len(combined)):
+                self._check_registry(combined, rejects, result)
+        with self._timed(result, 'fix', len(combined)) as stage:
+            combined = self._fix_fields(combined, result)
+            stage['rows_out'] = len(combined)
+        sources = np.array([os.path.basename(f) for f in result.loaded_files], dtype=object)
+        row_sources = sources[np.searchsorted(self._file_ends, combined.index.to_numpy(), side='right')]
+        if self._registry is not None:
+            self._registry.stage(combined, fullcardcode_to_int(combined['FULLCARDCODE']), row_sources)
+        if self.near_duplicates:
+            with self._timed(result, 'near_duplicates', len(combined)) as stage:
+                stage['rows_out'] = self._find_near_duplicates(combined, row_sources, rejects, result)
+        with self._timed(result, 'stats', len(combined)) as stage:
+            self._statistics(stats_cube(combined), result)
+            stage['rows_out'] = len(combined)
+
+        self.log("\n💾 Ждем сохранение файла")
+
+        with self._timed(result, 'write_rejects') as stage:
+            self._close_rejects(rejects, result)
+            stage['rows_out'] = sum(result.reject_counts.values())
+
+        # С проекцией кадр уже в схеме TARGET_FIELDS — reindex ничего не добавляет
+        combined = combined.reindex(columns=TARGET_FIELDS, fill_value='')
+
+        if self.delta:
+            snapshot_path = self.snapshot_path or default_snapshot_path(output_dir)
+            with self._timed(result, 'delta', len(combined)) as stage:
+                output, removed = self._delta(combined, snapshot_path, result)
+                stage['rows_out'] = len(output)
+        else:
+            output = combined
+
+        with self._timed(result, 'write', len(output)) as stage:
+            output_file = self._write_frame(output, output_file, result, 'export')
+            if self.delta and len(removed):
+                result.removed_file = self._write_frame(
+                    removed, os.path.splitext(output_file)[0] + "_удалённые.xlsx", result, 'removed')
+            stage['rows_out'] = len(output)
+        self.log(f"\nФайл сохранён: {output_file}")
+        if result.removed_file:
+            self.log(f"📁 Удалённые записи сохранены в: {result.removed_file}")
+        if self.delta:
+            # Снимок обновляется только после успешной записи файла изменений
+            save_snapshot(combined, snapshot_path)
+        self._log_write_stats(result)
+        result.counts['final'] = len(combined)
+        return self._finish(output_file, combined, result, started)
+
+    def _write_frame(self, df, xlsx_path, result, name):
+        """Сохраняет кадр в xlsx и/или Parquet (тот же путь с расширением .parquet). Возвращает основной путь."""
+        path = xlsx_path
+        if self.columnar:
+            path = os.path.splitext(xlsx_path)[0] + '.parquet'
+            writer = ParquetStreamWriter(path, df.columns)
+            writer.append(df)
+            writer.close()
+            result.columnar_files[name] = path
+        if self.xlsx:
+            write_output(df, xlsx_path, self.output_engine)
+            path = xlsx_path
+        return path
+
+    def _delta(self, combined, snapshot_path, result):
+        """Новые и изменённые записи (для импорта) и удалённые — по снимку прошлого запуска."""
+        previous = load_snapshot(snapshot_path)
+        if previous is None:
+            self.log(f"\n🔁 Снимок прошлого запуска не найден ({snapshot_path}) — все записи считаются новыми")
+            previous = combined.iloc[0:0]
+        new, changed, removed, fields = diff_frames(previous, combined)
+        counts = {'delta_new': int(new.sum()), 'delta_changed': int(changed.sum()),
+                  'delta_removed': int(removed.sum()),
+                  'delta_unchanged': len(combined) - int(new.sum()) - int(changed.sum())}
+        result.counts.update(counts)
+        self.log("\n🔁 Изменения с прошлого запуска:")
+        self.log(f"   Новых: {counts['delta_new']}")
+        self.log(f"   Изменённых: {counts['delta_changed']}")
+        self.log(f"   Удалённых: {counts['delta_removed']}")
+        self.log(f"   Без изменений: {counts['delta_unchanged']}")
+        if len(fields):
+            self.log("   Изменённые поля: " + ", ".join(f"{col} ({count})" for col, count in fields.head(10).items()))
+        return combined[new | changed], previous[removed]
+
+    def _log_write_stats(self, result):
+        peak = peak_rss_mb()
+        result.memory['peak_rss_mb'] = round(peak, 1) if peak is not None else None
+        line = f"⏱ Запись ({self.output_engine}): {result.timings['write']:.2f} с"
+        if peak is not None:
+            line += f", пик памяти процесса: {peak:.0f} МБ"
+        self.log(line)
+
+    def _finish(self, output_file, combined, result, started):
+        if result.summary:
+            result.summary['reasons'] = self._reasons(result)
+        if result.summary and self.report != 'none':
+            with self._timed(result, 'summary'):
+                result.summary_file = self._write_summary(output_file, result.summary)
+            if result.summary_file:
+                self.log(f"📈 Сводка сохранена в: {result.summary_file}")
+        if result.columnar_files:
+            self.log(f"🗃 Сохранено в Parquet: {len(result.columnar_files)} файлов "
+                     f"(итог — {os.path.basename(result.columnar_files.get('export', '-'))})")
+        if self.resave_com and self.xlsx:
+            with self._timed(result, 'com_resave'):
+                self._resave_with_excel(output_file)
+        if self._registry is not None:
+            # Итоговый файл сохранён — выгруженные карты заносятся в реестр одной транзакцией
+            with self._timed(result, 'registry_commit'):
+                try:
+                    added, updated = self._registry.commit(datetime.now().isoformat(timespec='seconds'))
+                    result.counts['registry_added'] = added
+                    result.counts['registry_updated'] = updated
+                    self.log(f"🗂 Реестр карт обновлён: новых {added}, повторно выгружено {updated}")
+                except (sqlite3.Error, OSError) as e:
+                    self.log(f"❌ ОШИБКА обновления реестра карт: {e}")
+            self._close_registry()
+
+        result.output_file = output_file
+        result.combined = combined
+        result.timings['total'] = time.perf_counter() - started
+        log_stages(self.log, result.stages + [stage_record(
+            'total', result.timings['total'], result.counts.get('initial'), result.counts.get('final'))])
+        return result
+
+    def _open_registry(self):
+        self._registry = None
+        if not self.registry_path:
+            return
+        try:
+            self._registry = CardRegistry(self.registry_path)
+            self.log(f"🗂 Реестр карт: {self.registry_path} ({len(self._registry)} карт)")
+        except (sqlite3.Error, OSError) as e:
+            self.log(f"⚠ Реестр карт недоступен ({e}) — проверка по прошлым выгрузкам пропущена")
+
+    def _close_registry(self):
+        if self._registry is not None:
+            self._registry.close()
+            self._registry = None
+
+    def _find_near_duplicates(self, df, sources, rejects, result):
+        """Возможные дубли одного человека — список пар на проверку (строки остаются). Возвращает число пар."""
+        left, right, score, skipped = near_duplicate_pairs(df)
+        result.counts['near_duplicate_pairs'] = len(left)
+        if len(left):
+            rows = np.column_stack([left, right]).ravel()
+            review = df.iloc[rows].reset_index(drop=True)
+            review.insert(0, 'PAIR', np.repeat(np.arange(1, len(left) + 1), 2))
+            review.insert(1, 'SCORE', np.repeat(np.round(score, 2), 2).astype(str))
+            review.insert(2, 'SOURCE', sources[rows])
+            review_file = self._save_rejected(review, rejects, result, *NEAR_DUPLICATES_OUTPUT)
+            self.log(f"👥 Возможные дубли (один человек с разными картами или написанием): {len(left)} пар")
+            self.log(f"📁 Список на проверку сохранён в: {review_file}")
+        else:
+            self.log("✅ Возможных дублей по ФИО/дате рождения/TABLENO нет")
+        if skipped:
+            self.log(f"⚠ Не проверено на возможные дубли (слишком крупные блоки): {skipped} строк")
+        return len(left)
+
+    def _check_registry(self, df, rejects, result):
+        """Карты, уже выгруженные раньше на другой TABLENO, — в отдельный список (строки остаются)."""
+        conflicts = self._registry.conflicts(df, fullcardcode_to_int(df['FULLCARDCODE']))
+        result.counts['registry_conflicts'] = result.counts.get('registry_conflicts', 0) + len(conflicts)
+        if len(conflicts):
+            conflicts_file = self._save_rejected(conflicts, rejects, result, *REGISTRY_OUTPUT)
+            if not self.chunksize:
+                self.log(f"⚠️ КОНФЛИКТЫ С ПРОШЛЫМИ ВЫГРУЗКАМИ: {len(conflicts)} карт уже выданы другим TABLENO")
+                self.log(f"📁 Список сохранён в: {conflicts_file}")
+        elif not self.chunksize:
+            self.log("✅ Конфликтов с прошлыми выгрузками нет")
+
+    def _cache_failed(self, error):
+        self.log(f"⚠ Кэш недоступен ({error}) — файлы читаются без кэша")
+
+    def _load(self, csv_files, result):
+        # Кэш только ускоряет загрузку: любая его ошибка — предупреждение и обычный разбор
+        cache = self.cache
+        if cache is None and self.cache_dir:
+            try:
+                cache = FileCache(self.cache_dir, self.cache_max_bytes)
+            except CACHE_ERRORS as e:
+                self._cache_failed(e)
+        loaded = [None] * len(csv_files)
+        pending = []
+        for i, f in enumerate(csv_files):
+            hit = None
+            if cache:
+                try:
+                    hit = cache.lookup(f)
+                except CACHE_ERRORS as e:
+                    self._cache_failed(e)
+                    cache = None
+            # Кадр в кэше должен быть прочитан в том же режиме (с проекцией на TARGET_FIELDS или без)
+            if hit is not None and hit[1].get('projected', False) == self.projected:
+                loaded[i] = (f, hit[0], dict(hit[1], cached=True), None)
+            else:
+                pending.append(i)
+        if cache and len(pending) < len(csv_files):
+            self.log(f"Из кэша: {len(csv_files) - len(pending)} файлов, читаются заново: {len(pending)}")
+
+        workers = resolve_workers(self.workers, len(pending))
+        if workers > 1:
+            self.log(f"Параллельная загрузка: {workers} процессов")
+        for i, item in zip(pending, iter_read_csv_files([csv_files[i] for i in pending], workers, self.projected)):
+            loaded[i] = item
+            f, df, info, error = item
+            if cache and error is None:
+                try:
+                    cache.store(f, df, info)
+                except CACHE_ERRORS as e:
+                    self._cache_failed(e)
+                    cache = None
+        if cache:
+            try:
+                cache.save()
+            except CACHE_ERRORS as e:
+                self._cache_failed(e)
+
+        all_dfs = []
+        placeholders = 0
+        unknown_columns = set()
+        # Результаты идут в порядке csv_files — drop_duplicates(keep='first')
+        # ведёт себя так же, как при последовательном чтении
+        for f, df, info, error in loaded:
+            if error is None:
+                all_dfs.append(df)
+                placeholders += info['placeholders']
+                result.loaded_files.append(f)
+                source = ", из кэша" if info.get('cached') else ""
+                self.log(f" + {os.path.basename(f)} — {info['rows']} строк (кодировка: {info['encoding']}{source})")
+                if info.get('unknown_columns'):
+                    unknown_columns.update(info['unknown_columns'])
+                    self.log(f"   ⚠ Отброшены столбцы вне TARGET_FIELDS: {', '.join(info['unknown_columns'])}")
+            else:
+                result.failed_files.append(f)
+                self.log(f" ОШИБКА при чтении {f}: {error}")
+        result.counts['placeholders'] = placeholders
+        if self.projected:
+            result.counts['unknown_columns'] = len(unknown_columns)
+        return all_dfs
+
+    def _save_rejected(self, df, rejects, result, name, sheet_name):
+        """Передаёт отклонённые строки в RejectWriter; файлы пишутся в конце, в _close_rejects.
+
+        В потоковом режиме сюда приходят пачки — кадры в result.rejected не хранятся, только счётчики.
+        """
+        if not self.chunksize:
+            result.rejected[name] = df
+        return rejects.add(name, sheet_name, df)
+
+    def _close_rejects(self, rejects, result):
+        rejects.close()
+        result.reject_counts.update(rejects.counts)
+        result.reject_files.update(rejects.files)
+        result.columnar_files.update(rejects.columnar_files)
+
+    def _normalize(self, df, rejects, result):
+        """Исправление FULLCARDCODE и ФИО до проверки правил; строки с исправленным кодом — в отдельный список."""
+        normalized, codes_changed, names_changed = normalize_frame(df)
+        if codes_changed.any():
+            original = df.loc[codes_changed, 'FULLCARDCODE'].astype(object).fillna('')
+            repaired = normalized[codes_changed]
+            repaired.insert(repaired.columns.get_loc('FULLCARDCODE') + 1, 'FULLCARDCODE_ORIGINAL', original.to_numpy())
+            result.reject_files[REPAIRED_OUTPUT[0]] = self._save_rejected(repaired, rejects, result, *REPAIRED_OUTPUT)
+            # Из исправленных — те, что раньше ушли бы в rejected_FULLCARDCODE
+            recovered = int((~original.str.strip().str.fullmatch(HEX_PATTERN.pattern)).sum())
+            result.counts['fullcardcode_recovered'] = result.counts.get('fullcardcode_recovered', 0) + recovered
+        for key, mask in (('fullcardcode_repaired', codes_changed), ('names_repaired', names_changed)):
+            result.counts[key] = result.counts.get(key, 0) + int(mask.sum())
+        if not self.chunksize:
+            self._log_normalized(result)
+        return normalized
+
+    def _log_normalized(self, result):
+        repaired = result.counts.get('fullcardcode_repaired', 0)
+        if repaired:
+            self.log(f"🔧 Исправлено FULLCARDCODE (кириллица, невидимые символы, пробелы, регистр): {repaired}, "
+                     f"из них иначе были бы отклонены: {result.counts.get('fullcardcode_recovered', 0)}")
+            self.log(f"📁 Список исправленных сохранён в: {result.reject_files[REPAIRED_OUTPUT[0]]}")
+        names = result.counts.get('names_repaired', 0)
+        if names:
+            self.log(f"🔧 Исправлено ФИО (латинские буквы-двойники, невидимые символы, пробелы): {names} строк")
+
+    def _validate(self, combined, rejects, result):
+        # Обрезка пробелов и все правила — за один проход, затем разбор отклонённых
+        combined = strip_frame(combined)
+        if not all(col in combined.columns for col in ['NAME', 'FIRSTNAME', 'SECONDNAME']):
+            self.log("\n⚠️ Пропущено удаление заглушек: отсутствуют столбцы NAME/FIRSTNAME/SECONDNAME")
+
+        reasons = evaluate_rules(combined)
+
+        # Основная часть заглушек убрана ещё при чтении файлов (read_csv_file)
+        bad_rows = result.counts.get('placeholders', 0) + int((reasons == REJECT_PLACEHOLDER).sum())
+        result.counts['placeholders'] = bad_rows
+        self.log(f"\nУдалено полей с русскими названиями: {bad_rows}")
+        self.log("✅ Удалены начальные и конечные пробелы из всех строковых полей")
+
+        if 'FULLCARDCODE' not in combined.columns:
+            self.log("❌ ОШИБКА: отсутствует поле FULLCARDCODE — все строки отклонены")
+            return combined.iloc[0:0]
+
+        for code, (name, sheet_name) in REJECT_OUTPUTS.items():
+            mask = reasons == code
+            rejected_count = int(mask.sum())
+            if code == REJECT_FULLCARDCODE:
+                if rejected_count > 0:
+                    rejected_df = combined[mask]
+                    rejected_file = self._save_rejected(rejected_df, rejects, result, name, sheet_name)
+                    self.log(f"⚠️ УДАЛЕНО строк с битым FULLCARDCODE: {rejected_count}")
+                    self.log(f"📁 Полный список сохранён в: {rejected_file}")
+                    empty_rows = int(rejected_df.eq('').all(axis=1).sum())
+                else:
+                    empty_rows = 0
+                    self.log("✅ FULLCARDCODE: все значения корректны")
+                result.counts['empty'] = empty_rows
+                self.log(f"Удалено пустых строк: {empty_rows}")
+            elif code == REJECT_NAME_TABLENO:
+                missing_required_cols = [col for col in ['NAME', 'TABLENO'] if col not in combined.columns]
+                if rejected_count > 0:
+                    rejected_file = self._save_rejected(combined[mask], rejects, result, name, sheet_name)
+                    if missing_required_cols:
+                        self.log(f"⚠️ ОТСУТСТВУЮТ обязательные столбцы: {', '.join(missing_required_cols)}")
+                        self.log(f"⚠️ УДАЛЕНО строк без возможности проверки NAME/TABLENO: {rejected_count}")
+                    else:
+                        self.log(f"⚠️ УДАЛЕНО строк без NAME/TABLENO: {rejected_count}")
+                    self.log(f"📁 Полный список сохранён в: {rejected_file}")
+                elif not missing_required_cols:
+                    self.log("✅ Все строки содержат NAME и TABLENO")
+            elif code == REJECT_NO_POST:
+                if rejected_count > 0:
+                    rejected_post_file = self._save_rejected(combined[mask], rejects, result, name, sheet_name)
+                    if 'POST' in combined.columns:
+                        self.log(f"⚠️ УДАЛЕНО строк без должности (POST): {rejected_count}")
+                    else:
+                        self.log(f"⚠️ СТОЛБЕЦ POST ОТСУТСТВУЕТ — все {rejected_count} строк отклонены")
+                    self.log(f"📁 Список сохранён в: {rejected_post_file}")
+                elif 'POST' in combined.columns:
+                    self.log("✅ Все строки содержат должность (POST)")
+                else:
+                    self.log("✅ Нет данных для обработки (POST отсутствует, но и строк нет)")
+
+        return combined[reasons == REJECT_OK]
+
+    def _deduplicate(self, combined, rejects, result):
+        # Проверка дубликатов по FULLCARDCODE
+        if 'FULLCARDCODE' in combined.columns:
+            # Коды уже проверены (_validate) — индекс по 48-битным целым
+            index = DedupIndex.from_codes(combined['FULLCARDCODE'])
+            duplicated_mask = index.duplicated()
+            duplicated_count = int(duplicated_mask.sum())
+
+            if duplicated_count > 0:
+                duplicated_df = combined[duplicated_mask].copy()
+                duplicated_file = self._save_rejected(duplicated_df, rejects, result, *DUPLICATES_OUTPUT)
+
+                self.log(f"⚠️ НАЙДЕНО дубликатов по FULLCARDCODE: {duplicated_count} строк")
+                self.log(f"⚠️ Уникальных дублирующихся кодов: {len(index.duplicate_groups()[0])}")
+                self.log(f"📁 Дубликаты сохранены в: {duplicated_file}")
+
+                # Удаляем дубликаты, оставляя первый экземпляр
+                combined = combined[index.first()]
+                self.log(f"✅ После удаления дубликатов: {len(combined)} строк")
+            else:
+                self.log("✅ Нет дубликатов по FULLCARDCODE")
+
+        # Дубликаты по всем полям (после удаления дубликатов по FULLCARDCODE)
+        before_dupes = len(combined)
+        combined = combined[DedupIndex.from_rows(combined).first()]
+        result.counts['full_duplicates'] = before_dupes - len(combined)
+        self.log(f"Удалено дубликатов по всем полям: {before_dupes - len(combined)}")
+        return combined
+
+    def _fix_fields(self, combined, result):
+        # WORG6 → WORG7
+        if all(col in combined.columns for col in ['WORG6','WORG7','WORG8']):
+            mask_fix = (combined['WORG7'].str.strip() == '') & (combined['WORG8'].str.strip() == '') & (combined['WORG6'].str.strip() != '')
+            fixed = mask_fix.sum()
+            if fixed:
+                set_where(combined, mask_fix, 'WORG7', combined['WORG6'])
+                result.counts['worg7_fixed'] = int(fixed)
+                self.log(f"Перенос названия организации из WORG6 → WORG7: {fixed}")
+
+        # WDEP8
+        if 'WDEP8' not in combined.columns:
+            combined['WDEP8'] = 'Нет данных'
+        else:
+            mask_empty = combined['WDEP8'].str.strip() == ''
+            set_where(combined, mask_empty, 'WDEP8', 'Нет данных')
+            result.counts['wdep8_filled'] = int(mask_empty.sum())
+            self.log(f"Заполнено пустых *Подразделений*: {mask_empty.sum()}")
+        return combined
+
+    def _statistics(self, cube, result):
+        """Статистика по отделам, организациям и блокировкам из свёртки stats_cube; полные таблицы — в result.summary."""
+        summary = summary_tables(cube)
+        result.summary = summary
+        departments, organizations = summary['departments'], summary['organizations']
+
+        self.log("\n📊 Статистика по отделам (топ-10):")
+        for i, (dep, count) in enumerate(departments.iloc[:10, :2].itertuples(index=False)):
+            self.log(f"   {i+1}. {dep}: {count} человек")
+        if len(departments) > 10:
+            self.log(f"   ... и ещё {len(departments) - 10} отделов")
+
+        self.log("\n🏢 Статистика по организациям (топ-10):")
+        for i, (org, count) in enumerate(organizations.iloc[:10, :2].itertuples(index=False)):
+            self.log(f"   {i+1}. {org}: {count} человек")
+        if len(organizations) > 10:
+            self.log(f"   ... и ещё {len(organizations) - 10} организаций")
+
+        self.log(f"\n🔒 Статистика по заблокированным пропускам: {summary['blocked']} из {summary['total']} "
+                 f"({summary['blocked_percent']:.2f}%)")
+
+    def _reasons(self, result):
+        """Таблица причин: сколько строк отклонено или отмечено каждым правилом."""
+        rows = []
+        for key, label in SUMMARY_REASONS:
+            count = result.reject_counts.get(key, result.counts.get(key, 0))
+            if count:
+                rows.append((label, key, int(count), os.path.basename(result.reject_files.get(key, ''))))
+        return pd.DataFrame(rows, columns=['Причина', 'Набор', 'Строк', 'Файл'])
+
+    def _write_summary(self, output_file, summary):
+        """Сводка рядом с итоговым файлом: Бастион_Сводка_<время>.xlsx (лист на таблицу) или .json."""
+        name = os.path.splitext(os.path.basename(output_file))[0]
+        if name.startswith("Бастион_Экспорт"):
+            name = "Бастион_Сводка" + name[len("Бастион_Экспорт"):]
+        else:
+            name += "_сводка"
+        path = os.path.join(os.path.dirname(os.path.abspath(output_file)), f"{name}.{self.report}")
+        try:
+            if self.report == 'json':
+                _write_json(path, summary_to_dict(summary))
+                return path
+            blocked = pd.DataFrame({'Показатель': ['Всего человек', 'Заблокировано', 'Доля заблокированных, %'],
+                                    'Значение': [summary['total'], summary['blocked'], summary['blocked_percent']]})
+            tables = dict(summary, blocked=blocked)
+            writer = XlsxStreamWriter(path)
+            for key, sheet_name in SUMMARY_SHEETS.items():
+                writer.add_sheet(sheet_name, tables[key].columns)
+                writer.append(tables[key], sheet_name)
+            writer.close()
+            return path
+        except Exception as e:
+            self.log(f"⚠ Не удалось сохранить сводку: {e}")
+            return None
+
+    # --- Потоковый режим ----------------------------------------------------
+
+    def _iter_chunks(self, csv_files, result, usecols=None, log_files=False, failed=None, skip=None):
+        """Пачки по self.chunksize строк из всех файлов, выровненные по TARGET_FIELDS.
+
+        failed — словарь, куда записываются файлы с ошибкой чтения (путь -> сообщение);
+        skip — такие файлы из первого прохода: не читаются и отмечаются как незагруженные.
+        """
+        columns = usecols or TARGET_FIELDS
+        for f in csv_files:
+            if skip and f in skip:
+                if log_files:
+                    result.failed_files.append(f)
+                    self.log(f" ОШИБКА при чтении {f}: {skip[f]}")
+                continue
+            try:
+                enc = detect_encoding(f)
+                reader = pd.read_csv(f, sep=';', quotechar='"', encoding=enc, dtype=str,
+                                     keep_default_na=False, na_filter=False,
+                                     chunksize=self.chunksize,
+                                     usecols=(lambda c: c in columns) if usecols else None)
+                rows = 0
+                for chunk in reader:
+                    rows += len(chunk)
+                    self._chunk_source = os.path.basename(f)
+                    yield chunk.reindex(columns=columns, fill_value='')
+                if log_files:
+                    result.loaded_files.append(f)
+                    self.log(f" + {os.path.basename(f)} — {rows} строк (кодировка: {enc})")
+            except Exception as e:
+                if failed is not None:
+                    failed[f] = str(e)
+                if log_files:
+                    result.failed_files.append(f)
+                    self.log(f" ОШИБКА при чтении {f}: {str(e)}")
+
+    def _find_duplicate_codes(self, csv_files, result):
+        """Первый проход: коды, которые после отбора встречаются более одного раза.
+
+        Проход читает каждый файл целиком, поэтому заодно проверяет его: коды файла
+        учитываются только после успешного чтения до конца. Возвращает (коды,
+        {файл: ошибка}, прочитано строк) — файлы с ошибкой второй проход пропускает,
+        как пакетный режим, и в итог не попадает ни одна их строка.
+        """
+        key_cols = ['NAME', 'FIRSTNAME', 'SECONDNAME', 'TABLENO', 'FULLCARDCODE', 'POST']
+        seen, duplicated = SeenSet(), SeenSet()
+        failed = {}
+        scanned = 0
+        for f in csv_files:
+            file_codes = []
+            for chunk in self._iter_chunks([f], result, usecols=key_cols, failed=failed):
+                scanned += len(chunk)
+                if self.normalize:
+                    chunk = normalize_frame(chunk)[0]
+                chunk = strip_frame(chunk)
+                file_codes.append(fullcardcode_to_int(chunk.loc[evaluate_rules(chunk) == REJECT_OK, 'FULLCARDCODE']))
+            if f in failed or not file_codes:
+                continue
+            codes = np.concatenate(file_codes)
+            first = seen.add_first(codes)
+            duplicated.update(codes[~first])
+        return duplicated, failed, scanned
+
+    def _run_streaming(self, csv_files, rejects, output_file, result):
+        """Обработка пачками: память ограничена размером пачки и множествами ключей."""
+        self.log(f"Потоковый режим: пачки по {self.chunksize} строк")
+
+        with self._timed(result, 'dedup_scan') as stage:
+            duplicated_codes, failed, stage['rows_in'] = self._find_duplicate_codes(csv_files, result)
+            stage['rows_out'] = len(duplicated_codes)
+
+        outputs = list(REJECT_OUTPUTS.values()) + [DUPLICATES_OUTPUT]
+        writers = []
+        if self.xlsx:
+            writers.append(open_xlsx_writer(output_file, 'Лист1', TARGET_FIELDS, self.output_engine))
+        if self.columnar:
+            result.columnar_files['export'] = os.path.splitext(output_file)[0] + '.parquet'
+            writers.append(ParquetStreamWriter(result.columnar_files['export'], TARGET_FIELDS))
+            if not self.xlsx:
+                output_file = result.columnar_files['export']
+        seen_codes, seen_rows = SeenSet(), SeenSet()
+        counts = dict.fromkeys(['initial', 'placeholders', 'empty', 'full_duplicates',
+                                'worg7_fixed', 'wdep8_filled', 'final'], 0)
+        cubes = []
+        # Для поиска возможных дублей копятся только ключевые столбцы всех пачек
+        near_keys, near_sources = [], []
+
+        with self._timed(result, 'process') as stage:
+            for chunk in self._iter_chunks(csv_files, result, log_files=True, skip=failed):
+                counts['initial'] += len(chunk)
+                if self.normalize:
+                    chunk = self._normalize(chunk, rejects, result)
+                chunk = strip_frame(chunk)
+                reasons = evaluate_rules(chunk)
+
+                counts['placeholders'] += int((reasons == REJECT_PLACEHOLDER).sum())
+                for code, (name, sheet_name) in REJECT_OUTPUTS.items():
+                    rejected = chunk[reasons == code]
+                    if code == REJECT_FULLCARDCODE:
+                        counts['empty'] += int(rejected.eq('').all(axis=1).sum())
+                    rejects.add(name, sheet_name, rejected)
+                chunk = chunk[reasons == REJECT_OK]
+
+                codes = fullcardcode_to_int(chunk['FULLCARDCODE'])
+                rejects.add(*DUPLICATES_OUTPUT, chunk[duplicated_codes.contains(codes)])
+                chunk = chunk[seen_codes.add_first(codes)]
+                first_rows = seen_rows.add_first(row_hashes(chunk))
+                counts['full_duplicates'] += int((~first_rows).sum())
+                chunk = chunk[first_rows].copy()
+                if self._registry is not None:
+                    self._check_registry(chunk, rejects, result)
+                    self._registry.stage(chunk, fullcardcode_to_int(chunk['FULLCARDCODE']),
+                                         np.full(len(chunk), self._chunk_source, dtype=object))
+
+                mask_fix = (chunk['WORG7'] == '') & (chunk['WORG8'] == '') & (chunk['WORG6'] != '')
+                chunk.loc[mask_fix, 'WORG7'] = chunk.loc[mask_fix, 'WORG6']
+                counts['worg7_fixed'] += int(mask_fix.sum())
+                mask_empty = chunk['WDEP8'] == ''
+                chunk.loc[mask_empty, 'WDEP8'] = 'Нет данных'
+                counts['wdep8_filled'] += int(mask_empty.sum())
+
+                cubes.append(stats_cube(chunk))
+
+                for output in writers:
+                    output.append(chunk)
+                if self.near_duplicates:
+                    near_keys.append(chunk[['FULLCARDCODE'] + NEAR_FIELDS].astype(object))
+                    near_sources.append(np.full(len(chunk), self._chunk_source, dtype=object))
+                counts['final'] += len(chunk)
+            stage['rows_in'], stage['rows_out'] = counts['initial'], counts['final']
+
+        if near_keys:
+            with self._timed(result, 'near_duplicates', counts['final']) as stage:
+                stage['rows_out'] = self._find_near_duplicates(
+                    pd.concat(near_keys, ignore_index=True), np.concatenate(near_sources), rejects, result)
+            del near_keys, near_sources
+
+        with self._timed(result, 'write', counts['final']) as stage:
+            self._close_rejects(rejects, result)
+            for output in writers:
+                output.close()
+            stage['rows_out'] = counts['final']
+
+        result.counts.update(counts)
+        self.log(f"\nВсего строк после объединения: {counts['initial']}")
+        self.log(f"Удалено полей с русскими названиями: {counts['placeholders']}")
+        self.log(f"Удалено пустых строк: {counts['empty']}")
+        self._log_normalized(result)
+        for name, _ in outputs:
+            if name in result.reject_counts:
+                self.log(f"⚠️ {name}: {result.reject_counts[name]} строк")
+                self.log(f"📁 Список сохранён в: {result.reject_files[name]}")
+        self.log(f"Уникальных дублирующихся кодов: {len(duplicated_codes)}")
+        self.log(f"Удалено дубликатов по всем полям: {counts['full_duplicates']}")
+        self.log(f"Перенос названия организации из WORG6 → WORG7: {counts['worg7_fixed']}")
+        self.log(f"Заполнено пустых *Подразделений*: {counts['wdep8_filled']}")
+        if self._registry is not None:
+            conflicts = result.counts.get('registry_conflicts', 0)
+            if conflicts:
+                self.log(f"⚠️ КОНФЛИКТЫ С ПРОШЛЫМИ ВЫГРУЗКАМИ: {conflicts} карт уже выданы другим TABLENO")
+                self.log(f"📁 Список сохранён в: {result.reject_files[REGISTRY_OUTPUT[0]]}")
+            else:
+                self.log("✅ Конфликтов с прошлыми выгрузками нет")
+        with self._timed(result, 'stats', counts['final']) as stage:
+            self._statistics(merge_cubes(cubes), result)
+            stage['rows_out'] = counts['final']
+        self.log(f"\nФайл сохранён: {output_file}")
+        self._log_write_stats(result)
+        return output_file
+
+    def _resave_with_excel(self, output_file):
+        # Пересохраняем через Excel COM
+        win32 = _win32_client()
+        if win32 is not None:
+            excel = None
+            wb = None
+            try:
+                excel = win32.Dispatch("Excel.Application")
+                excel.Visible = False
+                wb = excel.Workbooks.Open(output_file)
+                wb.Save()
+                self.log("✅ Файл пересохранён через Excel (структура выровнена)")
+            except Exception as e:
+                self.log(f"⚠ Не удалось пересохранить через Excel: {str(e)}")
+            finally:
+                try:
+                    if wb is not None:
+                        wb.Close(SaveChanges=True)
+                finally:
+                    if excel is not None:
+                        excel.Quit()
+        else:
+            self.log("⚠ Модуль win32com не установлен — пересохранение пропущено")
+
+
+class CheckResult:
+    """Результат проверки готового xlsx: найденные проблемы по категориям."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.error = None
+        self.rows = 0
+        self.columns = 0
+        self.issues = {}             # категория -> количество
+        self.stopped = False         # проверка прервана (fail_fast или stop)
+        self.timings = {}
+        self.memory = {}
+        self.stages = []
+
+    @property
+    def ok(self):
+        return self.error is None and not self.issues and not self.stopped
+
+    def to_dict(self):
+        return {
+            'file': self.file_path,
+            'ok': self.ok,
+            'error': self.error,
+            'rows': self.rows,
+            'columns': self.columns,
+            'issues': self.issues,
+            'stopped': self.stopped,
+            'timings': {name: round(sec, 4) for name, sec in self.timings.items()},
+            'memory': self.memory,
+            'stages': self.stages,
+        }
+
+
+CHECK_CHUNK_ROWS = 50000
+
+
+def _check_header(columns, issues, log):
+    """Этап 1: наличие и порядок столбцов по строке заголовка."""
+    missing_columns = [field for field in TARGET_FIELDS if field not in columns]
+    extra_columns = [col for col in columns if col not in TARGET_FIELDS]
+
+    if missing_columns:
+        issues['missing_columns'] = len(missing_columns)
+        log(f"❌ ОТСУТСТВУЮЩИЕ СТОЛБЦЫ ({len(missing_columns)}):")
+        for col in missing_columns:
+            log(f"  - {col}")
+
+    if extra_columns:
+        issues['extra_columns'] = len(extra_columns)
+        log(f"❌ ЛИШНИЕ СТОЛБЦЫ ({len(extra_columns)}):")
+        for col in extra_columns:
+            log(f"  - {col}")
+
+    # Проверка порядка столбцов
+    actual_order = list(columns)
+    expected_order = TARGET_FIELDS.copy()
+
+    if actual_order != expected_order:
+        issues['column_order'] = 1
+        log("❌ ПОРЯДОК СТОЛБЦОВ НЕ СООТВЕТСТВУЕТ ТРЕБУЕМОМУ:")
+        log("  Ожидаемый порядок:")
+        for i, col in enumerate(expected_order):
+            log(f"    {i+1}. {col}")
+        log("  Фактический порядок:")
+        for i, col in enumerate(actual_order):
+            log(f"    {i+1}. {col}")
+
+
+def _report_codes(issues, log, invalid_count, invalid_samples, index, code_of):
+    """Итог по FULLCARDCODE: некорректные (с примерами строк) и дубликаты по индексу.
+
+    code_of(позиции) — написание кодов для примеров; нужно только для первых групп-дубликатов.
+    """
+    if invalid_count > 0:
+        issues['invalid_fullcardcode'] = invalid_count
+        log(f"❌ НЕКОРРЕКТНЫЕ FULLCARDCODE ({invalid_count}):")
+        for row_no, code in invalid_samples[:10]:
+            log(f"  Строка {row_no}: {code}")
+
+    # Группы и их размеры — за один проход индекса
+    duplicated_count = int(index.duplicated().sum())
+    if duplicated_count > 0:
+        issues['duplicated_fullcardcode'] = duplicated_count
+        first_rows, sizes = index.duplicate_groups()
+        log(f"❌ ДУБЛИКАТЫ FULLCARDCODE ({duplicated_count} строк, {len(sizes)} уникальных):")
+        for code, count in zip(code_of(first_rows[:10]), sizes[:10]):
+            log(f"  {code}: {count} раз")
+        if len(sizes) > 10:
+            log(f"  ... и ещё {len(sizes) - 10} дубликатов")
+
+
+def _report_rows(issues, log, duplicate_count, empty_name_table, has_required, empty_rows, whitespace):
+    """Итог построчных проверок в прежнем порядке сообщений."""
+    if duplicate_count:
+        issues['duplicated_rows'] = duplicate_count
+        log(f"❌ ДУБЛИКАТЫ СТРОК ({duplicate_count})")
+
+    if not has_required:
+        issues['missing_name_tableno'] = 1
+        log("❌ ОТСУТСТВУЮТ СТОЛБЦЫ NAME ИЛИ TABLENO")
+    elif empty_name_table > 0:
+        issues['empty_name_tableno'] = empty_name_table
+        log(f"❌ СТРОКИ БЕЗ NAME ИЛИ TABLENO ({empty_name_table}):")
+
+    if empty_rows > 0:
+        issues['empty_rows'] = empty_rows
+        log(f"❌ ПУСТЫЕ СТРОКИ ({empty_rows}):")
+
+    if whitespace > 0:
+        issues['whitespace'] = int(whitespace)
+        log(f"❌ ДАННЫЕ С НАЧАЛЬНЫМИ/КОНЕЧНЫМИ ПРОБЕЛАМИ ({whitespace})")
+
+
+def _chunk_row_checks(df, name_col, tableno_col):
+    """Счётчики для пачки строк: без NAME/TABLENO, полностью пустые, ячейки с пробелами по краям."""
+    stripped = df.astype(str).apply(lambda col: col.str.strip())
+    empty_name_table = 0
+    if name_col is not None and tableno_col is not None:
+        empty_name_table = int((stripped[name_col].eq('') | stripped[tableno_col].eq('')).sum())
+    empty_rows = int(stripped.eq('').all(axis=1).sum())
+    whitespace = 0
+    for col in df.columns:
+        if pd.api.types.is_string_dtype(df[col].dtype):
+            whitespace += int(df[col].astype(str).str.contains(r'^\s|\s$', regex=True, na=False).sum())
+    return empty_name_table, empty_rows, whitespace
+
+
+def _check_frame(file_path, result, log, clock):
+    """Полная проверка через pandas: файл целиком загружается в память."""
+    df = read_export_frame(file_path)
+    clock.lap('read', rows_out=len(df))
+    result.rows = len(df)
+    result.columns = len(df.columns)
+    log(f"Файл успешно загружен. Строк: {len(df)}, Столбцов: {len(df.columns)}")
+
+    issues = result.issues
+    _check_header(df.columns, issues, log)
+    clock.lap('columns', len(df), len(df))
+
+    if 'FULLCARDCODE' in df.columns:
+        df['FULLCARDCODE'] = df['FULLCARDCODE'].astype(str).str.strip()
+        valid_mask = df['FULLCARDCODE'].str.fullmatch(HEX_PATTERN.pattern)
+        invalid_codes = df['FULLCARDCODE'][~valid_mask & (df['FULLCARDCODE'] != '')]
+        samples = [(idx + 2, code) for idx, code in invalid_codes.head(10).items()]
+        valid_codes = df['FULLCARDCODE'][valid_mask]
+        _report_codes(issues, log, len(invalid_codes), samples,
+                      DedupIndex.from_codes(valid_codes), valid_codes.to_numpy().__getitem__)
+    else:
+        issues['missing_fullcardcode'] = 1
+        log("❌ ОТСУТСТВУЕТ СТОЛБЕЦ FULLCARDCODE")
+    clock.lap('fullcardcode', len(df), len(df))
+
+    duplicate_count = len(df) - len(DedupIndex.from_rows(df).sizes)
+    clock.lap('duplicates', len(df), len(df))
+
+    has_required = 'NAME' in df.columns and 'TABLENO' in df.columns
+    counts = _chunk_row_checks(df, 'NAME' if has_required else None, 'TABLENO' if has_required else None)
+    _report_rows(issues, log, duplicate_count, counts[0], has_required, counts[1], counts[2])
+    clock.lap('rows', len(df), len(df))
+
+
+def _check_stream(file_path, result, log, clock, fail_fast=False, stop=None, chunk_rows=CHECK_CHUNK_ROWS):
+    """Потоковая проверка: заголовок сразу, затем строки пачками прямо из XML листа.
+
+    Память — одна пачка строк плюс 8-байтные ключи для поиска дубликатов
+    (FULLCARDCODE — числом, написание хранится только у кодов в нижнем регистре).
+    fail_fast — не читать строки, если уже заголовок неверен; stop() — вызывается
+    после каждой пачки, True прерывает проверку.
+    """
+    issues = result.issues
+    with zipfile.ZipFile(file_path) as zf:
+        sheet_path = _xlsx_sheet_paths(zf)[0][1]
+        rows = iter_xlsx_cells(zf, sheet_path, _xlsx_shared_strings(zf))
+        header_row, header_cells = next(rows, (0, {}))
+        width = max(header_cells) + 1 if header_cells else 0
+        # Безымянные столбцы называются так же, как в pandas.read_excel
+        columns = [header_cells[i][1] if i in header_cells else f"Unnamed: {i}" for i in range(width)]
+        result.columns = width
+        log(f"Заголовок прочитан. Столбцов: {width}")
+        _check_header(columns, issues, log)
+        clock.lap('header')
+
+        if fail_fast and issues:
+            log("⏹ Заголовок не соответствует требованиям — строки не проверялись")
+            result.stopped = True
+            return
+
+        def position(name):
+            return columns.index(name) if name in columns else None
+
+        code_col, name_col, tableno_col = position('FULLCARDCODE'), position('NAME'), position('TABLENO')
+        has_required = name_col is not None and tableno_col is not None
+        invalid_count, invalid_samples = 0, []
+        keys, hashes = [], []
+        spelled = {}     # позиция ключа -> написание кода, если оно не восстанавливается из числа
+        empty_name_table = empty_rows = whitespace = 0
+
+        def check_chunk(batch, numbers):
+            nonlocal invalid_count, empty_name_table, empty_rows, whitespace
+            df = pd.DataFrame(batch, columns=range(width), dtype=object)
+            if code_col is not None:
+                df[code_col] = df[code_col].str.strip()
+                valid = df[code_col].str.fullmatch(HEX_PATTERN.pattern).to_numpy(dtype=bool)
+                invalid = ~valid & (df[code_col] != '').to_numpy()
+                invalid_count += int(invalid.sum())
+                for pos in np.flatnonzero(invalid)[:10 - len(invalid_samples)]:
+                    invalid_samples.append((numbers[pos], df[code_col].iat[pos]))
+                valid_codes = df[code_col][valid]
+                mixed = np.flatnonzero((valid_codes != valid_codes.str.upper()).to_numpy())
+                base = sum(len(k) for k in keys)
+                spelled.update(zip((base + mixed).tolist(), valid_codes.iloc[mixed]))
+                keys.append(fullcardcode_to_int(valid_codes))
+            hashes.append(row_hashes(df))
+            counts = _chunk_row_checks(df, name_col, tableno_col)
+            empty_name_table += counts[0]
+            empty_rows += counts[1]
+            whitespace += counts[2]
+            found = invalid_count + (empty_name_table if has_required else 0) + empty_rows + whitespace
+            log(f"   проверено строк: {result.rows}, найдено проблем: {found}")
+
+        batch, numbers = [], []
+        expected = header_row + 1
+        for row_no, cells in rows:
+            # Пропущенные в XML строки — пустые, как их видит read_excel
+            while expected < row_no:
+                batch.append([''] * width)
+                numbers.append(expected)
+                expected += 1
+            batch.append([cells[i][1] if i in cells else '' for i in range(width)])
+            numbers.append(row_no)
+            expected = row_no + 1
+            if len(batch) >= chunk_rows:
+                result.rows += len(batch)
+                check_chunk(batch, numbers)
+                batch, numbers = [], []
+                if stop is not None and stop():
+                    result.stopped = True
+                    log(f"⏹ Проверка остановлена после {result.rows} строк")
+                    break
+        else:
+            if batch:
+                result.rows += len(batch)
+                check_chunk(batch, numbers)
+        clock.lap('rows', rows_out=result.rows)
+
+    if code_col is None:
+        issues['missing_fullcardcode'] = 1
+        log("❌ ОТСУТСТВУЕТ СТОЛБЕЦ FULLCARDCODE")
+    else:
+        keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.uint64)
+
+        def code_of(rows):
+            return [spelled.get(int(row), f"{int(keys[row]):012X}") for row in rows]
+
+        _report_codes(issues, log, invalid_count, invalid_samples, DedupIndex(keys), code_of)
+    hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+    duplicate_count = len(hashes) - len(DedupIndex(hashes).sizes)
+    _report_rows(issues, log, duplicate_count, empty_name_table, has_required, empty_rows, whitespace)
+    clock.lap('duplicates', result.rows, result.rows)
+
+
+def check_export(file_path, log=None, stream=True, fail_fast=False, stop=None, chunk_rows=CHECK_CHUNK_ROWS):
+    """Проверка готового xlsx файла на соответствие структуры (без GUI).
+
+    По умолчанию лист читается потоково (_check_stream): проблемы заголовка видны
+    сразу, строки проверяются пачками с выводом прогресса. stream=False (и файлы
+    .xls) — прежняя проверка через pandas.read_excel; .parquet читается целиком.
+    """
+    log = log or null_log
+    result = CheckResult(file_path)
+    started = time.perf_counter()
+    clock = StageClock(result)
+
+    log(f"Проверка файла: {file_path}")
+    log("="*50)
+
+    try:
+        if stream and zipfile.is_zipfile(file_path):
+            _check_stream(file_path, result, log, clock, fail_fast, stop, chunk_rows)
+        else:
+            _check_frame(file_path, result, log, clock)
+
+        if not result.issues and not result.stopped:
+            log("✅ Файл соответствует всем требованиям!")
+        elif result.issues:
+            log("❌ Обнаружены проблемы в файле!")
+
+    except Exception as e:
+        result.error = str(e)
+        log(f"❌ ОШИБКА при проверке файла: {str(e)}")
+
+    result.timings['total'] = time.perf_counter() - started
+    log_stages(log, result.stages + [stage_record('total', result.timings['total'], rows_out=result.rows)])
+    return result
+
+
+# Категории проблем проверки — столбцы сводной таблицы пакетной проверки
+CHECK_ISSUES = ('missing_columns', 'extra_columns', 'column_order', 'invalid_fullcardcode',
+                'duplicated_fullcardcode', 'missing_fullcardcode', 'duplicated_rows',
+                'empty_name_tableno', 'missing_name_tableno', 'empty_rows', 'whitespace')
+CHECK_PATTERN = "Бастион_Экспорт_*.xlsx"
+
+
+def check_exports(sources, workers=0, log=None):
+    """Пакетная проверка xlsx из папок (по CHECK_PATTERN), масок и файлов в пуле процессов.
+
+    Отдельные журналы по файлам не создаются: в log идёт строка на файл по мере
+    готовности, итог — сводная таблица (summary_frame / log_check_summary).
+    Возвращает список CheckResult в порядке файлов.
+    """
+    log = log or null_log
+    files = collect_csv_files(sources, CHECK_PATTERN)
+    if not files:
+        log("ОШИБКА: файлы для проверки не найдены.", 'error')
+        return []
+    workers = resolve_workers(workers, len(files))
+    log(f"Проверка файлов: {len(files)}" + (f", процессов: {workers}" if workers > 1 else ""))
+    results = []
+    for result in pool_map(check_export, files, workers):
+        results.append(result)
+        line = f"{os.path.basename(result.file_path)} — {result.rows} строк, {result.timings.get('total', 0):.2f} с"
+        if result.error:
+            log(f"❌ {line}, ошибка: {result.error}")
+        elif result.ok:
+            log(f"✅ {line}")
+        else:
+            log(f"❌ {line}, видов проблем: {len(result.issues)}")
+    return results
+
+
+def summary_frame(results):
+    """Сводная таблица пакетной проверки: файл, строки, число каждой проблемы, время."""
+    rows = []
+    for result in results:
+        row = {'file': result.file_path, 'status': 'error' if result.error else ('ok' if result.ok else 'issues'),
+               'rows': result.rows}
+        row.update({key: result.issues.get(key, 0) for key in CHECK_ISSUES})
+        row['sec'] = round(result.timings.get('total', 0.0), 3)
+        row['error'] = result.error or ''
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['file', 'status', 'rows', *CHECK_ISSUES, 'sec', 'error'])
+
+
+def log_check_summary(log, results):
+    """Сводка в журнал: только столбцы проблем, встретившихся хотя бы в одном файле."""
+    summary = summary_frame(results)
+    issues = [key for key in CHECK_ISSUES if summary[key].any()]
+    name_width = max([len(os.path.basename(f)) for f in summary['file']] + [4])
+    log("\n📊 Сводка проверки:")
+    log(f"   {'файл':<{name_width}} {'строк':>8} " + " ".join(f"{key:>{len(key)}}" for key in issues) + f" {'сек':>7}")
+    for row in summary.itertuples(index=False):
+        values = row._asdict()
+        line = f"   {os.path.basename(values['file']):<{name_width}} {values['rows']:>8} "
+        line += " ".join(f"{values[key]:>{len(key)}}" for key in issues) + f" {values['sec']:>7.2f}"
+        if values['error']:
+            line += f"  ОШИБКА: {values['error']}"
+        log(line)
+    bad = int((summary['status'] != 'ok').sum())
+    if bad:
+        log(f"❌ Файлов с проблемами: {bad} из {len(summary)}")
+    else:
+        log(f"✅ Все файлы ({len(summary)}) соответствуют требованиям")
+
+
+def save_check_summary(results, path):
+    """Сохраняет сводку в .xlsx или CSV (по расширению)."""
+    summary = summary_frame(results)
+    if path.lower().endswith('.xlsx'):
+        write_output(summary.astype(str), path)
+    else:
+        summary.to_csv(path, sep=';', index=False, encoding='utf-8-sig')
+
+
+WATCH_TRIGGER = "ВЫГРУЗИТЬ"
+WATCH_OUTPUT = "Выгрузка"
+
+
+class FolderWatcher:
+    """Опрос папки: отдаёт новые и изменённые CSV, когда их запись закончена.
+
+    Файл считается готовым, если размер и mtime не менялись settle секунд и он
+    открывается на чтение (на Windows файл, который ещё пишется, обычно
+    заблокирован).
+    """
+
+    def __init__(self, folder, pattern="*.csv", settle=5.0):
+        self.folder = folder
+        self.pattern = pattern
+        self.settle = settle
+        self._pending = {}   # путь -> (size, mtime_ns, когда замечено последнее изменение)
+        self._known = {}     # путь -> (size, mtime_ns) уже принятых файлов
+
+    @staticmethod
+    def _readable(path):
+        try:
+            with open(path, 'rb'):
+                return True
+        except OSError:
+            return False
+
+    @property
+    def busy(self):
+        """Есть файлы, запись которых ещё не закончена."""
+        return bool(self._pending)
+
+    def poll(self, now=None):
+        """Возвращает (готовые файлы, удалённые файлы) с прошлого опроса."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        seen = set()
+        for path in collect_csv_files([self.folder], self.pattern):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            seen.add(path)
+            signature = (st.st_size, st.st_mtime_ns)
+            if self._known.get(path) == signature:
+                self._pending.pop(path, None)
+                continue
+            pending = self._pending.get(path)
+            if pending is None or pending[:2] != signature:
+                self._pending[path] = signature + (now,)
+            elif now - pending[2] >= self.settle and self._readable(path):
+                del self._pending[path]
+                self._known[path] = signature
+                ready.append(path)
+        removed = [path for path in self._known if path not in seen]
+        for path in removed:
+            del self._known[path]
+        for path in [path for path in self._pending if path not in seen]:
+            del self._pending[path]
+        return ready, removed
+
+
+class WatchService:
+    """Служба наблюдения за папкой выгрузок рабочих мест.
+
+    Готовые CSV сразу читаются и нормализуются в кэш (FileCache) — это и есть
+    поддерживаемый набор данных: при сборке экспорта неизменённые файлы берутся
+    из кэша без разбора. Экспорт пересобирается, если есть изменения и с
+    прошлой сборки прошло interval секунд (0 — сразу после поступления), или
+    по требованию — когда в папке появляется файл trigger (он удаляется).
+    Пока какой-то файл ещё дописывается, обе сборки откладываются.
+    """
+
+    def __init__(self, folder, output_dir=None, interval=0, settle=5.0, poll_interval=2.0,
+                 trigger=WATCH_TRIGGER, log=None, workers=1, **pipeline_options):
+        self.folder = folder
+        self.output_dir = output_dir or os.path.join(folder, WATCH_OUTPUT)
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.trigger = trigger
+        self.log = log or null_log
+        self.workers = workers
+        self.pipeline_options = dict(pipeline_options, workers=workers)
+        self.pipeline_options.setdefault('cache_dir', default_cache_dir())
+        self.watcher = FolderWatcher(folder, settle=settle)
+        try:
+            self.cache = FileCache(self.pipeline_options['cache_dir'],
+                                   self.pipeline_options.get('cache_max_mb', 1024) * 1024 * 1024)
+        except CACHE_ERRORS as e:
+            self._cache_failed(e)
+        self.dirty = False
+        self.requested = False
+        self.last_export = None
+        self.exports = []
+
+    def ingest(self, files):
+        """Читает готовые файлы в кэш. Возвращает число прочитанных без ошибок."""
+        ok = 0
+        workers = resolve_workers(self.workers, len(files))
+        for f, df, info, error in iter_read_csv_files(files, workers, self.pipeline_options.get('projected', False)):
+            if error is None:
+                if self.cache is not None:
+                    try:
+                        self.cache.store(f, df, info)
+                    except CACHE_ERRORS as e:
+                        self._cache_failed(e)
+                ok += 1
+                self.log(f" + {os.path.basename(f)} — {info['rows']} строк (кодировка: {info['encoding']})")
+            else:
+                self.log(f" ОШИБКА при чтении {f}: {error}")
+        if self.cache is not None:
+            try:
+                self.cache.save()
+            except CACHE_ERRORS as e:
+                self._cache_failed(e)
+        return ok
+
+    def _cache_failed(self, error):
+        # Без кэша служба продолжает работу: экспорт разбирает CSV заново
+        self.log(f"⚠ Кэш недоступен ({error}) — файлы будут читаться при сборке экспорта")
+        self.cache = None
+        self.pipeline_options['cache_dir'] = None
+
+    def export(self, now=None):
+        """Пересобирает экспорт; now — время по часам step(), от него отсчитывается interval."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        pipeline = ExportPipeline(log=self.log, cache=self.cache, **self.pipeline_options)
+        result = pipeline.run([self.folder], output_dir=self.output_dir)
+        append_metrics(os.path.join(self.output_dir, METRICS_NAME), 'process', result, self.log)
+        self.last_export = time.monotonic() if now is None else now
+        self.dirty = False
+        self.exports.append(result)
+        return result
+
+    def _triggered(self):
+        path = os.path.join(self.folder, self.trigger)
+        if not os.path.exists(path):
+            return False
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return True
+
+    def step(self, now=None):
+        """Один опрос папки. Возвращает ExportResult, если экспорт пересобран, иначе None."""
+        now = time.monotonic() if now is None else now
+        ready, removed = self.watcher.poll(now)
+        if ready:
+            self.log(f"\n📥 Поступило файлов: {len(ready)}")
+            self.ingest(ready)
+        for path in removed:
+            self.log(f"🗑 Файл удалён из папки: {os.path.basename(path)}")
+        self.dirty = self.dirty or bool(ready) or bool(removed)
+
+        if self._triggered():
+            self.requested = True
+            if self.watcher.busy:
+                self.log("\n⏳ Экспорт по требованию отложен — дописываются файлы")
+        if self.requested and not self.watcher.busy:
+            self.requested = False
+            self.log("\n▶ Экспорт по требованию")
+            return self.export(now)
+        due = self.last_export is None or now - self.last_export >= self.interval
+        if self.dirty and due and not self.watcher.busy:
+            return self.export(now)
+        return None
+
+    def run(self, stop=None, once=False):
+        """Цикл наблюдения до stop() (или одной сборки при once)."""
+        self.log(f"👁 Наблюдение за папкой: {self.folder}", 'info')
+        self.log(f"   Результаты: {self.output_dir}; экспорт по требованию — создайте файл «{self.trigger}»")
+        while not (stop and stop()):
+            self.step()
+            if once and not self.watcher.busy:
+                if self.dirty:
+                    self.export()
+                break
+            time.sleep(self.poll_interval)
+        self.log("⏹ Наблюдение остановлено")
+
+
 class App:
     # Цветовая схема
     COLORS = {
@@ -83,11 +3361,16 @@ class App:
         self.font_normal = Font(family="Segoe UI", size=10)
         self.font_log = Font(family="Consolas", size=9)
 
+        # Сообщения журнала копятся в очереди и выводятся пачками по таймеру
+        self.log_queue = queue.SimpleQueue()
+        self.log_sink = LogSink(ui_queue=self.log_queue)
+
         self._create_menu()
         self._create_header()
         self._create_main_card()
         self._create_buttons()
         self._create_status_bar()
+        self._drain_log()
 
         # Центрирование окна на экране (выполняется после создания всех виджетов)
         self.root.update_idletasks()
@@ -128,7 +3411,11 @@ class App:
         menu_bar = Menu(self.root)
         file_menu = Menu(menu_bar, tearoff=0)
         file_menu.add_command(label="📁 Выбрать папку...", command=self.run_process)
+        file_menu.add_command(label="🔁 Только изменения с прошлого запуска...", command=self.run_process_delta)
         file_menu.add_command(label="✅ Проверить файл...", command=self.check_export_file)
+        file_menu.add_command(label="📚 Проверить папку с выгрузками...", command=self.check_export_folder)
+        file_menu.add_separator()
+        file_menu.add_command(label="🗑 Очистить кэш", command=self.clear_cache)
         file_menu.add_separator()
         file_menu.add_command(label="❌ Выход", command=self.root.quit)
         menu_bar.add_cascade(label="Файл", menu=file_menu)
@@ -172,6 +3459,8 @@ class App:
         scrollbar.pack(side="right", fill="y")
         self.log_text.config(yscrollcommand=scrollbar.set)
         
+        for color, foreground in self.LOG_COLORS.items():
+            self.log_text.tag_config(color, foreground=foreground)
         self.log_text.config(state=DISABLED)
 
         # Прогресс-бар
@@ -194,6 +3483,13 @@ class App:
                                  bd=1, relief="solid", padx=25, pady=10, cursor="hand2", command=self.check_export_file)
         self.btn_check.pack(side="left", padx=10)
 
+        self.btn_stop = Button(btn_frame, text="⏹ Остановить проверку",
+                               font=self.font_normal, bg=self.COLORS['card_bg'], fg=self.COLORS['error'],
+                               activebackground='#fff1f0', activeforeground=self.COLORS['error'],
+                               bd=1, relief="solid", padx=25, pady=10, cursor="hand2",
+                               state=DISABLED, command=self.stop_check)
+        self.btn_stop.pack(side="left", padx=10)
+
     def _create_status_bar(self):
         self.status_var = self.root.var = "Готов к работе"
         self.status_label = Label(self.root, text=self.status_var, 
@@ -230,56 +3526,84 @@ class App:
             self.progress.pack_forget()
             self.btn_process.config(state=NORMAL)
             self.btn_check.config(state=NORMAL)
+            self.btn_stop.config(state=DISABLED)
             self.root.update()
         self._ui(_stop)
 
+    LOG_COLORS = {
+        'success': '#52c41a',
+        'warning': '#faad14',
+        'error': '#ff4d4f',
+        'info': '#1890ff',
+        'stat': '#722ed1',
+        'default': '#d4d4d4'
+    }
+    LOG_INTERVAL_MS = 100
+    LOG_BATCH = 2000
+
     def log(self, msg, tag=None):
-        def _log():
-            self.log_text.config(state=NORMAL)
+        self.log_sink(msg, tag)
+
+    def _open_log(self, log_file):
+        """Новый файл журнала для очередной операции; сообщения по-прежнему идут в окно."""
+        self.log_sink.close()
+        self.log_sink = LogSink(log_file, ui_queue=self.log_queue)
+
+    @staticmethod
+    def _log_color(msg, tag):
+        # Определяем цвет по префиксу сообщения
+        if tag:
+            return tag
+        elif msg.startswith('✅'):
+            return 'success'
+        elif msg.startswith('⚠') or msg.startswith('❗'):
+            return 'warning'
+        elif msg.startswith('❌'):
+            return 'error'
+        elif msg.startswith('📁') or msg.startswith('💾'):
+            return 'info'
+        elif msg.startswith('📊') or msg.startswith('🏢') or msg.startswith('🔒'):
+            return 'stat'
+        return 'default'
+
+    def _drain_log(self, reschedule=True):
+        """Выводит накопившиеся сообщения одной вставкой на цвет подряд (UI-поток)."""
+        batch = []
+        try:
+            while len(batch) < self.LOG_BATCH:
+                batch.append(self.log_queue.get_nowait())
+        except queue.Empty:
+            pass
 
-            # Определяем цвет по префиксу сообщения
-            if tag:
-                color = tag
-            elif msg.startswith('✅'):
-                color = 'success'
-            elif msg.startswith('⚠') or msg.startswith('❗'):
-                color = 'warning'
-            elif msg.startswith('❌'):
-                color = 'error'
-            elif msg.startswith('📁') or msg.startswith('💾'):
-                color = 'info'
-            elif msg.startswith('📊') or msg.startswith('🏢') or msg.startswith('🔒'):
-                color = 'stat'
-            else:
-                color = 'default'
-
-            colors = {
-                'success': '#52c41a',
-                'warning': '#faad14',
-                'error': '#ff4d4f',
-                'info': '#1890ff',
-                'stat': '#722ed1',
-                'default': '#d4d4d4'
-            }
-
-            self.log_text.tag_config(color, foreground=colors.get(color, '#d4d4d4'))
-            self.log_text.insert(END, msg + "\n", color)
+        if batch:
+            self.log_text.config(state=NORMAL)
+            run_color, run_lines = None, []
+            for msg, tag in batch:
+                color = self._log_color(msg, tag)
+                if color != run_color and run_lines:
+                    self.log_text.insert(END, "".join(run_lines), run_color)
+                    run_lines = []
+                run_color = color
+                run_lines.append(msg + "\n")
+            self.log_text.insert(END, "".join(run_lines), run_color)
             self.log_text.see(END)
             self.log_text.config(state=DISABLED)
-            self.log_text.update_idletasks()
 
-            if hasattr(self, 'log_file'):
-                with open(self.log_file, "a", encoding="utf-8") as f:
-                    f.write(msg + "\n")
-        self._ui(_log)
+        if reschedule:
+            # Если очередь не разобрана до конца — следующая пачка сразу
+            delay = 1 if len(batch) == self.LOG_BATCH else self.LOG_INTERVAL_MS
+            self.root.after(delay, self._drain_log)
 
-    def detect_encoding(self, file_path):
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                f.read(1024)
-            return 'utf-8'
-        except UnicodeDecodeError:
-            return 'cp1251'
+    def _flush_log(self):
+        """Довыводит всю очередь перед диалогом и сбрасывает файл журнала."""
+        while not self.log_queue.empty():
+            self._drain_log(reschedule=False)
+        self.log_sink.flush()
+
+    def clear_cache(self):
+        cache_dir = default_cache_dir()
+        removed = FileCache(cache_dir).invalidate() if os.path.isdir(cache_dir) else 0
+        messagebox.showinfo("Кэш", f"Кэш очищен: {removed} записей")
 
     def check_export_file(self):
         """Проверка готового xlsx файла на соответствие структуры"""
@@ -293,434 +3617,370 @@ class App:
         # Создаем лог для проверки
         folder = os.path.dirname(file_path)
         timestamp = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
-        self.log_file = os.path.join(folder, f"Бастион_Экспорт_Проверка_{timestamp}.txt")
-        open(self.log_file, "w", encoding="utf-8").close()
+        self._open_log(os.path.join(folder, f"Бастион_Экспорт_Проверка_{timestamp}.txt"))
 
-        self.log(f"Проверка файла: {file_path}")
-        self.log("="*50)
+        # Проверка идёт в фоне: журнал обновляется по мере чтения, её можно остановить
+        self._stop_check = threading.Event()
+        self.start_progress()
+        self.btn_stop.config(state=NORMAL)
+        self.set_status("Проверка файла...", self.COLORS['primary'])
+        thread = threading.Thread(target=self._check_export_thread, args=(file_path, folder))
+        thread.daemon = True
+        thread.start()
 
-        try:
-            # Загружаем файл
-            df = pd.read_excel(file_path, dtype=str, keep_default_na=False, na_filter=False)
-            self.log(f"Файл успешно загружен. Строк: {len(df)}, Столбцов: {len(df.columns)}")
-
-            issues_found = False
-
-            # 1. Проверка на наличие всех необходимых столбцов
-            missing_columns = []
-            extra_columns = []
-            
-            for field in TARGET_FIELDS:
-                if field not in df.columns:
-                    missing_columns.append(field)
-            
-            for col in df.columns:
-                if col not in TARGET_FIELDS:
-                    extra_columns.append(col)
-
-            if missing_columns:
-                issues_found = True
-                self.log(f"❌ ОТСУТСТВУЮЩИЕ СТОЛБЦЫ ({len(missing_columns)}):")
-                for col in missing_columns:
-                    self.log(f"  - {col}")
-
-            if extra_columns:
-                issues_found = True
-                self.log(f"❌ ЛИШНИЕ СТОЛБЦЫ ({len(extra_columns)}):")
-                for col in extra_columns:
-                    self.log(f"  - {col}")
-
-            # 2. Проверка порядка столбцов
-            actual_order = list(df.columns)
-            expected_order = TARGET_FIELDS.copy()
-            
-            if actual_order != expected_order:
-                issues_found = True
-                self.log("❌ ПОРЯДОК СТОЛБЦОВ НЕ СООТВЕТСТВУЕТ ТРЕБУЕМОМУ:")
-                self.log("  Ожидаемый порядок:")
-                for i, col in enumerate(expected_order):
-                    self.log(f"    {i+1}. {col}")
-                self.log("  Фактический порядок:")
-                for i, col in enumerate(actual_order):
-                    self.log(f"    {i+1}. {col}")
-
-            # 3. Проверка FULLCARDCODE
-            if 'FULLCARDCODE' in df.columns:
-                df['FULLCARDCODE'] = df['FULLCARDCODE'].astype(str).str.strip()
-                hex_pattern = re.compile(r'^[0-9A-Fa-f]{12}$')
-                
-                # Проверка формата
-                invalid_codes = df[~df['FULLCARDCODE'].apply(lambda x: bool(hex_pattern.fullmatch(x))) & (df['FULLCARDCODE'] != '')]
-                if len(invalid_codes) > 0:
-                    issues_found = True
-                    self.log(f"❌ НЕКОРРЕКТНЫЕ FULLCARDCODE ({len(invalid_codes)}):")
-                    for idx, row in invalid_codes.head(10).iterrows():
-                        self.log(f"  Строка {idx+2}: {row['FULLCARDCODE']}")
-
-                # Проверка дубликатов FULLCARDCODE
-                valid_codes_df = df[df['FULLCARDCODE'].apply(lambda x: bool(hex_pattern.fullmatch(x)))]
-                duplicated_codes = valid_codes_df[valid_codes_df.duplicated(subset=['FULLCARDCODE'], keep=False)]
-                
-                if len(duplicated_codes) > 0:
-                    issues_found = True
-                    unique_duplicated = duplicated_codes['FULLCARDCODE'].nunique()
-                    self.log(f"❌ ДУБЛИКАТЫ FULLCARDCODE ({len(duplicated_codes)} строк, {unique_duplicated} уникальных):")
-                    for code in duplicated_codes['FULLCARDCODE'].unique()[:10]:
-                        count = len(duplicated_codes[duplicated_codes['FULLCARDCODE'] == code])
-                        self.log(f"  {code}: {count} раз")
-                    if len(duplicated_codes['FULLCARDCODE'].unique()) > 10:
-                        self.log(f"  ... и ещё {len(duplicated_codes['FULLCARDCODE'].unique()) - 10} дубликатов")
+    def _check_export_thread(self, file_path, folder):
+        result = check_export(file_path, log=self.log, stop=self._stop_check.is_set)
+        append_metrics(os.path.join(folder, METRICS_NAME), 'check', result, self.log)
+        self._ui(self._flush_log, wait=True)
+        self.stop_progress()
 
-            else:
-                issues_found = True
-                self.log("❌ ОТСУТСТВУЕТ СТОЛБЕЦ FULLCARDCODE")
-
-            # 4. Проверка дубликатов строк
-            original_len = len(df)
-            unique_df = df.drop_duplicates()
-            if len(unique_df) != original_len:
-                issues_found = True
-                duplicate_count = original_len - len(unique_df)
-                self.log(f"❌ ДУБЛИКАТЫ СТРОК ({duplicate_count})")
-
-            # 5. Проверка обязательных полей NAME и TABLENO
-            if 'NAME' in df.columns and 'TABLENO' in df.columns:
-                empty_name_table = df[
-                    ((df['NAME'].isna()) | (df['NAME'] == '') | (df['NAME'].str.strip() == '')) |
-                    ((df['TABLENO'].isna()) | (df['TABLENO'] == '') | (df['TABLENO'].str.strip() == ''))
-                ]
-                
-                if len(empty_name_table) > 0:
-                    issues_found = True
-                    self.log(f"❌ СТРОКИ БЕЗ NAME ИЛИ TABLENO ({len(empty_name_table)}):")
-            else:
-                issues_found = True
-                self.log("❌ ОТСУТСТВУЮТ СТОЛБЦЫ NAME ИЛИ TABLENO")
-
-            # 6. Проверка пустых строк
-            all_empty_rows = df[df.astype(str).apply(lambda col: col.str.strip()).eq('').all(axis=1)]
-            if len(all_empty_rows) > 0:
-                issues_found = True
-                self.log(f"❌ ПУСТЫЕ СТРОКИ ({len(all_empty_rows)}):")
-
-            # 7. Проверка на пробелы в строковых данных
-            string_columns = df.select_dtypes(include=['object']).columns
-            rows_with_leading_trailing_spaces = 0
-            
-            for col in string_columns:
-                if col in df.columns:
-                    mask = df[col].astype(str).str.contains(r'^\s|\s$', regex=True, na=False)
-                    rows_with_leading_trailing_spaces += mask.sum()
-            
-            if rows_with_leading_trailing_spaces > 0:
-                issues_found = True
-                self.log(f"❌ ДАННЫЕ С НАЧАЛЬНЫМИ/КОНЕЧНЫМИ ПРОБЕЛАМИ ({rows_with_leading_trailing_spaces})")
-
-            if not issues_found:
-                self.log("✅ Файл соответствует всем требованиям!")
-                messagebox.showinfo("Проверка завершена", f"Файл {os.path.basename(file_path)} соответствует всем требованиям!")
-            else:
-                self.log("❌ Обнаружены проблемы в файле!")
-                messagebox.showwarning("Проверка завершена", f"Файл {os.path.basename(file_path)} содержит ошибки! Подробности в логе.")
+        name = os.path.basename(file_path)
+        if result.error:
+            self.set_status("Ошибка проверки", self.COLORS['error'])
+            self._ui(messagebox.showerror, "Ошибка", f"Не удалось проверить файл: {result.error}")
+        elif result.ok:
+            self.set_status("Проверка завершена", self.COLORS['success'])
+            self._ui(messagebox.showinfo, "Проверка завершена", f"Файл {name} соответствует всем требованиям!")
+        elif result.issues:
+            self.set_status("Проверка завершена: есть ошибки", self.COLORS['warning'])
+            self._ui(messagebox.showwarning, "Проверка завершена", f"Файл {name} содержит ошибки! Подробности в логе.")
+        else:
+            self.set_status("Проверка остановлена", self.COLORS['warning'])
 
-        except Exception as e:
-            self.log(f"❌ ОШИБКА при проверке файла: {str(e)}")
-            messagebox.showerror("Ошибка", f"Не удалось проверить файл: {str(e)}")
+    def check_export_folder(self):
+        """Пакетная проверка всех Бастион_Экспорт_*.xlsx в папке — одна сводка вместо журнала на файл."""
+        folder = filedialog.askdirectory(title="Выберите папку с выгрузками")
+        if not folder:
+            return
+        timestamp = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
+        self._open_log(os.path.join(folder, f"Бастион_Экспорт_Проверка_сводка_{timestamp}.txt"))
+        self.start_progress()
+        self.set_status("Проверка файлов...", self.COLORS['primary'])
+        thread = threading.Thread(target=self._check_folder_thread, args=(folder, timestamp))
+        thread.daemon = True
+        thread.start()
+
+    def _check_folder_thread(self, folder, timestamp):
+        results = check_exports([folder], workers=0, log=self.log)
+        if results:
+            log_check_summary(self.log, results)
+            summary_file = os.path.join(folder, f"Бастион_Экспорт_Проверка_сводка_{timestamp}.csv")
+            save_check_summary(results, summary_file)
+            self.log(f"📁 Сводка сохранена в: {summary_file}")
+        self._ui(self._flush_log, wait=True)
+        self.stop_progress()
 
-    def run_process(self):
-        from tkinter import filedialog
+        if not results:
+            self.set_status("Ошибка: файлы не найдены", self.COLORS['error'])
+            self._ui(messagebox.showerror, "❌ Ошибка", f"В папке нет файлов {CHECK_PATTERN}!")
+            return
+        bad = sum(1 for result in results if not result.ok)
+        self.set_status(f"Проверено файлов: {len(results)}, с проблемами: {bad}",
+                        self.COLORS['warning'] if bad else self.COLORS['success'])
+        self._ui(messagebox.showinfo, "Проверка завершена",
+                 f"Проверено файлов: {len(results)}\nС проблемами: {bad}\nПодробности в сводке.")
+
+    def stop_check(self):
+        if hasattr(self, '_stop_check'):
+            self._stop_check.set()
+
+    def run_process_delta(self):
+        self.run_process(delta=True)
+
+    def run_process(self, delta=False):
         folder = filedialog.askdirectory(title="Выберите папку с CSV-файлами")
         if not folder:
             return
 
-        self.log_file = os.path.join(folder, "export_log.txt")
-        open(self.log_file, "w", encoding="utf-8").close()
+        self._open_log(os.path.join(folder, "export_log.txt"))
 
-        self.log("═" * 50, 'info')
-        self.log(f"🚀 Начат экспорт из папки: {folder}", 'info')
-        self.log("═" * 50, 'info')
-        
         self.start_progress()
         self.set_status("Обработка файлов...", self.COLORS['primary'])
         
         # Запускаем обработку в отдельном потоке
-        thread = threading.Thread(target=self._run_process_thread, args=(folder,))
+        thread = threading.Thread(target=self._run_process_thread, args=(folder, delta))
         thread.daemon = True
         thread.start()
 
-    def _run_process_thread(self, folder):
-        csv_files = glob.glob(os.path.join(folder, "*.csv"))
-        if not csv_files:
+    def _run_process_thread(self, folder, delta=False):
+        try:
+            pipeline = ExportPipeline(log=self.log, workers=0, cache_dir=default_cache_dir(),
+                                      registry_path=default_registry_path(), delta=delta)
+            result = pipeline.run([folder], output_dir=folder)
+            append_metrics(os.path.join(folder, METRICS_NAME), 'process', result, self.log)
+        except Exception as e:
+            # Поток не должен падать молча: иначе индикатор крутится бесконечно
+            self.log(f"❌ ОШИБКА: {e}", 'error')
+            self.set_status("Ошибка при обработке", self.COLORS['error'])
+            self._ui(messagebox.showerror, "❌ Ошибка", str(e))
+            return
+        finally:
+            self.log_sink.flush()
             self.stop_progress()
+
+        if result.error == 'no_files':
             self.set_status("Ошибка: файлы не найдены", self.COLORS['error'])
             self._ui(messagebox.showerror, "❌ Ошибка", "В папке нет CSV-файлов!")
-            self.log("ОШИБКА: CSV-файлы не найдены.", 'error')
             return
-
-        self.log(f"Найдено {len(csv_files)} CSV-файлов. Загрузка...")
-
-        all_dfs = []
-        for f in csv_files:
-            try:
-                enc = self.detect_encoding(f)
-                df = pd.read_csv(f, sep=';', quotechar='"', encoding=enc,
-                                 dtype=str, keep_default_na=False, na_filter=False)
-                all_dfs.append(df)
-                self.log(f" + {os.path.basename(f)} — {len(df)} строк (кодировка: {enc})")
-            except Exception as e:
-                self.log(f" ОШИБКА при чтении {f}: {str(e)}")
-
-        if not all_dfs:
-            self.stop_progress()
+        if result.error == 'no_data':
             self.set_status("Ошибка: файлы не загружены", self.COLORS['error'])
-            self.log("❌ ОШИБКА: ни один файл не загружен.", 'error')
             return
 
-        combined = pd.concat(all_dfs, ignore_index=True)
-        initial_count = len(combined)
-        self.log(f"\nВсего строк после объединения: {initial_count}")
-
-        # Удаление заглушек
-        placeholder_cols = ['NAME', 'FIRSTNAME', 'SECONDNAME']
-        if all(col in combined.columns for col in placeholder_cols):
-            mask_bad = (combined['NAME'] == 'Фамилия') & (combined['FIRSTNAME'] == 'Имя') & (combined['SECONDNAME'] == 'Отчество')
-            bad_rows = mask_bad.sum()
-            combined = combined[~mask_bad].copy()
-            self.log(f"\nУдалено полей с русскими названиями: {bad_rows}")
-        else:
-            self.log("\n⚠️ Пропущено удаление заглушек: отсутствуют столбцы NAME/FIRSTNAME/SECONDNAME")
-
-        # Применяем strip ко всем строковым значениям
-        for col in combined.columns:
-            if combined[col].dtype == 'object':
-                combined[col] = combined[col].astype(str).str.strip()
-        
-        self.log("✅ Удалены начальные и конечные пробелы из всех строковых полей")
-
-        # Валидация FULLCARDCODE — сохраняем ВСЕХ удалённых
-        if 'FULLCARDCODE' in combined.columns:
-            combined['FULLCARDCODE'] = combined['FULLCARDCODE'].astype(str).str.strip()
-            hex_pattern = re.compile(r'^[0-9A-Fa-f]{12}$')
-            valid_mask = combined['FULLCARDCODE'].apply(lambda x: bool(hex_pattern.fullmatch(x)))
-            invalid_count = (~valid_mask).sum()
-
-            if invalid_count > 0:
-                # Выделяем ВСЕХ, кого удалим
-                rejected_df = combined[~valid_mask].copy()
-                rejected_file = os.path.join(folder, "rejected_FULLCARDCODE.xlsx")
-                rejected_df.to_excel(rejected_file, sheet_name='Отклонённые', index=False)
-                self.log(f"⚠️ УДАЛЕНО строк с битым FULLCARDCODE: {invalid_count}")
-                self.log(f"📁 Полный список сохранён в: {rejected_file}")
-                # Оставляем только валидные
-                combined = combined[valid_mask].copy()
-            else:
-                self.log("✅ FULLCARDCODE: все значения корректны")
-        else:
-            self.log("❌ ОШИБКА: отсутствует поле FULLCARDCODE — все строки отклонены")
-            combined = combined.iloc[0:0]
-
-        # Пустые строки
-        before_empty = len(combined)
-        empty_mask = combined.astype(str).apply(lambda col: col.str.strip()).eq('').all(axis=1)
-        combined = combined[~empty_mask].copy()
-        self.log(f"Удалено пустых строк: {before_empty - len(combined)}")
-
-        # NAME / TABLENO — сохраняем отклонённых
-        required_cols = ['NAME', 'TABLENO']
-        missing_required_cols = [col for col in required_cols if col not in combined.columns]
-        if missing_required_cols:
-            rejected_count = len(combined)
-            if rejected_count > 0:
-                rejected_file = os.path.join(folder, "rejected_NAME_TABLENO.xlsx")
-                combined.to_excel(rejected_file, sheet_name='Отклонённые', index=False)
-                self.log(f"⚠️ ОТСУТСТВУЮТ обязательные столбцы: {', '.join(missing_required_cols)}")
-                self.log(f"⚠️ УДАЛЕНО строк без возможности проверки NAME/TABLENO: {rejected_count}")
-                self.log(f"📁 Полный список сохранён в: {rejected_file}")
-            combined = combined.iloc[0:0]
-        else:
-            req_values = combined[required_cols].astype(str).apply(lambda col: col.str.strip())
-            required_mask = (req_values != '').all(axis=1)
-            rejected_req = combined[~required_mask].copy()
-            rejected_count = len(rejected_req)
-
-            if rejected_count > 0:
-                rejected_file = os.path.join(folder, "rejected_NAME_TABLENO.xlsx")
-                rejected_req.to_excel(rejected_file, sheet_name='Отклонённые', index=False)
-                self.log(f"⚠️ УДАЛЕНО строк без NAME/TABLENO: {rejected_count}")
-                self.log(f"📁 Полный список сохранён в: {rejected_file}")
-            else:
-                self.log("✅ Все строки содержат NAME и TABLENO")
-
-            combined = combined[required_mask].copy()
-
-        # Проверка наличия должности (POST)
-        if 'POST' in combined.columns:
-            # Удаляем строки, где POST пустой (после strip)
-            post_mask = combined['POST'].astype(str).str.strip() != ''
-            rejected_no_post = combined[~post_mask].copy()
-            rejected_no_post_count = len(rejected_no_post)
-
-            if rejected_no_post_count > 0:
-                rejected_post_file = os.path.join(folder, "rejected_no_POST.xlsx")
-                rejected_no_post.to_excel(rejected_post_file, sheet_name='Без должности', index=False)
-                self.log(f"⚠️ УДАЛЕНО строк без должности (POST): {rejected_no_post_count}")
-                self.log(f"📁 Список сохранён в: {rejected_post_file}")
-            else:
-                self.log("✅ Все строки содержат должность (POST)")
-
-            # Оставляем только строки с непустым POST
-            combined = combined[post_mask].copy()
-        else:
-            # Если столбца POST вообще нет — считаем, что все строки без должности
-            rejected_no_post_count = len(combined)
-            if rejected_no_post_count > 0:
-                rejected_post_file = os.path.join(folder, "rejected_no_POST.xlsx")
-                combined.to_excel(rejected_post_file, sheet_name='Без должности', index=False)
-                self.log(f"⚠️ СТОЛБЕЦ POST ОТСУТСТВУЕТ — все {rejected_no_post_count} строк отклонены")
-                self.log(f"📁 Список сохранён в: {rejected_post_file}")
-                combined = combined.iloc[0:0]  # Очищаем DataFrame
-            else:
-                self.log("✅ Нет данных для обработки (POST отсутствует, но и строк нет)")        
-
-        # Проверка дубликатов по FULLCARDCODE
-        if 'FULLCARDCODE' in combined.columns:
-            # Находим дубликаты по FULLCARDCODE
-            duplicated_mask = combined.duplicated(subset=['FULLCARDCODE'], keep=False)
-            duplicated_count = duplicated_mask.sum()
-            
-            if duplicated_count > 0:
-                duplicated_df = combined[duplicated_mask].copy()
-                duplicated_file = os.path.join(folder, "duplicated_FULLCARDCODE.xlsx")
-                duplicated_df.to_excel(duplicated_file, sheet_name='Дубликаты', index=False)
-                
-                # Получаем уникальные дублирующиеся коды
-                unique_duplicated_codes = duplicated_df['FULLCARDCODE'].unique()
-                self.log(f"⚠️ НАЙДЕНО дубликатов по FULLCARDCODE: {duplicated_count} строк")
-                self.log(f"⚠️ Уникальных дублирующихся кодов: {len(unique_duplicated_codes)}")
-                self.log(f"📁 Дубликаты сохранены в: {duplicated_file}")
-                
-                # Удаляем дубликаты, оставляя первый экземпляр
-                combined = combined.drop_duplicates(subset=['FULLCARDCODE'], keep='first')
-                self.log(f"✅ После удаления дубликатов: {len(combined)} строк")
-            else:
-                self.log("✅ Нет дубликатов по FULLCARDCODE")
-
-        # Дубликаты по всем полям (после удаления дубликатов по FULLCARDCODE)
-        before_dupes = len(combined)
-        combined.drop_duplicates(inplace=True)
-        self.log(f"Удалено дубликатов по всем полям: {before_dupes - len(combined)}")
-
-        # WORG6 → WORG7
-        if all(col in combined.columns for col in ['WORG6','WORG7','WORG8']):
-            mask_fix = (combined['WORG7'].str.strip() == '') & (combined['WORG8'].str.strip() == '') & (combined['WORG6'].str.strip() != '')
-            fixed = mask_fix.sum()
-            if fixed:
-                combined.loc[mask_fix, 'WORG7'] = combined.loc[mask_fix, 'WORG6']
-                self.log(f"Перенос названия организации из WORG6 → WORG7: {fixed}")
-
-        # WDEP8
-        if 'WDEP8' not in combined.columns:
-            combined['WDEP8'] = 'Нет данных'
-        else:
-            mask_empty = combined['WDEP8'].str.strip() == ''
-            combined.loc[mask_empty, 'WDEP8'] = 'Нет данных'
-            self.log(f"Заполнено пустых *Подразделений*: {mask_empty.sum()}")
-
-        # Статистика по отделам
-        if 'WDEP8' in combined.columns:
-            dep_stats = combined['WDEP8'].value_counts()
-            self.log("\n📊 Статистика по отделам (топ-10):")
-            for i, (dep, count) in enumerate(dep_stats.head(10).items()):
-                self.log(f"   {i+1}. {dep}: {count} человек")
-            
-            if len(dep_stats) > 10:
-                self.log(f"   ... и ещё {len(dep_stats) - 10} отделов")
-
-        # Статистика по организациям
-        org_columns = [col for col in ['WORG1', 'WORG2', 'WORG3', 'WORG4', 'WORG5', 'WORG6', 'WORG7', 'WORG8'] if col in combined.columns]
-        if org_columns:
-            # Используем WORG7 как основной источник информации об организации
-            if 'WORG7' in combined.columns and combined['WORG7'].notna().any():
-                org_stats = combined['WORG7'].value_counts()
-                self.log("\n🏢 Статистика по организациям (топ-10):")
-                for i, (org, count) in enumerate(org_stats.head(10).items()):
-                    if org and org.strip() != '':
-                        self.log(f"   {i+1}. {org}: {count} человек")
-                
-                if len(org_stats) > 10:
-                    self.log(f"   ... и ещё {len(org_stats) - 10} организаций")
-            elif org_columns:
-                # Если WORG7 пустой, используем любое из WORG полей
-                org_data = pd.Series(dtype=str)
-                for col in org_columns:
-                    org_data = pd.concat([org_data, combined[col]])
-                org_stats = org_data.value_counts()
-                
-                self.log("\n🏢 Статистика по организациям (топ-10):")
-                count = 0
-                for org, org_count in org_stats.head(10).items():
-                    if org and org.strip() != '':
-                        self.log(f"   {count+1}. {org}: {org_count} человек")
-                        count += 1
-                
-                if len([x for x in org_stats.head(10).items() if x[0] and x[0].strip() != '']) < 10:
-                    remaining_orgs = len([x for x in org_stats.items() if x[0] and x[0].strip() != '']) - 10
-                    if remaining_orgs > 0:
-                        self.log(f"   ... и ещё {remaining_orgs} организаций")
-
-        # Статистика по заблокированным пропускам
-        if 'IS_BLOCKED' in combined.columns:
-            blocked_count = (combined['IS_BLOCKED'] == '1').sum()
-            total_count = len(combined)
-            if total_count > 0:
-                blocked_percent = blocked_count / total_count * 100
-                self.log(f"\n🔒 Статистика по заблокированным пропускам: {blocked_count} из {total_count} ({blocked_percent:.2f}%)")
+        final_count = result.counts['final']
+        if delta:
+            self.set_status(f"Готово! Новых: {result.counts['delta_new']}, изменённых: "
+                            f"{result.counts['delta_changed']}, удалённых: {result.counts['delta_removed']}",
+                            self.COLORS['success'])
+            self._ui(messagebox.showinfo, "✅ Готово!",
+                     f"Экспорт изменений завершён!\n\n📁 Файл: {result.output_file}\n"
+                     f"🆕 Новых: {result.counts['delta_new']}\n✏ Изменённых: {result.counts['delta_changed']}\n"
+                     f"🗑 Удалённых: {result.counts['delta_removed']}")
+            return
+        self.set_status("Готово! Обработано записей: " + str(final_count), self.COLORS['success'])
+        self._ui(messagebox.showinfo, "✅ Готово!", f"Экспорт завершён!\n\n📁 Файл: {result.output_file}\n📝 Лог: export_log.txt\n📊 Обработано: {final_count} записей")
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Нормализация CSV «Бастион» → Excel (без графического интерфейса)")
+    sub = parser.add_subparsers(dest='command')
+
+    p_run = sub.add_parser('process', help="объединить и нормализовать CSV")
+    p_run.add_argument('sources', nargs='+', help="папки, CSV-файлы или маски (*.csv)")
+    p_run.add_argument('-o', '--output', help="итоговый .xlsx или папка для результатов")
+    p_run.add_argument('--log', help="файл журнала (по умолчанию export_log.txt в папке результата)")
+    p_run.add_argument('--com', action='store_true',
+                       help="дополнительно пересохранить через Excel COM (только Windows с Excel)")
+    p_run.add_argument('-j', '--workers', type=int, default=0,
+                       help="процессов для чтения CSV (0 — по числу ядер, 1 — последовательно)")
+    p_run.add_argument('--chunksize', type=int,
+                       help="потоковый режим: обрабатывать пачками по N строк (ограниченная память)")
+    p_run.add_argument('--rejects', choices=RejectWriter.FORMATS, default='xlsx',
+                       help="отклонённые строки: xlsx — файл на причину, workbook — одна книга "
+                            "с листом на причину, csv/parquet — без Excel")
+    p_run.add_argument('--engine', choices=OUTPUT_ENGINES, default='native',
+                       help="движок записи итогового xlsx: native — структура как у Excel (по умолчанию), "
+                            "pandas — как раньше, openpyxl — потоковая запись с постоянным расходом "
+                            "памяти, xlsxwriter")
+    p_run.add_argument('--cache', nargs='?', const=default_cache_dir(), metavar='DIR',
+                       help="кэш прочитанных CSV: неизменённые файлы не перечитываются "
+                            f"(без DIR — {default_cache_dir()})")
+    p_run.add_argument('--cache-size', type=int, default=1024, metavar='MB',
+                       help="предельный размер кэша, МБ (старые записи вытесняются)")
+    p_run.add_argument('--invalidate-cache', action='store_true', help="очистить кэш перед обработкой")
+    p_run.add_argument('--registry', nargs='?', const=default_registry_path(), metavar='FILE',
+                       help="реестр выгруженных карт (SQLite): проверка FULLCARDCODE по прошлым запускам "
+                            f"и обновление после сохранения (без FILE — {default_registry_path()})")
+    p_run.add_argument('--delta', action='store_true',
+                       help="режим изменений: сохранить только новые/изменённые записи (и удалённые отдельно) "
+                            "по сравнению со снимком прошлого запуска")
+    p_run.add_argument('--snapshot', metavar='FILE',
+                       help="файл снимка для --delta (по умолчанию Бастион_Экспорт_снимок.* в папке результата)")
+    p_run.add_argument('--no-normalize', action='store_true',
+                       help="не исправлять FULLCARDCODE (кириллица А/В/С/Е, невидимые символы, пробелы, регистр) "
+                            "и ФИО (латиница-двойники, неразрывные пробелы) перед проверкой")
+    p_run.add_argument('--near-duplicates', dest='near_duplicates', action='store_true', default=None,
+                       help="искать возможные дубли одного человека (ФИО, дата рождения, TABLENO); по умолчанию "
+                            "включено, кроме --chunksize: там ключи всех строк держатся в памяти до конца")
+    p_run.add_argument('--no-near-duplicates', dest='near_duplicates', action='store_false',
+                       help="не искать возможные дубли одного человека")
+    p_run.add_argument('--project', action='store_true',
+                       help="читать CSV сразу в схему TARGET_FIELDS (pyarrow, многопоточно): неизвестные столбцы "
+                            "отбрасываются с предупреждением, отсутствующие создаются пустыми")
+    p_run.add_argument('--columnar', action='store_true',
+                       help="дополнительно сохранить итог и отклонённые строки в Parquet (поля по TARGET_FIELDS)")
+    p_run.add_argument('--no-xlsx', action='store_true',
+                       help="с --columnar: итог только в Parquet, xlsx по необходимости — командой to-xlsx")
+    p_run.add_argument('--report', choices=REPORT_FORMATS, default='xlsx',
+                       help="сводка по отделам, организациям, блокировкам и причинам отклонения (полные "
+                            "таблицы): xlsx — Бастион_Сводка_*.xlsx рядом с итогом (по умолчанию), json, none")
+    p_run.add_argument('--json', help="сохранить результат (счётчики, тайминги) в JSON")
+    p_run.add_argument('--metrics', help=f"дописать метрики этапов строкой JSON (по умолчанию {METRICS_NAME} "
+                                          "рядом с журналом)")
+    p_run.add_argument('-q', '--quiet', action='store_true', help="не выводить журнал в консоль")
+
+    p_cmp = sub.add_parser('compare', help="сравнить структуру xlsx с эталоном (например, пересохранённым Excel)")
+    p_cmp.add_argument('file', help="проверяемый .xlsx")
+    p_cmp.add_argument('reference', help="эталонный .xlsx")
+
+    p_check = sub.add_parser('check', help="проверить готовый xlsx")
+    p_check.add_argument('file', help="проверяемый .xlsx или .parquet")
+    p_check.add_argument('--log', help="файл журнала")
+    p_check.add_argument('--json', help="сохранить результат проверки в JSON")
+    p_check.add_argument('--metrics', help="дописать метрики этапов строкой JSON в файл")
+    p_check.add_argument('--fail-fast', action='store_true',
+                         help="не проверять строки, если заголовок не соответствует требованиям")
+    p_check.add_argument('--pandas', action='store_true',
+                         help="прежняя проверка: загрузить файл целиком через pandas.read_excel")
+    p_check.add_argument('-q', '--quiet', action='store_true', help="не выводить журнал в консоль")
+
+    p_xlsx = sub.add_parser('to-xlsx', help="собрать xlsx из Parquet (итог или отклонённые строки)")
+    p_xlsx.add_argument('file', help=".parquet, сохранённый process --columnar")
+    p_xlsx.add_argument('-o', '--output', help="итоговый .xlsx (по умолчанию рядом, с тем же именем)")
+    p_xlsx.add_argument('--engine', choices=OUTPUT_ENGINES, default='native', help="движок записи xlsx")
+
+    p_batch = sub.add_parser('check-batch', help="проверить много xlsx параллельно, одна сводная таблица")
+    p_batch.add_argument('sources', nargs='+',
+                         help=f"папки (файлы {CHECK_PATTERN}), маски или отдельные .xlsx")
+    p_batch.add_argument('-j', '--workers', type=int, default=0,
+                         help="процессов (0 — по числу ядер, 1 — последовательно)")
+    p_batch.add_argument('--summary', help="сохранить сводку в .csv или .xlsx")
+    p_batch.add_argument('--log', help="файл журнала")
+    p_batch.add_argument('--json', help="сохранить результаты проверки всех файлов в JSON")
+    p_batch.add_argument('-q', '--quiet', action='store_true', help="не выводить журнал в консоль")
+
+    p_watch = sub.add_parser('watch', help="служба: следить за папкой и пересобирать экспорт по мере поступления CSV")
+    p_watch.add_argument('folder', help="папка, куда рабочие места складывают CSV")
+    p_watch.add_argument('-o', '--output', help=f"папка результатов (по умолчанию {WATCH_OUTPUT} внутри folder)")
+    p_watch.add_argument('--interval', type=float, default=0, metavar='MIN',
+                         help="пересобирать не чаще раза в MIN минут (0 — сразу после поступления файлов)")
+    p_watch.add_argument('--settle', type=float, default=5.0, metavar='SEC',
+                         help="файл считается записанным, если не менялся SEC секунд")
+    p_watch.add_argument('--poll', type=float, default=2.0, metavar='SEC', help="период опроса папки")
+    p_watch.add_argument('--trigger', default=WATCH_TRIGGER,
+                         help="имя файла-флага в папке для немедленной сборки")
+    p_watch.add_argument('--once', action='store_true', help="обработать текущее содержимое и завершиться")
+    p_watch.add_argument('-j', '--workers', type=int, default=1, help="процессов для чтения CSV")
+    p_watch.add_argument('--cache', default=default_cache_dir(), metavar='DIR', help="папка кэша")
+    p_watch.add_argument('--registry', nargs='?', const=default_registry_path(), metavar='FILE',
+                         help="реестр выгруженных карт, как у process")
+    p_watch.add_argument('--delta', action='store_true', help="выгружать только изменения, как у process")
+    p_watch.add_argument('--rejects', choices=RejectWriter.FORMATS, default='xlsx')
+    p_watch.add_argument('--engine', choices=OUTPUT_ENGINES, default='native')
+    p_watch.add_argument('--columnar', action='store_true', help="дополнительно сохранять Parquet, как у process")
+    p_watch.add_argument('--project', action='store_true', help="чтение в схему TARGET_FIELDS, как у process")
+    p_watch.add_argument('--log', help="файл журнала (по умолчанию watch_log.txt в папке результатов)")
+    p_watch.add_argument('-q', '--quiet', action='store_true', help="не выводить журнал в консоль")
+    return parser
+
+
+# Ошибки чтения/записи файлов, о которых командам достаточно сообщить (без трассировки):
+# нет файла или доступа, не xlsx/повреждённый архив, нет части пакета, битый XML, предел листа
+FILE_ERRORS = (OSError, ValueError, KeyError, zipfile.BadZipFile, ElementTree.ParseError)
+
+
+def _write_json(path, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def cli_main(argv=None):
+    """Точка входа командной строки. Возвращает код завершения."""
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if hasattr(sys.stdout, 'reconfigure'):
+        sys.stdout.reconfigure(errors='replace')
+
+    if args.command == 'process':
+        output_dir, output_file = None, None
+        if args.output:
+            if args.output.lower().endswith('.xlsx'):
+                output_file = os.path.abspath(args.output)
+                output_dir = os.path.dirname(output_file)
             else:
-                self.log("\n🔒 Статистика по заблокированным пропускам: 0 из 0 (0.00%)")
-
-        self.log("\n💾 Ждем сохранение файла")
-
-        for col in TARGET_FIELDS:
-            if col not in combined.columns:
-                combined[col] = ''
-
-        combined = combined[TARGET_FIELDS]
-
-        timestamp = datetime.now().strftime("%d-%m-%Y_%H-%M-%S")
-        output_file = os.path.join(folder, f"Бастион_Экспорт_{timestamp}.xlsx")
-        combined.to_excel(output_file, sheet_name='Лист1', index=False)
-        self.log(f"\nФайл сохранён: {output_file}")
-
-        # Пересохраняем через Excel COM
-        if HAS_WIN32:
-            excel = None
-            wb = None
+                output_dir = args.output
+            os.makedirs(output_dir, exist_ok=True)
+        log_dir = output_dir or (args.sources[0] if os.path.isdir(args.sources[0]) else '.')
+        log_file = args.log or os.path.join(log_dir, "export_log.txt")
+        with LogSink(log_file, echo=not args.quiet) as log:
+            if args.invalidate_cache:
+                cache_dir = args.cache or default_cache_dir()
+                if os.path.isdir(cache_dir):
+                    removed = FileCache(cache_dir).invalidate()
+                    log(f"🗑 Кэш очищен: {removed} записей")
             try:
-                excel = win32.Dispatch("Excel.Application")
-                excel.Visible = False
-                wb = excel.Workbooks.Open(output_file)
-                wb.Save()
-                self.log("✅ Файл пересохранён через Excel (структура выровнена)")
-            except Exception as e:
-                self.log(f"⚠ Не удалось пересохранить через Excel: {str(e)}")
-            finally:
-                try:
-                    if wb is not None:
-                        wb.Close(SaveChanges=True)
-                finally:
-                    if excel is not None:
-                        excel.Quit()
-        else:
-            self.log("⚠ Модуль win32com не установлен — пересохранение пропущено")
+                result = ExportPipeline(log=log, resave_com=args.com, cache_dir=args.cache,
+                                        cache_max_mb=args.cache_size, registry_path=args.registry,
+                                        delta=args.delta, snapshot_path=args.snapshot,
+                                        columnar=args.columnar, xlsx=not args.no_xlsx, projected=args.project,
+                                        normalize=not args.no_normalize, near_duplicates=args.near_duplicates,
+                                        report=args.report, workers=args.workers, chunksize=args.chunksize,
+                                        reject_format=args.rejects, output_engine=args.engine).run(
+                    args.sources, output_dir=output_dir, output_file=output_file)
+            except FILE_ERRORS as e:
+                log(f"❌ ОШИБКА: {e}", 'error')
+                result = ExportResult()
+                result.error = str(e)
+            append_metrics(args.metrics or os.path.join(os.path.dirname(os.path.abspath(log_file)), METRICS_NAME),
+                           'process', result, log)
+            if args.json:
+                _write_json(args.json, result.to_dict())
+            return 0 if result.ok else 1
+
+    if args.command == 'compare':
+        try:
+            differences = compare_xlsx_structure(args.file, args.reference)
+        except FILE_ERRORS as e:
+            print(f"❌ ОШИБКА при чтении файлов: {e}")
+            return 2
+        for line in differences:
+            print(f"❌ {line}")
+        if not differences:
+            print("✅ Структура файлов эквивалентна")
+        return 1 if differences else 0
+
+    if args.command == 'to-xlsx':
+        output = args.output or os.path.splitext(args.file)[0] + '.xlsx'
+        started = time.perf_counter()
+        try:
+            df = read_export_frame(args.file)
+            write_output(df, output, args.engine)
+        except FILE_ERRORS as e:
+            print(f"❌ ОШИБКА при преобразовании {args.file}: {e}")
+            return 1
+        print(f"✅ {output}: {len(df)} строк, {time.perf_counter() - started:.2f} с")
+        return 0
+
+    if args.command == 'check':
+        with LogSink(args.log, echo=not args.quiet) as log:
+            result = check_export(args.file, log=log, stream=not args.pandas, fail_fast=args.fail_fast)
+            if args.metrics:
+                append_metrics(args.metrics, 'check', result, log)
+        if args.json:
+            _write_json(args.json, result.to_dict())
+        return 0 if result.ok else 1
+
+    if args.command == 'check-batch':
+        with LogSink(args.log, echo=not args.quiet) as log:
+            results = check_exports(args.sources, workers=args.workers, log=log)
+            if results:
+                log_check_summary(log, results)
+            if results and args.summary:
+                save_check_summary(results, args.summary)
+                log(f"📁 Сводка сохранена в: {args.summary}")
+        if args.json:
+            _write_json(args.json, [result.to_dict() for result in results])
+        return 0 if results and all(result.ok for result in results) else 1
+
+    if args.command == 'watch':
+        output_dir = args.output or os.path.join(args.folder, WATCH_OUTPUT)
+        os.makedirs(output_dir, exist_ok=True)
+        with LogSink(args.log or os.path.join(output_dir, "watch_log.txt"), echo=not args.quiet) as log:
+            service = WatchService(args.folder, output_dir, interval=args.interval * 60, settle=args.settle,
+                                   poll_interval=args.poll, trigger=args.trigger, log=log,
+                                   workers=args.workers, cache_dir=args.cache, registry_path=args.registry,
+                                   delta=args.delta, reject_format=args.rejects, output_engine=args.engine,
+                                   columnar=args.columnar, projected=args.project)
+            try:
+                service.run(once=args.once)
+            except KeyboardInterrupt:
+                log("⏹ Наблюдение остановлено")
+        return 0 if all(result.ok for result in service.exports) else 1
+
+    parser.print_help()
+    return 2
 
-        self.stop_progress()
-        self.set_status("Готово! Обработано записей: " + str(len(combined)), self.COLORS['success'])
-        self._ui(messagebox.showinfo, "✅ Готово!", f"Экспорт завершён!\n\n📁 Файл: {output_file}\n📝 Лог: export_log.txt\n📊 Обработано: {len(combined)} записей")
 
 def main():
     root = Tk()
     app = App(root)
+    # Окно уже на экране — pandas, numpy и движки xlsx подгружаются в фоне, пока пользователь выбирает папку
+    root.after(100, lambda: threading.Thread(target=warm_up, daemon=True).start())
     root.mainloop()
 
 if __name__ == "__main__":
+    # Нужно для пула процессов в собранном PyInstaller exe (Windows)
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(cli_main())
     main()
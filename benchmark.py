@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарк нормализации CSV «Бастион».
+
+Генерирует синтетические выгрузки *.csv по схеме TARGET_FIELDS (кодировки,
+доля битых FULLCARDCODE, заглушек, дубликатов и строк без POST задаются
+параметрами), прогоняет ExportPipeline и check_export, выводит время,
+строк/с и пиковую память по этапам, а также время импорта модуля (с этого
+момента GUI может показать окно) и фонового прогрева зависимостей. Результат
+можно сохранить как эталон и сравнивать с ним последующие прогоны.
+
+Пример:
+    python benchmark.py --rows 200000 --files 20 --save baseline.json
+    python benchmark.py --rows 200000 --files 20 --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from Fix_CSV_for_Buro import TARGET_FIELDS, ExportPipeline, check_export, null_log, peak_rss_mb
+
+SURNAMES = ['Иванов', 'Петров', 'Сидоров', 'Кузнецов', 'Смирнов', 'Попов', 'Васильев', 'Соколов',
+            'Михайлов', 'Новиков', 'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов']
+FIRST_NAMES = ['Иван', 'Пётр', 'Сергей', 'Алексей', 'Андрей', 'Дмитрий', 'Ольга', 'Елена', 'Мария', 'Анна']
+SECOND_NAMES = ['Иванович', 'Петрович', 'Сергеевич', 'Алексеевич', 'Андреевна', 'Дмитриевна']
+POSTS = ['Инженер', 'Техник', 'Оператор', 'Мастер участка', 'Начальник отдела', 'Электромонтёр',
+         'Кладовщик', 'Водитель', 'Бухгалтер', 'Специалист']
+
+
+def generate_exports(folder, rows=100000, files=10, encodings=('utf-8', 'cp1251'),
+                     invalid_rate=0.01, placeholder_rate=0.005, duplicate_rate=0.02,
+                     empty_post_rate=0.01, seed=1):
+    """Создаёт files CSV-файлов с rows строками в сумме. Возвращает список путей."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    n = rows
+
+    data = {col: np.full(n, '', dtype=object) for col in TARGET_FIELDS}
+    data['B_VERSION'][:] = '1'
+    data['NAME'] = rng.choice(SURNAMES, n).astype(object)
+    data['FIRSTNAME'] = rng.choice(FIRST_NAMES, n).astype(object)
+    data['SECONDNAME'] = rng.choice(SECOND_NAMES, n).astype(object)
+    data['TABLENO'] = np.char.mod('%06d', np.arange(1, n + 1)).astype(object)
+    codes = rng.choice(2 ** 47, n, replace=False)
+    data['FULLCARDCODE'] = np.char.mod('%012X', codes).astype(object)
+    departments = np.array([f'Отдел {i}' for i in range(1, 301)] + [''], dtype=object)
+    data['WDEP8'] = rng.choice(departments, n)
+    organizations = np.array([f'ООО «Предприятие {i}»' for i in range(1, 61)], dtype=object)
+    worg = rng.choice(organizations, n)
+    moved = rng.random(n) < 0.3
+    data['WORG7'] = np.where(moved, '', worg).astype(object)
+    data['WORG6'] = np.where(moved, worg, '').astype(object)
+    data['POST'] = rng.choice(POSTS, n).astype(object)
+    data['PERSONCAT'] = rng.choice(['Сотрудник', 'Посетитель', 'Подрядчик'], n).astype(object)
+    data['SITIZENSHIP'] = rng.choice(['РФ', 'РБ', 'Казахстан'], n, p=[0.9, 0.05, 0.05]).astype(object)
+    data['PASSKIND'] = rng.choice(['Постоянный', 'Временный'], n).astype(object)
+    data['IS_BLOCKED'] = rng.choice(['0', '1'], n, p=[0.9, 0.1]).astype(object)
+    data['SEX'] = rng.choice(['М', 'Ж'], n).astype(object)
+    days = rng.integers(0, 365 * 50, n)
+    data['BIRTHDATE'] = pd.to_datetime('1950-01-01') + pd.to_timedelta(days, unit='D')
+    data['BIRTHDATE'] = data['BIRTHDATE'].strftime('%d.%m.%Y').to_numpy(dtype=object)
+    df = pd.DataFrame(data, columns=TARGET_FIELDS)
+
+    # Искажения
+    invalid = rng.random(n) < invalid_rate
+    df.loc[invalid, 'FULLCARDCODE'] = rng.choice(['', 'ZZZ', '12345', 'G0000000000X', ' 0000C3D4E5 '], invalid.sum())
+    empty_post = rng.random(n) < empty_post_rate
+    df.loc[empty_post, 'POST'] = ''
+    placeholder = rng.random(n) < placeholder_rate
+    df.loc[placeholder, ['NAME', 'FIRSTNAME', 'SECONDNAME']] = ['Фамилия', 'Имя', 'Отчество']
+    dup_count = int(n * duplicate_rate)
+    if dup_count:
+        src = rng.integers(0, n, dup_count)
+        dst = rng.integers(0, n, dup_count)
+        df.loc[dst, 'FULLCARDCODE'] = df['FULLCARDCODE'].to_numpy()[src]
+
+    paths = []
+    for i, part in enumerate(np.array_split(np.arange(n), files)):
+        enc = encodings[i % len(encodings)]
+        path = os.path.join(folder, f"station_{i + 1:03d}.csv")
+        df.iloc[part].to_csv(path, sep=';', index=False, encoding=enc, errors='replace')
+        paths.append(path)
+    return paths
+
+
+def _stage_table(stages, timings, memory, rows):
+    """Этапы для отчёта: время, строки/с по строкам самого этапа и память.
+
+    Строки и память берутся из stage_record (повторы этапа, например по пачкам,
+    суммируются); rss_delta_mb и peak_growth_mb есть всегда, peak_mb —
+    пик tracemalloc, только с --trace-memory. rows — для 'total' и этапов без счётчика строк.
+    """
+    merged = {}
+    for item in stages:
+        entry = merged.setdefault(item['stage'], {'rows': None, 'rss_delta_mb': None, 'peak_growth_mb': None})
+        stage_rows = item['rows_in'] if item['rows_in'] is not None else item['rows_out']
+        if stage_rows is not None:
+            entry['rows'] = (entry['rows'] or 0) + stage_rows
+        for key in ('rss_delta_mb', 'peak_growth_mb'):
+            if item.get(key) is not None:
+                entry[key] = round((entry[key] or 0.0) + item[key], 1)
+    table = {}
+    for stage, sec in timings.items():
+        entry = merged.get(stage, {'rows': rows if stage == 'total' else None,
+                                   'rss_delta_mb': None, 'peak_growth_mb': None})
+        table[stage] = {
+            'sec': round(sec, 4),
+            'rows': entry['rows'],
+            'rows_per_sec': round(entry['rows'] / sec) if sec > 0 and entry['rows'] else None,
+            'rss_delta_mb': entry['rss_delta_mb'],
+            'peak_growth_mb': entry['peak_growth_mb'],
+            'peak_mb': memory.get(stage),
+        }
+    return table
+
+
+def measure_import():
+    """Импорт модуля и warm_up() в отдельном чистом интерпретаторе: {'module_sec', 'warm_up': {модуль: сек}}."""
+    code = ("import json, time; started = time.perf_counter(); import Fix_CSV_for_Buro as m; "
+            "module_sec = time.perf_counter() - started; "
+            "print(json.dumps({'module_sec': module_sec, 'warm_up': m.warm_up()}))")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    report = json.loads(out.stdout.splitlines()[-1])
+    report['module_sec'] = round(report['module_sec'], 4)
+    report['warm_up'] = {name: round(sec, 4) for name, sec in report['warm_up'].items()}
+    return report
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='bastion_bench_')
+    try:
+        encodings = tuple(args.encodings.split(','))
+        started = time.perf_counter()
+        generate_exports(os.path.join(workdir, 'csv'), args.rows, args.files, encodings,
+                         args.invalid_rate, args.placeholder_rate, args.duplicate_rate,
+                         args.empty_post_rate, args.seed)
+        generate_sec = time.perf_counter() - started
+
+        if args.trace_memory:
+            tracemalloc.start()
+        pipeline = ExportPipeline(log=null_log, workers=args.workers, chunksize=args.chunksize,
+                                  output_engine=args.engine, projected=args.project)
+        result = pipeline.run([os.path.join(workdir, 'csv')], output_dir=workdir)
+        if not result.ok:
+            raise SystemExit(f"Ошибка обработки: {result.error}")
+        check = check_export(result.output_file)
+        if args.trace_memory:
+            tracemalloc.stop()
+
+        rows = result.counts['initial']
+        report = {
+            'params': {k: v for k, v in vars(args).items() if k not in ('save', 'baseline', 'json')},
+            'generate_sec': round(generate_sec, 3),
+            'import': measure_import(),
+            'rows': rows,
+            'final_rows': result.counts['final'],
+            'pipeline': _stage_table(result.stages, result.timings, result.memory, rows),
+            'check': _stage_table(check.stages, check.timings, check.memory, check.rows),
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_report(report, baseline=None, threshold=0.2):
+    """Печатает таблицу этапов; с эталоном — изменение времени и отметку о регрессии."""
+    regressions = []
+    print(f"Строк на входе: {report['rows']}, на выходе: {report['final_rows']}, "
+          f"генерация: {report['generate_sec']} с")
+    for section in ('pipeline', 'check'):
+        print(f"\n{'Обработка' if section == 'pipeline' else 'Проверка xlsx'}:")
+        traced = any(row.get('peak_mb') is not None for row in report[section].values())
+        print(f"  {'этап':<16}{'сек':>10}{'строк/с':>14}{'ΔRSS МБ':>10}{'рост пика':>11}"
+              + (f"{'trace МБ':>10}" if traced else '') + f"{'к эталону':>12}")
+        base = (baseline or {}).get(section, {})
+        for stage, row in report[section].items():
+            delta = ''
+            if stage in base and base[stage]['sec']:
+                ratio = row['sec'] / base[stage]['sec']
+                delta = f"{(ratio - 1) * 100:+.0f}%"
+                if ratio > 1 + threshold and row['sec'] - base[stage]['sec'] > 0.05:
+                    delta += ' ▲'
+                    regressions.append(f"{section}.{stage}")
+            rps = f"{row['rows_per_sec']:,}".replace(',', ' ') if row['rows_per_sec'] else '-'
+            rss = f"{row['rss_delta_mb']:+.1f}" if row.get('rss_delta_mb') is not None else '-'
+            growth = f"{row['peak_growth_mb']:.1f}" if row.get('peak_growth_mb') is not None else '-'
+            line = f"  {stage:<16}{row['sec']:>10.3f}{rps:>14}{rss:>10}{growth:>11}"
+            if traced:
+                line += f"{row['peak_mb']:>10.1f}" if row.get('peak_mb') is not None else f"{'-':>10}"
+            print(line + f"{delta:>12}")
+    if 'import' in report:
+        imp = report['import']
+        line = f"\nИмпорт модуля (окно GUI): {imp['module_sec']:.3f} с"
+        base = (baseline or {}).get('import')
+        if base and base['module_sec']:
+            ratio = imp['module_sec'] / base['module_sec']
+            line += f" ({(ratio - 1) * 100:+.0f}% к эталону)"
+            if ratio > 1 + threshold and imp['module_sec'] - base['module_sec'] > 0.05:
+                line += ' ▲'
+                regressions.append('import')
+        print(line)
+        print("Фоновый прогрев: " + ", ".join(f"{name} {sec:.3f} с" for name, sec in imp['warm_up'].items()))
+    if report['peak_rss_mb'] is not None:
+        print(f"\nПиковая память процесса: {report['peak_rss_mb']:.0f} МБ")
+    if regressions:
+        print(f"\n▲ Замедление более чем на {threshold:.0%}: {', '.join(regressions)}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк нормализации CSV «Бастион»")
+    parser.add_argument('--rows', type=int, default=100000, help="строк во всех файлах вместе")
+    parser.add_argument('--files', type=int, default=10, help="число CSV-файлов")
+    parser.add_argument('--encodings', default='utf-8,cp1251', help="кодировки файлов по кругу, через запятую")
+    parser.add_argument('--invalid-rate', type=float, default=0.01, help="доля битых FULLCARDCODE")
+    parser.add_argument('--placeholder-rate', type=float, default=0.005, help="доля строк-заглушек")
+    parser.add_argument('--duplicate-rate', type=float, default=0.02, help="доля дубликатов FULLCARDCODE")
+    parser.add_argument('--empty-post-rate', type=float, default=0.01, help="доля строк без POST")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-j', '--workers', type=int, default=1, help="процессов чтения CSV")
+    parser.add_argument('--chunksize', type=int, help="потоковый режим")
+    parser.add_argument('--engine', default='native', help="движок записи xlsx")
+    parser.add_argument('--project', action='store_true', help="чтение CSV сразу в схему TARGET_FIELDS")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="пиковая память по этапам через tracemalloc (замедляет прогон)")
+    parser.add_argument('--save', help="сохранить результат как эталон (JSON)")
+    parser.add_argument('--baseline', help="сравнить с эталоном (JSON)")
+    parser.add_argument('--threshold', type=float, default=0.2, help="допустимое замедление этапа (0.2 = 20%%)")
+    parser.add_argument('--json', help="сохранить результат в JSON")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    regressions = print_report(report, baseline, args.threshold)
+    for path in (args.save, args.json):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
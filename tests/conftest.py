@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+# Скрипт лежит в корне репозитория, пакета нет
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Fix_CSV_for_Buro import TARGET_FIELDS  # noqa: E402
+
+
+def _write_csv(path, start, rows, tail=''):
+    """CSV выгрузки по TARGET_FIELDS: rows корректных строк с кодами start.., затем tail как есть."""
+    lines = [';'.join(TARGET_FIELDS)]
+    for i in range(start, start + rows):
+        values = dict.fromkeys(TARGET_FIELDS, '')
+        values.update(NAME=f'Иванов{i}', FIRSTNAME='Иван', SECONDNAME='Иванович', TABLENO=str(i),
+                      FULLCARDCODE=f'{i:012X}', POST='Инженер', WDEP8='Отдел 1', WORG7='ООО Ромашка')
+        lines.append(';'.join(values[col] for col in TARGET_FIELDS))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n' + tail)
+
+
+@pytest.fixture
+def write_csv():
+    return _write_csv
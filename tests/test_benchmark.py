@@ -0,0 +1,19 @@
+from benchmark import _stage_table
+
+
+def test_stage_table_uses_stage_rows_and_memory_without_tracemalloc():
+    stages = [
+        {'stage': 'validate', 'sec': 1.0, 'rows_in': 1000, 'rows_out': 900, 'rss_delta_mb': 5.0, 'peak_growth_mb': 2.0},
+        {'stage': 'dedup', 'sec': 0.5, 'rows_in': 900, 'rows_out': 800, 'rss_delta_mb': -1.0, 'peak_growth_mb': 0.0},
+        {'stage': 'process', 'sec': 0.5, 'rows_in': 300, 'rows_out': 300, 'rss_delta_mb': 1.0, 'peak_growth_mb': 1.5},
+        {'stage': 'process', 'sec': 0.5, 'rows_in': 200, 'rows_out': 200, 'rss_delta_mb': 0.5, 'peak_growth_mb': 0.0},
+    ]
+    timings = {'validate': 1.0, 'dedup': 0.5, 'process': 1.0, 'total': 4.0}
+
+    table = _stage_table(stages, timings, {}, 1000)
+
+    assert table['dedup']['rows_per_sec'] == 1800
+    assert table['process']['rows'] == 500 and table['process']['rows_per_sec'] == 500
+    assert table['process']['rss_delta_mb'] == 1.5 and table['process']['peak_growth_mb'] == 1.5
+    assert table['validate']['peak_mb'] is None
+    assert table['total']['rows_per_sec'] == 250
@@ -0,0 +1,59 @@
+import os
+
+from Fix_CSV_for_Buro import ExportPipeline, WatchService
+
+
+def run(src, out, **options):
+    messages = []
+    os.makedirs(out, exist_ok=True)
+    result = ExportPipeline(log=lambda msg, tag=None: messages.append(msg), reject_format='csv',
+                            report='none', **options).run([str(src)], output_dir=str(out))
+    return result, messages
+
+
+def test_unusable_cache_dir_falls_back_to_plain_parse(tmp_path, write_csv):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 10)
+    blocker = tmp_path / 'cache'
+    blocker.write_text('не папка')
+
+    result, messages = run(src, tmp_path / 'out', cache_dir=str(blocker / 'sub'))
+
+    assert result.ok and result.counts['final'] == 10
+    assert any('Кэш недоступен' in msg for msg in messages)
+
+
+def test_cache_store_error_keeps_export_and_leaves_no_data_file(tmp_path, write_csv, monkeypatch):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 10)
+    cache_dir = tmp_path / 'cache'
+
+    def broken_to_pickle(self, path, *args, **kwargs):
+        open(path, 'wb').close()
+        raise OSError('диск заполнен')
+
+    monkeypatch.setattr('pandas.DataFrame.to_pickle', broken_to_pickle)
+    monkeypatch.setattr('pandas.DataFrame.to_feather', broken_to_pickle)
+
+    result, messages = run(src, tmp_path / 'out', cache_dir=str(cache_dir))
+
+    assert result.ok and result.counts['final'] == 10
+    assert any('диск заполнен' in msg for msg in messages)
+    assert os.listdir(cache_dir) == []
+
+
+def test_watch_service_runs_without_usable_cache(tmp_path, write_csv):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 10)
+    blocker = tmp_path / 'cache'
+    blocker.write_text('не папка')
+
+    service = WatchService(str(src), settle=0, cache_dir=str(blocker), report='none', reject_format='csv')
+    service.step(0)
+    result = service.step(1)
+
+    assert service.cache is None
+    assert result is not None and result.ok and result.counts['final'] == 10
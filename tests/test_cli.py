@@ -0,0 +1,16 @@
+import json
+
+from Fix_CSV_for_Buro import NativeXlsxWriter, cli_main
+
+
+def test_process_reports_write_error_without_traceback(tmp_path, write_csv, monkeypatch):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 20)
+    monkeypatch.setattr(NativeXlsxWriter, 'MAX_ROWS', 10)
+    summary = tmp_path / 'result.json'
+
+    code = cli_main(['process', str(src), '-o', str(tmp_path / 'out'), '-q', '--json', str(summary)])
+
+    assert code == 1
+    assert 'предела Excel' in json.loads(summary.read_text(encoding='utf-8'))['error']
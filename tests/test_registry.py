@@ -0,0 +1,35 @@
+import os
+
+from Fix_CSV_for_Buro import ExportPipeline
+
+
+def run(src, out, **options):
+    messages = []
+    os.makedirs(out, exist_ok=True)
+    result = ExportPipeline(log=lambda msg, tag=None: messages.append(msg), reject_format='csv',
+                            report='none', **options).run([str(src)], output_dir=str(out))
+    return result, messages
+
+
+def test_unusable_registry_path_skips_registry(tmp_path, write_csv):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 10)
+    blocker = tmp_path / 'registry'
+    blocker.write_text('не папка')
+
+    result, messages = run(src, tmp_path / 'out', registry_path=str(blocker / 'cards.sqlite'))
+
+    assert result.ok and result.counts['final'] == 10
+    assert 'registry_added' not in result.counts
+    assert any('Реестр карт недоступен' in msg for msg in messages)
+
+
+def test_registry_records_exported_cards(tmp_path, write_csv):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 10)
+
+    result, _ = run(src, tmp_path / 'out', registry_path=str(tmp_path / 'cards.sqlite'))
+
+    assert result.ok and result.counts['registry_added'] == 10
@@ -0,0 +1,24 @@
+import os
+
+from Fix_CSV_for_Buro import ExportPipeline
+
+
+def run(sources, output_dir, **options):
+    os.makedirs(output_dir, exist_ok=True)
+    return ExportPipeline(reject_format='csv', report='none', **options).run(sources, output_dir=output_dir)
+
+
+def test_file_failing_mid_stream_is_dropped_like_in_batch_mode(tmp_path, write_csv):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 300)
+    # Хвост файла повреждён (незакрытая кавычка): ошибка разбора после нескольких прочитанных пачек
+    write_csv(src / 'b.csv', 1001, 500, tail='"Петров;Пётр\n')
+
+    batch = run([str(src)], str(tmp_path / 'batch'))
+    streaming = run([str(src)], str(tmp_path / 'stream'), chunksize=100)
+
+    assert batch.counts['final'] == 300
+    assert streaming.counts['final'] == batch.counts['final']
+    assert [os.path.basename(f) for f in streaming.failed_files] == ['b.csv']
+    assert [os.path.basename(f) for f in streaming.loaded_files] == ['a.csv']
@@ -0,0 +1,18 @@
+from Fix_CSV_for_Buro import WatchService
+
+
+def test_interval_is_counted_on_the_step_clock(tmp_path, write_csv):
+    src = tmp_path / 'src'
+    src.mkdir()
+    write_csv(src / 'a.csv', 1, 10)
+    service = WatchService(str(src), str(tmp_path / 'out'), interval=100, settle=0,
+                           report='none', reject_format='csv')
+    service.step(1000)
+    assert service.step(1001) is not None
+    assert service.last_export == 1001
+
+    write_csv(src / 'b.csv', 11, 5)
+    service.step(1002)
+    assert service.step(1050) is None and service.dirty
+    result = service.step(1101)
+    assert result is not None and result.counts['final'] == 15
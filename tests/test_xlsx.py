@@ -0,0 +1,43 @@
+import re
+import zipfile
+
+import pandas as pd
+
+from Fix_CSV_for_Buro import compare_xlsx_structure, write_output
+
+
+def frame(rows):
+    return pd.DataFrame({'NAME': [f'Иванов{i}' for i in range(rows)], 'TABLENO': [str(i) for i in range(rows)]})
+
+
+def drop_row(src, dst, row):
+    """Копия книги без элемента <row r="row"> на первом листе."""
+    with zipfile.ZipFile(src) as zin, zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            data = zin.read(item.filename)
+            if item.filename == 'xl/worksheets/sheet1.xml':
+                data = re.sub(rb'<row r="%d".*?</row>' % row, b'', data)
+            zout.writestr(item, data)
+
+
+def test_compare_pairs_rows_by_number(tmp_path):
+    full, gap = tmp_path / 'full.xlsx', tmp_path / 'gap.xlsx'
+    write_output(frame(6), str(full))
+    drop_row(full, gap, 3)
+
+    # Пропуск одной строки — одно расхождение, следующие строки не сдвигаются
+    assert compare_xlsx_structure(str(gap), str(full)) == ["Лист1: строка 3 различается"]
+    assert compare_xlsx_structure(str(full), str(full)) == []
+
+
+def test_native_skips_blank_rows_like_xlsxwriter(tmp_path):
+    df = frame(5)
+    df.iloc[2] = ''
+    df.loc[len(df)] = ['', '']
+    native, reference = tmp_path / 'native.xlsx', tmp_path / 'xlsxwriter.xlsx'
+    write_output(df, str(native), 'native')
+    write_output(df, str(reference), 'xlsxwriter')
+
+    assert compare_xlsx_structure(str(native), str(reference)) == []
+    with zipfile.ZipFile(native) as zf:
+        assert b'<row r="4"' not in zf.read('xl/worksheets/sheet1.xml')